@@ -780,7 +780,7 @@ def main():
         inc    = 'freetype2'
         stream.write(pc_file(prefix, name, ver, lib, inc))
     # install standard libraries
-    std_pkgs = ['Routes', 'python-dateutil', 'decorator',
+    std_pkgs = ['python-dateutil', 'decorator',
             'pyOpenSSL', 'paramiko', 'pyzmq', 'tornado',
             'numpy', 'matplotlib', 'html2text', 'feedparser',
     ]
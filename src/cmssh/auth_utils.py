@@ -13,21 +13,29 @@ __author__ = "Valentin Kuznetsov"
 import os
 import stat
 import time
+import zlib
+import atexit
+import socket
+import thread
 import urllib
 import urllib2
 import httplib
 import tempfile
+import threading
 import traceback
 import cookielib
 
 # cmssh modules
 from   cmssh.iprint import print_info
-from   cmssh.utils import run
+from   cmssh.utils import run, HTTP_BYTES
+from   cmssh.metrics import METRICS
 
 class HTTPSClientAuthHandler(urllib2.HTTPSHandler):
     """
     Simple HTTPS client authentication class based on provided
-    key/ca information
+    key/ca information. The handler keeps persistent (keep-alive)
+    connection per host and thread, the connection is re-used by next
+    request once the previous response has been fully read.
     """
     def __init__(self, ckey=None, cert=None):
         if  int(os.environ.get('HTTPDEBUG', 0)):
@@ -40,39 +48,292 @@ class HTTPSClientAuthHandler(urllib2.HTTPSHandler):
         else:
             self.cert = cert
             self.ckey = None
+        self.conns = {} # (thread id, host) => (connection, last response)
+        self.lock  = threading.Lock()
 
     def https_open(self, req):
         """Open request method"""
-        #Rather than pass in a reference to a connection class, we pass in
-        # a reference to a function which, for all intents and purposes,
-        # will behave as a constructor
-        return self.do_open(self.get_connection, req)
+        host = req.get_host()
+        if  not host:
+            raise urllib2.URLError('no host given')
+        key = (thread.get_ident(), host)
+        with self.lock:
+            conn, last = self.conns.pop(key, (None, None))
+        resp = None
+        if  conn and last and not last.isclosed():
+            # previous response was not read till its end, hence
+            # connection can't be re-used
+            conn.close()
+            conn = None
+        if  conn and last:
+            try:
+                resp = self.send_request(conn, req)
+            except (socket.error, httplib.HTTPException):
+                # server closed idle connection, open a new one
+                conn.close()
+                resp = None
+        if  resp is None:
+            conn = self.get_connection(host, req.timeout)
+            conn.set_debuglevel(self._debuglevel)
+            try:
+                resp = self.send_request(conn, req)
+            except socket.error as err:
+                conn.close()
+                raise urllib2.URLError(err)
+        if  not resp.will_close:
+            with self.lock:
+                self.conns[key] = (conn, resp)
+        # wrap response the same way as urllib2.AbstractHTTPHandler.do_open
+        resp.recv = resp.read
+        fdesc = socket._fileobject(resp, close=True)
+        res = urllib.addinfourl(fdesc, resp.msg, req.get_full_url())
+        res.code = resp.status
+        res.msg = resp.reason
+        return res
+
+    def send_request(self, conn, req):
+        "Send given request over given connection and return its response"
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        return conn.getresponse(buffering=True)
 
     def get_connection(self, host, timeout=300):
         """Connection method"""
+        if  timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = 300
         if  self.cert:
             return httplib.HTTPSConnection(host, key_file=self.ckey,
-                                                cert_file=self.cert)
-        return httplib.HTTPSConnection(host)
+                                cert_file=self.cert, timeout=timeout)
+        return httplib.HTTPSConnection(host, timeout=timeout)
+
+class DecompressReader(object):
+    """
+    File-like wrapper around HTTP response which decompress gzip/deflate
+    encoded body as it is read and accounts received bytes in HTTP_BYTES.
+    """
+    def __init__(self, fdesc, encoding=None, chunk=65536):
+        self.fdesc = fdesc
+        self.chunk = chunk
+        self.encoding = encoding
+        self.zobj  = None
+        if  encoding == 'gzip':
+            self.zobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.zobj = zlib.decompressobj()
+        self.first = True
+        self.buf   = ''
+        self.eof   = False
+        HTTP_BYTES.add(0, 0)
+
+    def decompress(self, data):
+        "Decompress given portion of the body"
+        if  not self.zobj:
+            return data
+        try:
+            return self.zobj.decompress(data)
+        except zlib.error:
+            if  not (self.first and self.encoding == 'deflate'):
+                raise
+            # some servers send raw deflate stream without zlib header
+            self.zobj = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.zobj.decompress(data)
+
+    def fill(self):
+        "Read next chunk of data from underlying response"
+        data = self.fdesc.read(self.chunk)
+        if  not data:
+            self.eof = True
+            if  self.zobj:
+                self.buf += self.zobj.flush()
+            return
+        body = self.decompress(data)
+        self.first = False
+        HTTP_BYTES.add(len(data), len(body), requests=0)
+        self.buf += body
+
+    def read(self, size=-1):
+        "Read up to size bytes of decoded body"
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            self.fill()
+        if  size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self, size=-1):
+        "Read single line of decoded body"
+        while not self.eof and self.buf.find('\n') == -1:
+            self.fill()
+        idx = self.buf.find('\n') + 1
+        if  not idx:
+            idx = len(self.buf)
+        if  size >= 0:
+            idx = min(idx, size)
+        data, self.buf = self.buf[:idx], self.buf[idx:]
+        return data
+
+    def close(self):
+        "Close underlying response"
+        self.fdesc.close()
+
+class HTTPCompressionProcessor(urllib2.BaseHandler):
+    """
+    urllib2 processor which negotiates gzip/deflate encoding of HTTP
+    responses and transparently decompress them for the caller.
+    """
+    def http_request(self, req):
+        "Add Accept-Encoding header to outgoing request"
+        if  not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-encoding', 'gzip, deflate')
+        return req
+
+    def http_response(self, req, resp):
+        "Wrap response into decompressing reader"
+        encoding = resp.info().get('Content-Encoding', '').strip().lower()
+        if  encoding not in ['gzip', 'deflate']:
+            encoding = None
+        fdesc = DecompressReader(resp, encoding)
+        res = urllib.addinfourl(fdesc, resp.info(), resp.geturl(), resp.code)
+        res.msg = resp.msg
+        return res
+
+    https_request = http_request
+    https_response = http_response
+
+# registry of urllib2 openers, see get_opener
+OPENERS = {}
+OPENERS_LOCK = threading.Lock()
+
+def get_opener(ckey=None, cert=None, cookie_jar=None):
+    """
+    Return urllib2 opener for given key/cert and (optional) cookie jar.
+    Openers are cached, therefore all calls with the same credentials
+    share persistent connections of their HTTPSClientAuthHandler. The
+    openers are safe to use from multiple threads. Unless
+    CMSSH_HTTP_COMPRESSION is set to 0 openers negotiate gzip/deflate
+    response encoding.
+    """
+    debug = int(os.environ.get('HTTPDEBUG', 0))
+    compression = int(os.environ.get('CMSSH_HTTP_COMPRESSION', 1))
+    key = (ckey, cert, id(cookie_jar), debug, compression)
+    with OPENERS_LOCK:
+        if  key not in OPENERS:
+            handlers = [HTTPSClientAuthHandler(ckey, cert)]
+            if  compression:
+                handlers.append(HTTPCompressionProcessor())
+            if  cookie_jar is not None:
+                handlers.append(urllib2.HTTPCookieProcessor(cookie_jar))
+            # keep cookie jar reference, since its id is part of the key
+            OPENERS[key] = (urllib2.build_opener(*handlers), cookie_jar)
+        return OPENERS[key][0]
+
+# cookie jars used by SSO openers, one per key/cert pair
+SSO_COOKIES = {}
 
 def create_https_opener(key, cert):
     "Create HTTPS url opener with cookie support"
-    cookie_jar = cookielib.CookieJar()
-    cookie_handler = urllib2.HTTPCookieProcessor(cookie_jar)
-    https_handler  = HTTPSClientAuthHandler(key, cert)
-    opener = urllib2.build_opener(cookie_handler, https_handler)
+    with OPENERS_LOCK:
+        cookie_jar = SSO_COOKIES.setdefault((key, cert), cookielib.CookieJar())
+    opener = get_opener(key, cert, cookie_jar)
     agent = 'Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10.6; en-US; rv:1.9.2.11) Gecko/20101012 Firefox/3.6.11'
     opener.addheaders = [('User-Agent', agent)]
-    urllib2.install_opener(opener)
     return opener
 
 class _PEMMgr(object):
-    "PEM content holder"
+    """
+    PEM content holder. It also manages session key file, i.e. the file
+    with user key pem content which is created once per cmssh session
+    (in user .globus area with 0600 permissions) and shared by all
+    HTTP calls made via working_pem. The file is removed at shell exit.
+    """
     def __init__(self):
-        self.pem  = None # to be initialized at run time
+        self.pem   = None # to be initialized at run time
+        self.gdir  = os.path.join(os.environ['HOME'], '.globus')
+        self.files = {}   # pem content => session key file name
+        self.refs  = {}   # session key file name => number of active users
+        self.stale = set()# files whose pem content was replaced
+        self.lock  = threading.RLock()
+        # .globus can be shared among hosts (AFS/NFS home), hence host name
+        self.host   = socket.gethostname().replace('_', '-')
+        self.prefix = 'cmssh_pem_%s_%s_' % (self.host, os.getpid())
+
+    def acquire(self, pem=None):
+        "Return session key file for given pem content and increment its refs"
+        if  pem is None:
+            pem = self.pem
+        with self.lock:
+            name = self.files.get(pem)
+            if  not name:
+                if  not self.files:
+                    self.sweep()
+                for oname in self.files.values():
+                    if  self.refs.get(oname):
+                        self.stale.add(oname)
+                    else:
+                        self.remove(oname)
+                fdesc, name = tempfile.mkstemp(prefix=self.prefix, dir=self.gdir)
+                with os.fdopen(fdesc, 'w') as stream:
+                    stream.write(pem)
+                self.files = {pem: name}
+                self.refs[name] = 0
+            self.refs[name] += 1
+            return name
+
+    def release(self, name):
+        """
+        Decrement refs of given session key file. The file is kept
+        until the end of the session unless its pem content was replaced
+        """
+        with self.lock:
+            self.refs[name] -= 1
+            if  name in self.stale and not self.refs[name]:
+                self.remove(name)
+
+    def remove(self, name):
+        "Remove given session key file"
+        with self.lock:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+            self.stale.discard(name)
+            self.refs.pop(name, None)
+
+    def sweep(self):
+        """
+        Remove session key files left by cmssh sessions of this host
+        which did not exit, files of other hosts are never touched
+        """
+        if  not os.path.isdir(self.gdir):
+            return
+        prefix = 'cmssh_pem_%s_' % self.host
+        for fname in os.listdir(self.gdir):
+            if  not fname.startswith(prefix):
+                continue
+            try:
+                pid = int(fname[len(prefix):].split('_')[0])
+                os.kill(pid, 0)
+            except (ValueError, IndexError):
+                continue
+            except OSError: # process does not exist anymore
+                try:
+                    os.remove(os.path.join(self.gdir, fname))
+                except OSError:
+                    pass
+
+    def cleanup(self):
+        "Remove all session key files, called at shell exit"
+        with self.lock:
+            for name in self.refs.keys():
+                self.remove(name)
+            self.files = {}
 
 # Singleton
 PEMMGR = _PEMMgr()
+atexit.register(PEMMGR.cleanup)
 
 def read_pem():
     "Create user key pem content"
@@ -116,21 +377,20 @@ def read_pem_via_openssl():
         traceback.print_exc()
 
 class working_pem(object):
-    "ContextManager for temporary user key pem file"
-    def __init__(self, pem):
-        self.gdir = os.path.join(os.environ['HOME'], '.globus')
+    """
+    ContextManager for user key pem file. It provides session key file
+    managed by PEMMGR, therefore no file is written for every request.
+    """
+    def __init__(self, pem=None):
         self.pem  = pem
         self.name = None # runtime thing
     def __enter__(self):
         "Enter the runtime context related to this object"
-        fobj = tempfile.mkstemp(prefix='cmssh', dir=self.gdir)
-        self.name = fobj[-1]
-        with open(self.name, 'w') as fname:
-            fname.write(self.pem)
+        self.name = PEMMGR.acquire(self.pem)
         return self.name
     def __exit__(self, exc_type, exc_val, exc_tb):
         "Exit the runtime context related to this object"
-        os.remove(self.name)
+        PEMMGR.release(self.name)
         self.name = None
 
 def timestamp():
@@ -172,7 +432,9 @@ def get_data_sso(url, key, cert, debug=0, redirect=None):
     For iCMS access we need to pass via environment checking, e.g.
     http://cms.cern.ch/iCMS/bla should be redirected to
     https://cms.cern.ch/test/env.cgi?url=http://cms.cern.ch/iCMS/bla
+    The total time of SSO look-up is recorded in METRICS.
     """
+    time0    = time.time()
     cern_env = 'https://cms.cern.ch/test/env.cgi?url='
     if  url.find('http://cms.cern.ch/iCMS') == 0 or\
         url.find('https://cms.cern.ch/iCMS') == 0:
@@ -197,6 +459,7 @@ def get_data_sso(url, key, cert, debug=0, redirect=None):
         # descriptor to upper level, e.g.
         # in case of CERN twiki it does not pass through SSO
         # therefore we just return file descriptor
+        METRICS.record(orig_url, time.time() - time0, fdesc.code, label='SSO')
         return fdesc
     fdesc.close()
 
@@ -231,6 +494,7 @@ def get_data_sso(url, key, cert, debug=0, redirect=None):
         print_info('Redirect parameters')
         print url + '?' + params
     fdesc  = opener.open(url, params)
+    METRICS.record(orig_url, time.time() - time0, fdesc.code, label='SSO')
     return fdesc
 
 def get_key_cert():
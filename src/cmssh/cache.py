@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+
+"""
+Cache of function results. Every decorated function has its own cache
+with optional TTL of results and max number of results, least recently
+used results are evicted first. Caches are thread-safe, count their
+hits, misses and evictions, and can be invalidated explicitly. Results
+of generators are stored as lists. Cache can be persisted on disk, in
+this case results should be JSON serializable. Persistent caches are
+stored in CMSSH_CACHE_DIR/functions (default is ~/.cmssh/cache), they
+are kept in memory only if CMSSH_CACHE=0.
+
+Usage:
+
+    @cached(ttl=3600, maxsize=32)
+    def releases(name=None):
+        ...
+
+    releases.invalidate() # drop all results
+    releases.invalidate('CMSSW_5_3_0') # drop result of given call
+"""
+
+# system modules
+import os
+import json
+import time
+import inspect
+import tempfile
+import functools
+import threading
+from   types import GeneratorType
+from   collections import OrderedDict
+
+# registry of all caches, name => FunctionCache
+CACHES = {}
+
+class FunctionCache(object):
+    "Thread-safe cache of function results with TTL and LRU eviction"
+    def __init__(self, name, ttl=None, maxsize=None, persist=False):
+        self.name      = name
+        self.ttl       = ttl     # in sec, None means results do not expire
+        self.maxsize   = maxsize # None means unbounded cache
+        self.persist   = persist and \
+                bool(int(os.environ.get('CMSSH_CACHE', 1)))
+        self.entries   = OrderedDict() # key => (tstamp, value), LRU first
+        self.loaded    = not self.persist
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.lock      = threading.RLock()
+
+    def fname(self):
+        "Return location of persistent cache"
+        cdir = os.environ.get('CMSSH_CACHE_DIR', \
+                os.path.join(os.environ['HOME'], '.cmssh', 'cache'))
+        return os.path.join(cdir, 'functions', '%s.json' % self.name)
+
+    def load(self):
+        "Load persistent cache, the lock must be held"
+        if  self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(self.fname()) as stream:
+                for key, tstamp, value in json.load(stream):
+                    self.entries[key] = (tstamp, value)
+        except (IOError, ValueError, TypeError):
+            pass
+
+    def save(self):
+        "Atomically write persistent cache, the lock must be held"
+        if  not self.persist:
+            return
+        fname = self.fname()
+        try:
+            if  not os.path.isdir(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname), 0700)
+            fdes, tmp = tempfile.mkstemp(suffix='.tmp', \
+                    dir=os.path.dirname(fname))
+            with os.fdopen(fdes, 'w') as stream:
+                json.dump([[k, t, v] for k, (t, v) in self.entries.items()], stream)
+            os.rename(tmp, fname)
+        except (IOError, OSError, TypeError, ValueError):
+            pass # cache is an optimization
+
+    def expired(self, tstamp):
+        "Check if result stored at given time is expired"
+        return self.ttl is not None and time.time() - tstamp > self.ttl
+
+    def get(self, key):
+        "Return (found, value) pair for given key"
+        with self.lock:
+            self.load()
+            if  key in self.entries:
+                tstamp, value = self.entries.pop(key)
+                if  not self.expired(tstamp):
+                    self.entries[key] = (tstamp, value) # most recently used
+                    self.hits += 1
+                    return True, value
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        "Store value under given key"
+        with self.lock:
+            self.load()
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while self.maxsize and len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            self.save()
+
+    def invalidate(self, key=None):
+        "Drop result of given key or all results"
+        with self.lock:
+            self.load()
+            if  key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+            self.save()
+
+    def stats(self):
+        "Return dict of cache statistics"
+        with self.lock:
+            return {'name': self.name, 'size': len(self.entries),
+                    'maxsize': self.maxsize, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'persist': self.persist}
+
+def cached(ttl=None, maxsize=128, persist=False, name=None, key=None):
+    """
+    Decorator which caches results of a function. Results are keyed by
+    call arguments (positional and keyword arguments are equivalent,
+    defaults are taken into account) or by key(*args, **kwargs) if key
+    function is given.
+    Decorated function provides cache attribute and invalidate method
+    which accepts the same arguments as the function, without arguments
+    it drops all results.
+    """
+    def wrap(func):
+        "Wrap given function"
+        cname = name or '%s.%s' % (func.__module__.split('.')[-1], func.__name__)
+        cache = FunctionCache(cname, ttl, maxsize, persist)
+        CACHES[cname] = cache
+        def make_key(args, kwargs):
+            "Cache key of given call"
+            if  key:
+                return json.dumps(key(*args, **kwargs), default=repr)
+            callargs = inspect.getcallargs(func, *args, **kwargs)
+            return json.dumps(sorted(callargs.items()), default=repr)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            "Return cached result of the call"
+            ckey = make_key(args, kwargs)
+            found, value = cache.get(ckey)
+            if  found:
+                return value
+            value = func(*args, **kwargs)
+            if  isinstance(value, GeneratorType):
+                value = list(value)
+            cache.set(ckey, value)
+            return value
+        def invalidate(*args, **kwargs):
+            "Drop cached result of given call, or all results"
+            if  args or kwargs:
+                cache.invalidate(make_key(args, kwargs))
+            else:
+                cache.invalidate()
+        wrapper.cache = cache
+        wrapper.invalidate = invalidate
+        return wrapper
+    return wrap
@@ -22,17 +22,25 @@ import subprocess
 # cmssh modules
 from cmssh.iprint import msg_red, msg_green, msg_blue
 from cmssh.iprint import print_warning, print_error, print_status, print_info
-from cmssh.filemover import copy_lfn, rm_lfn, mkdir, rmdir, list_se, dqueue
+from cmssh.filemover import copy_lfn, rm_lfn, mkdir, rmdir, list_se
+from cmssh.transfers import copy_files, multi_source, dqueue
+from cmssh.transfers import cancel_jobs, top_jobs
 from cmssh.utils import list_results, check_os, unsupported_linux, access2file
 from cmssh.utils import osparameters, check_voms_proxy, run, user_input
-from cmssh.utils import execmd, touch, platform
+from cmssh.utils import execmd, touch, platform, size_format, HTTP_BYTES
 from cmssh.cmsfs import dataset_info, block_info, file_info, site_info, run_info
-from cmssh.cmsfs import CMSMGR, apply_filter, validate_dbs_instance
+from cmssh.cmsfs import CMSMGR, validate_dbs_instance
+from cmssh.dispatcher import split_pipes
+from cmssh.pipeline import pipeline
 from cmssh.cmsfs import release_info, run_lumi_info
 from cmssh.github import get_tickets, post_ticket
 from cmssh.cms_urls import dbs_instances, tc_url
 from cmssh.das import das_client
 from cmssh.url_utils import get_data, send_email
+from cmssh.url_cache import HTTP_CACHE
+from cmssh.cache import CACHES
+from cmssh.metrics import METRICS
+from cmssh.sources import SOURCES
 from cmssh.regex import pat_release, pat_site, pat_dataset, pat_block
 from cmssh.regex import pat_lfn, pat_run, pat_se, pat_user
 from cmssh.tagcollector import architectures as tc_architectures
@@ -125,7 +133,7 @@ def cms_releases(arg=None):
         print "CMSSW releases for %s platform" % platform()
         res = release_info(release=None, rfilter=arg)
         RESMGR.assign(res)
-        releases = [str(r) for r in res]
+        releases = [str(r) for r in RESMGR]
         releases = list(set(releases))
         releases.sort()
         for rel in releases:
@@ -183,6 +191,8 @@ def cms_xrdcp(arg):
 def debug_http(arg):
     """
     Show or set HTTP debug flag. Default is 0.
+    When called without argument it also reports HTTP traffic,
+    i.e. number of bytes received over the wire and after decompression.
     """
     arg = arg.strip()
     if  arg:
@@ -193,6 +203,7 @@ def debug_http(arg):
         os.environ['HTTPDEBUG'] = arg
     else:
         print_info("HTTP debug level is %s" % os.environ.get('HTTPDEBUG', 0))
+        print_info("HTTP traffic: %s" % HTTP_BYTES)
 
 def cms_find(arg):
     """
@@ -201,14 +212,22 @@ def cms_find(arg):
     Examples:
         cmssh> find dataset=/ZMM*
         cmssh> find file dataset=/Cosmics/CRUZET3-v1/RAW
+        cmssh> find file dataset=/Cosmics/CRUZET3-v1/RAW run=51045 site=T2_CH_CERN
         csmsh> find site dataset=/Cosmics/CRUZET3-v1/RAW
         cmssh> find config dataset=/SUSY_LM9_sftsht_8TeV-pythia6/Summer12-START50_V13-v1/GEN-SIM
         cmssh> find run=160915
         cmssh> find lumi dataset=/Photon/Run2012A-29Jun2012-v1/AOD
         cmssh> find lumi run=190704
         cmssh> find user=oliver
+        cmssh> find file dataset=/Cosmics/CRUZET3-v1/RAW | grep -v 51045 | count
+        cmssh> find file dataset=/Cosmics/CRUZET3-v1/RAW | sort -r size | head 5
+        cmssh> find file dataset=/Cosmics/CRUZET3-v1/RAW | select logical_file_name,size
+        cmssh> find site dataset=/Cosmics/CRUZET3-v1/RAW | uniq
     List of supported entities:
         dataset, block, file, run, lumi, site, user
+    List of supported filters:
+        grep [-i|-v|-iv|-vi] <pattern>, count, head [N], sort [-r] [field],
+        uniq, select field[,field...]
     """
     lookup(arg)
 
@@ -231,17 +250,15 @@ def lookup(arg):
     """
     Perform lookup of given query in CMS data-services.
     """
-    arg = arg.strip()
     debug = get_ipython().debug
-    args  = arg.split('|')
-    if  len(args) == 1: # no filter
-        res = CMSMGR.lookup(arg)
-    else:
-        gen = CMSMGR.lookup(args[0].strip())
-        for flt in args[1:]:
-            res = apply_filter(flt.strip(), gen)
+    query, filters = split_pipes(arg)
+    try:
+        res = pipeline(CMSMGR.lookup(query), filters)
+    except NotImplementedError as exc:
+        print_error(str(exc))
+        return
     RESMGR.assign(res)
-    list_results(res, debug)
+    list_results(RESMGR, debug)
 
 def verbose(arg):
     """
@@ -590,6 +607,94 @@ def cms_pager(arg=None):
         msg = "cmssh pager is set to: %s" % val
         print msg
 
+def cms_cache(arg=None):
+    """
+    cmssh command to inspect or clear on-disk cache of data-service responses
+    Examples:
+        cmssh> cache # shows cache summary
+        cmssh> cache list # list cached responses
+        cmssh> cache clear # remove all cached responses
+        cmssh> cache clear phedex # remove cached responses of given URLs
+        cmssh> cache functions # show caches of function results
+        cmssh> cache invalidate # drop all cached function results
+        cmssh> cache invalidate tagcollector.releases # drop given cache
+    """
+    arg = arg.strip() if arg else ''
+    if  not arg:
+        print_info("Cache %s" % HTTP_CACHE)
+        if  not HTTP_CACHE.enabled():
+            print_warning('Cache is disabled, see CMSSH_CACHE')
+    elif arg == 'list':
+        now = time.time()
+        for meta in HTTP_CACHE.listing():
+            params = '&'.join('%s=%s' % (k, v) for k, v in \
+                        sorted(meta['params'].items()))
+            expire = meta['expire'] - now
+            status = 'expires in %ds' % expire if expire > 0 else 'expired'
+            print '%s?%s %s, %s' % (meta['url'], params,
+                    size_format(meta.get('size', 0)), status)
+    elif arg.split()[0] == 'clear':
+        pattern = arg.replace('clear', '', 1).strip()
+        HTTP_CACHE.clear(pattern)
+        print_info("Cache %s" % HTTP_CACHE)
+    elif arg == 'functions':
+        cols = '%-24s %6s %8s %8s %8s %9s %8s'
+        print cols % ('cache', 'size', 'maxsize', 'ttl', 'hits', 'misses', 'evicted')
+        for name in sorted(CACHES):
+            stats = CACHES[name].stats()
+            print cols % (name, stats['size'], stats['maxsize'] or '-',
+                    stats['ttl'] or '-', stats['hits'], stats['misses'],
+                    stats['evictions'])
+    elif arg.split()[0] == 'invalidate':
+        names = arg.split()[1:] or CACHES.keys()
+        for name in names:
+            if  name in CACHES:
+                CACHES[name].invalidate()
+            else:
+                print_error('No such cache: %s' % name)
+    else:
+        print_error('Unsupported cache command: %s' % arg)
+
+def cms_stats(arg=None):
+    """
+    cmssh command to show latency statistics of data-service calls, i.e.
+    per-service number of calls, errors, cache hits, received bytes,
+    percentiles of total request time and median of DNS look-up,
+    connect, TLS handshake and time to first byte
+    Examples:
+        cmssh> stats # per-service summary
+        cmssh> stats list # show last 20 requests
+        cmssh> stats list 100 # show last 100 requests
+        cmssh> stats clear # clear collected records
+        cmssh> stats sources # show transfer history of source SEs
+    """
+    arg = arg.strip() if arg else ''
+    if  not arg:
+        print METRICS
+    elif arg.split()[0] == 'list':
+        try:
+            nrec = int(arg.replace('list', '', 1).strip() or 20)
+        except ValueError:
+            print_error('Please provide number of records to list')
+            return
+        for rec in METRICS.last(nrec):
+            tstamp = time.strftime('%H:%M:%S', time.localtime(rec['tstamp']))
+            status = rec['cache'] or rec['status']
+            print '%s %-12s %6dms %5s %9s %s' % (tstamp, rec['service'],
+                    rec['total']*1000, status, size_format(rec['bytes']),
+                    rec['url'])
+    elif arg == 'clear':
+        METRICS.clear()
+    elif arg == 'sources':
+        print '%-36s %6s %6s %11s %s' % ('source', 'ok', 'fail', 'rate', 'status')
+        for source, rec in SOURCES.listing():
+            rate = size_format(rec['rate']) + '/s' if rec['rate'] else 'N/A'
+            status = 'cooldown' if SOURCES.in_cooldown(source) else ''
+            print '%-36s %6s %6s %11s %s' \
+                    % (source, rec['ok'], rec['fail'], rate, status)
+    else:
+        print_error('Unsupported stats command: %s' % arg)
+
 def dbs_instance(arg=None):
     """
     cmssh command to show or set DBS instance
@@ -640,6 +745,10 @@ def cms_help_msg():
     msg += msg_green('root        ') + ' invoke ROOT\n'
     msg += msg_green('du          ') \
         + ' display disk usage for given site, e.g. du T3_US_Cornell\n'
+    msg += msg_green('cache       ') \
+        + ' show or clear cache of data-service responses\n'
+    msg += msg_green('stats       ') \
+        + ' show latency statistics of data-service calls\n'
     msg += '\nAvailable CMSSW commands (once you install any CMSSW release):\n'
     msg += msg_green('releases    ') \
         + ' list available CMSSW releases, accepts <list|all> args\n'
@@ -833,7 +942,7 @@ def cms_ls(arg):
         run(cmd, shell=True)
     if  res:
         RESMGR.assign(res)
-        list_results(res, debug=True, flt=flt)
+        list_results(RESMGR, debug=True, flt=flt)
 
 def cms_jobs(arg=None):
     """
@@ -841,7 +950,11 @@ def cms_jobs(arg=None):
     about jobs at give site or for given user. It accepts the following
     list of options:
 
-    - list, which lists local transfer jobs
+    - list, which lists local transfer jobs, including finished
+      transfers of previous sessions
+    - cancel <ids|all>, which cancels given local transfer jobs
+    - top <ids>, which moves given waiting transfer jobs to the head
+      of the queue
     - site, which lists jobs at given site
     - dashboard, which lists jobs of current user
     - user, which lists jobs of given user
@@ -849,6 +962,8 @@ def cms_jobs(arg=None):
     Examples:
         cmssh> jobs
         cmssh> jobs list
+        cmssh> jobs cancel 12,13
+        cmssh> jobs top 20
         cmssh> jobs site=T2_US_UCSD
         cmssh> jobs dashboard
         cmssh> jobs user=my_cms_user_name
@@ -858,7 +973,7 @@ def cms_jobs(arg=None):
         debug = get_ipython().debug
     except:
         debug = 0
-    orig_arg = arg
+    orig_arg = arg or ''
     if  orig_arg.find('|') != -1:
         arg, flt = orig_arg.split('|', 1)
         arg = arg.strip()
@@ -869,6 +984,10 @@ def cms_jobs(arg=None):
     if  not arg or arg == 'list':
         print_info('Local data transfer')
         dqueue(arg)
+    elif arg.startswith('cancel '):
+        cancel_jobs(arg.replace('cancel ', '', 1))
+    elif arg.startswith('top '):
+        top_jobs(arg.replace('top ', '', 1))
     elif arg == 'dashboard':
         userdn = os.environ.get('USER_DN', None)
         if  userdn:
@@ -885,7 +1004,7 @@ def cms_jobs(arg=None):
         res  = jobsummary({'user': user})
     if  res:
         RESMGR.assign(res)
-        list_results(res, debug=True, flt=flt)
+        list_results(RESMGR, debug=True, flt=flt)
 
 def cms_config(arg):
     """
@@ -1032,8 +1151,13 @@ def cms_cp(arg):
     Examples:
         cmssh> cp file1 file2
         cmssh> cp file.root T3_US_Cornell:/store/user/name
+        cmssh> cp file.root T3_US_Cornell:/store/user/name &
         cmssh> cp /store/mc/file.root T3_US_Cornell:/store/user/name
         cmssh> cp T3_US_Cornell:/store/user/name/file.root T3_US_Omaha
+        cmssh> cp dataset=/a/b/c /data/dir
+        cmssh> cp block=/a/b/c#123 T3_US_Cornell:/store/user/name &
+        cmssh> cp @lfns.txt /data/dir
+        cmssh> cp "/store/user/name/run1/*.root" /data/dir
     """
     check_voms_proxy()
     background = False
@@ -1066,8 +1190,19 @@ def cms_cp(arg):
     if  not arg:
         print_error("Usage: cp <options> source_file target_{file,directory}")
     pat  = pat_se
-    orig = src.split(' ')[-1]
-    if  os.path.exists(orig) and not pat.match(dst):
+    orig = src.split(' ')[-1].strip('"').strip("'")
+    # background upload of local file is queued by transfer engine as well
+    upload = background and os.path.isfile(orig) and pat.match(dst)
+    if  upload:
+        orig = os.path.abspath(orig)
+    if  upload or \
+        ((background or multi_source(orig)) and not os.path.exists(orig)):
+        try:
+            status = copy_files(orig, dst, debug, background, overwrite)
+            print_status(status)
+        except:
+            traceback.print_exc()
+    elif  os.path.exists(orig) and not pat.match(dst):
         if  background:
             cmd = 'cp %s' % orig_arg
             subprocess.call(cmd, shell=True)
@@ -1075,7 +1210,7 @@ def cms_cp(arg):
             run("cp %s %s" % (src, dst))
     else:
         try:
-            status = copy_lfn(orig, dst, debug, background, overwrite)
+            status = copy_lfn(orig, dst, debug, overwrite)
             print_status(status)
         except:
             traceback.print_exc()
@@ -1133,22 +1268,30 @@ def cms_apt(arg=''):
         raise Exception(msg)
     run(cmd)
 
+def das_queries(arg):
+    "Split given argument into list of DAS queries"
+    return [q.strip() for q in arg.split(';') if q.strip()]
+
 def cms_das(query):
     """
     cmssh command which queries DAS data-service with provided query.
+    Several queries separated by semicolon are processed concurrently.
+    Results are shown page by page as they arrive, Ctrl-C cancels the query.
     Examples:
         cmssh> das dataset=/ZMM*
+        cmssh> das dataset=/ZMM*; site dataset=/ZMM/Summer11-DESIGN42_V11_428_SLHC1-v1/GEN-SIM
     """
     host  = 'https://cmsweb.cern.ch'
     idx   = 0
     limit = 0
     debug = 0
-    das_client(host, query, idx, limit, debug, 'plain')
+    das_client(host, das_queries(query), idx, limit, debug, 'plain')
 
 def cms_das_json(query):
     """
     cmssh command which queries DAS data-service with provided query and
-    returns results in JSON data format
+    returns results in JSON data format. Several queries separated by
+    semicolon are processed concurrently.
     Examples:
         cmssh> das_json dataset=/ZMM*
     """
@@ -1156,9 +1299,12 @@ def cms_das_json(query):
     idx   = 0
     limit = 0
     debug = 0
-    res   = das_client(host, query, idx, limit, debug, 'json')
-    RESMGR.assign([res])
-    pprint.pprint(res)
+    queries = das_queries(query)
+    res   = das_client(host, queries, idx, limit, debug, 'json')
+    if  res is None: # query is cancelled
+        return
+    RESMGR.assign(res)
+    pprint.pprint(res[0] if len(res) == 1 else res)
 
 def cms_vomsinit(_arg=None):
     """
@@ -11,6 +11,7 @@ import re
 # cmssh modules
 from cmssh.iprint import format_dict
 from cmssh.utils import size_format
+from cmssh.cache import cached
 
 NUMBER = re.compile('[0-9]')
 
@@ -90,8 +91,13 @@ class Site(CMSObj):
         else:
             return self.data
 
+@cached(maxsize=1024)
 def get_dashboardname(userdn):
-    "Return user name used in Dashboard"
+    "Return user name used in Dashboard, it is derived from DN"
+    return dashboard_name(userdn)
+
+def dashboard_name(userdn):
+    "Build Dashboard user name out of CN of given DN"
     if  userdn and isinstance(userdn, basestring):
         for key in userdn.split('/'):
             if  key.find('CN=') != -1:
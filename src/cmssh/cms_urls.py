@@ -5,6 +5,9 @@
 # system modules
 import os
 
+# cmssh modules
+from cmssh.cache import cached
+
 def tc_url(api=''):
     """Return TagCollector URL for given API name"""
     return 'https://cmssdt.cern.ch/tc/%s' % api
@@ -13,6 +16,7 @@ def phedex_url(api=''):
     """Return Phedex URL for given API name"""
     return 'https://cmsweb.cern.ch/phedex/datasvc/json/prod/%s' % api
 
+@cached(maxsize=4)
 def dbs_instances(dbs='DBS2'):
     "Return list of availabel DBS instances"
     if  dbs == 'DBS2':
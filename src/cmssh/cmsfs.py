@@ -2,27 +2,29 @@
 #-*- coding: ISO-8859-1 -*-
 
 """
-CMSFS is a file-system on top of routefs to access CMS meta-data
+CMSFS is a file-system on top of CMS data-services to access CMS meta-data,
+queries are dispatched to its controllers by cmssh.dispatcher
 """
 
 # system modules
 import os
 import re
 import json
-import routes
 import urllib
 import urllib2
 import pprint
-from   types import GeneratorType
 
 # cmssh modules
 from   cmssh.iprint import format_dict, print_warning, print_error
-from   cmssh.url_utils import get_data
+from   cmssh.url_utils import get_data, get_data_multi
 from   cmssh.cms_objects import Run, File, Block, Dataset, Site, User, Job
 from   cmssh.cms_objects import Release, CMSObj
 from   cmssh.tagcollector import releases
 from   cmssh.filemover import get_pfns, resolve_user_srm_path
-from   cmssh.cms_urls import phedex_url, dbs_url, conddb_url, sitedb_url
+from   cmssh.sitedb import SITEDB
+from   cmssh.dispatcher import Dispatcher, Route
+from   cmssh.pipeline import pipeline
+from   cmssh.cms_urls import phedex_url, dbs_url, conddb_url
 from   cmssh.cms_urls import dashboard_url, dbs_instances
 from   cmssh import dbs2
 from   cmssh.runsum import runsum
@@ -30,34 +32,13 @@ from   cmssh.lumidb import lumidb
 from   cmssh.regex import pat_dataset, pat_block, pat_lfn, pat_run
 from   cmssh.reqmgr import reqmgr
 from   cmssh.prepsrv import prep
-from   cmssh.utils import ranges
-
-def rowdict(columns, row):
-    """Convert given row list into dict with column keys"""
-    robj = {}
-    for key, val in zip(columns, row):
-        robj.setdefault(key, val)
-    return robj
-    
-def sitedb_parser(data):
-    """SiteDB parser"""
-    if  isinstance(data, str) or isinstance(data, unicode):
-        data = json.loads(data)
-    if  not isinstance(data, dict):
-        raise Exception('Wrong data type')
-    if  data.has_key('desc'):
-        columns = data['desc']['columns']
-        for row in data['result']:
-            yield rowdict(columns, row)
-    else:
-        for row in data['result']:
-            yield row
+from   cmssh.utils import ranges, PrintProgress
 
 def find_sites(url, params):
     """Find sites"""
-    data = get_data(url, params)
+    data = get_data(url, params, decoder='jsonstream', jpath='phedex.block')
     sites = {}
-    for files in data['phedex']['block']:
+    for files in data:
         for fdict in files['file']:
             replicas = fdict['replica']
             for replica in replicas:
@@ -71,47 +52,23 @@ def find_sites(url, params):
     for key, val in sites.iteritems():
         yield Site({'node': key, 'se': val})
 
+def site_files(dataset, site):
+    "Return set of LFNs of given dataset which are located at given site"
+    url    = phedex_url('fileReplicas')
+    params = {'dataset': dataset, 'node': site}
+    data   = get_data(url, params, decoder='jsonstream', jpath='phedex.block')
+    return set(fdict['name'] for block in data for fdict in block['file'])
+
+# patterns of condition values
+PAT_DATASET = r'/.*'
+PAT_SITE    = r'T[0-3].*'
+PAT_RUN     = r'[0-9]+'
+PAT_FILE    = r'/.*\.root'
+PAT_BLOCK   = r'/.*#.*'
+
 def apply_filter(flt, gen):
-    """Apply given filter to a given set of results"""
-    arr = flt.split()
-    if  len(arr) == 2:
-        flt_func, flt_name = arr
-        flt_opt = None
-    elif len(arr) == 3:
-        flt_func, flt_opt, flt_name = arr
-    elif len(arr) > 3:
-        raise NotImplementedError
-    else:
-        flt_func = arr[0]
-        flt_name = None
-    if  isinstance(gen, list) or isinstance(gen, GeneratorType):
-        if  flt_func == 'grep' and flt_name:
-            for row in gen:
-                rrr = repr(row)
-                if  flt_opt:
-                    if  flt_opt == '-i':
-                        if  rrr.lower().find(flt_name.lower()) != -1:
-                            yield row
-                    elif flt_opt == '-v':
-                        if  rrr.find(flt_name) == -1:
-                            yield row
-                    elif flt_opt == '-iv' or flt_opt == '-vi':
-                        if  rrr.lower().find(flt_name.lower()) == -1:
-                            yield row
-                    else:
-                        raise NotImplementedError
-                else:
-                    if  rrr.find(flt_name) != -1:
-                        yield row
-        elif flt_func == 'count' or flt_func == 'wc':
-            res = 0
-            for row in gen:
-                res += 1
-            yield res
-        else:
-            raise NotImplementedError
-    else:
-        yield gen
+    """Lazily apply given filter to a given set of results"""
+    return pipeline(gen, [flt])
 
 def validate_dbs_instance(inst):
     "Validate DBS url"
@@ -127,41 +84,36 @@ class CMSFS(object):
         self.map = self.make_map()
 
     def make_map(self):
-        rmp = routes.Mapper()
-        rmp.connect('run={run:\d+}', controller='list_runs')
-        rmp.connect('dataset={dataset:.*?} status={status:.*?}', controller='list_datasets')
-        rmp.connect('dataset={dataset:.*?}', controller='list_datasets')
-        rmp.connect('file run={run:[0-9]+} dataset={dataset:/.*?}', controller='list_files')
-        rmp.connect('file dataset={dataset:/.*?} run={run:[0-9]+}', controller='list_files')
-        rmp.connect('file dataset={dataset:/.*?}', controller='list_files')
-        rmp.connect('site dataset={dataset:/.*?}', \
-               controller='list_sites4dataset')
-        rmp.connect('site file={filename:/.*.root?}', \
-               controller='list_sites4file')
-        rmp.connect('{sitename:T[0-3].*?}', controller='list_du4site')
-        rmp.connect('site={sitename:T[0-3].*?}', controller='list_sites')
-        rmp.connect('block site={sitename:T[0-3].*?}', \
-               controller='list_block4site')
-        rmp.connect('user={username:.*?}', controller='list_user')
-        rmp.connect('job user={user:.*?}', controller='list_jobs')
-        rmp.connect('job site={site:T[0-3].*?}', controller='list_jobs')
-        rmp.connect('job', controller='list_jobs')
-        rmp.connect('release', controller='list_releases')
-        rmp.connect('releases', controller='list_releases')
-        rmp.connect('release={name:CMSSW(_[0-9]){3}}', controller='list_releases')
-        rmp.connect('config dataset={dataset:/.*?}', controller='list_configs')
-        rmp.connect('run_lumi dataset={dataset:/.*?}', controller='run_lumis')
-        rmp.connect('run_lumi block={block:/.*#.*?}', controller='run_lumis')
-        rmp.connect('run_lumi file={file:/.*.root}', controller='run_lumis')
-        rmp.connect('run_lumi run={run:[0-9]+}', controller='run_lumis')
-        rmp.connect('lumi dataset={dataset:/.*?}', controller='list_lumis')
-        rmp.connect('lumi block={block:/.*#.*?}', controller='list_lumis')
-        rmp.connect('lumi file={file:/.*.root}', controller='list_lumis')
-        rmp.connect('lumi run={run:[0-9]+}', controller='list_lumis')
-        rmp.connect('lumi {arg:.*}', controller='list_lumis')
-        rmp.connect('prep dataset={dataset:/.*?}', controller='list_prep')
-        rmp.connect('mcinfo dataset={dataset:/.*?}', controller='list_prep')
-        return rmp
+        "Compile dispatch table of queries to controllers"
+        sitename = {'site': 'sitename'}
+        routes = [
+            Route(None, 'list_runs', {'run': r'\d+'}),
+            Route(None, 'list_datasets', {'dataset': r'.*', 'status?': r'.*'}),
+            Route(None, 'list_du4site', argument=('sitename', PAT_SITE)),
+            Route(None, 'list_sites', {'site': PAT_SITE}, sitename),
+            Route(None, 'list_user', {'user': r'.*'}, {'user': 'username'}),
+            Route(None, 'list_releases', {'release': r'CMSSW(_[0-9]+){3}.*'},
+                    {'release': 'name'}),
+            Route('file', 'list_files', {'dataset': PAT_DATASET,
+                    'run?': PAT_RUN, 'site?': PAT_SITE}),
+            Route('site', 'list_sites4dataset', {'dataset': PAT_DATASET}),
+            Route('site', 'list_sites4file', {'file': PAT_FILE},
+                    {'file': 'filename'}),
+            Route('block', 'list_block4site', {'site': PAT_SITE}, sitename),
+            Route('job', 'list_jobs', {'user?': r'.*', 'site?': PAT_SITE}),
+            Route('release', 'list_releases'),
+            Route('releases', 'list_releases'),
+            Route('config', 'list_configs', {'dataset': PAT_DATASET}),
+            Route('prep', 'list_prep', {'dataset': PAT_DATASET}),
+            Route('mcinfo', 'list_prep', {'dataset': PAT_DATASET}),
+            Route('lumi', 'list_lumis', argument=('arg', r'.*')),
+        ]
+        # run-lumi look-ups accept one of dataset, block, file or run
+        for entity, controller in [('run_lumi', 'run_lumis'), ('lumi', 'list_lumis')]:
+            for key, pat in [('dataset', PAT_DATASET), ('block', PAT_BLOCK),
+                    ('file', PAT_FILE), ('run', PAT_RUN)]:
+                routes.insert(-1, Route(entity, controller, {key: pat}))
+        return Dispatcher(routes)
 
     def lookup(self, obj):
         """
@@ -270,15 +222,21 @@ class CMSFS(object):
         url = dbs_url()
         run = kwargs.get('run', None)
         dataset = kwargs.get('dataset')
+        site = kwargs.get('site')
         if  url.find('cmsdbsprod') != -1: # DBS2
-            return dbs2.list_files(dataset, run)
-        url = dbs_url('files')
-        params = {'dataset': dataset, 'detail': 'True'}
-        if  run:
-            params.update({'run_num': run})
-        data = get_data(url, params)
-        plist = [File(f) for f in data]
-        return plist
+            files = dbs2.list_files(dataset, run)
+        else:
+            url = dbs_url('files')
+            params = {'dataset': dataset, 'detail': 'True'}
+            if  run:
+                params.update({'run_num': run})
+            data = get_data(url, params, decoder='jsonstream')
+            files = (File(f) for f in data)
+        if  site:
+            lfns = site_files(dataset, site)
+            files = (f for f in files \
+                    if f.data.get('logical_file_name') in lfns)
+        return files
 
     def list_sites4dataset(self, **kwargs):
         """
@@ -323,11 +281,11 @@ class CMSFS(object):
         url     = phedex_url('blockReplicas')
         site    = kwargs['sitename']
         params  = {'node': site}
-        data    = get_data(url, params)
+        data    = get_data(url, params, decoder='jsonstream', jpath='phedex.block')
         nfiles  = 0
         nblocks = 0
         size    = 0
-        for row in data['phedex']['block']:
+        for row in data:
             nblocks += 1
             nfiles += int(row['files'])
             for rep in row['replica']:
@@ -337,26 +295,10 @@ class CMSFS(object):
 
     def list_user(self, **kwargs):
         """
-        Controller to get site info
+        Controller to find users
         """
-        url = sitedb_url('people')
-        params = {}
-        cert = os.path.join(os.environ['HOME'], '.globus/usercert.pem')
-        ckey = os.path.join(os.environ['HOME'], '.globus/userkey.pem')
-        data = get_data(url, params)
-        qname = kwargs['username'].lower()
-        users = []
-        for row in sitedb_parser(data):
-            username = row.get('username', '').lower()
-            forename = row.get('forename', '').lower()
-            surname  = row.get('surname', '').lower()
-            email    = row.get('email', '').lower()
-            if  username and qname.find(username) != -1 or \
-                forename and qname.find(forename) != -1 or \
-                surname and qname.find(surname) != -1 or \
-                email and qname.find(email) != -1:
-                users.append(row)
-        return [User(u) for u in users]
+        users = SITEDB.find_users(kwargs['username'])
+        return [User(dict(u)) for u in users]
 
     def list_jobs(self, **kwargs):
         "Controller for jobs info"
@@ -491,13 +433,48 @@ def run_lumi_golden_json():
         print_warning(msg)
         return None, {}
 
-def parse_runlumis(filelumis):
-    "Parse DBS3 output of filelumis API and return run-lumi dict"
-    run_lumi = {}
+def parse_runlumis(filelumis, run_lumi=None):
+    """
+    Parse DBS3 output of filelumis API and merge it into given
+    run-lumi dict of sets, return run-lumi dict
+    """
+    if  run_lumi is None:
+        run_lumi = {}
     for row in filelumis:
-        run  = row['run_num']
-        lumi = row['lumi_section_num']
-        run_lumi.setdefault(run, []).append(lumi)
+        run   = row['run_num']
+        lumi  = row['lumi_section_num']
+        lumis = run_lumi.setdefault(run, set())
+        if  isinstance(lumi, list):
+            lumis.update(lumi)
+        else:
+            lumis.add(lumi)
+    return run_lumi
+
+def sorted_runlumis(run_lumi):
+    "Convert run-lumi dict of sets into run-lumi dict of sorted lists"
+    return dict([(run, sorted(lumis)) for run, lumis in run_lumi.iteritems()])
+
+def dataset_runlumis(dataset, verbose=None):
+    """
+    Return run-lumi dict of sets for given dataset. The DBS filelumis API
+    is called once per dataset block, block requests are executed
+    concurrently (no more than CMSSH_DBS_CONCURRENCY, default 10, at a
+    time) and their results are merged as they arrive.
+    """
+    blocks   = get_data(dbs_url('blocks'), {'dataset': dataset}, verbose=verbose)
+    url      = dbs_url('filelumis')
+    requests = [(url, {'block_name': row['block_name']}) for row in blocks]
+    limit    = int(os.environ.get('CMSSH_DBS_CONCURRENCY', 10))
+    run_lumi = {}
+    if  not requests:
+        return run_lumi
+    bar = PrintProgress('Dataset %s has %s blocks' % (dataset, len(requests)))
+    bar.init('Run-lumi look-up:')
+    for idx, (_url, _params, data) in \
+            enumerate(get_data_multi(requests, verbose=verbose, limit=limit)):
+        parse_runlumis(data, run_lumi)
+        bar.refresh(100*(idx+1)/len(requests))
+    bar.clear()
     return run_lumi
 
 def run_lumi_dict(arg, verbose=None):
@@ -518,21 +495,19 @@ def run_lumi_dict(arg, verbose=None):
         if  url.find('cmsdbsprod') != -1: # DBS2
             run_lumi = dbs2.run_lumi(str(data), verbose)
         else:
-            if  pat_dataset.match(data):
-                params = {'dataset': data}
-                result = get_data(dbs_url('files'), params, verbose)
-                for row in result:
-                    params = {'logical_file_name': row['logical_file_name']}
-                    run_lumi = parse_runlumis(get_data(dbs_url('filelumis'), params, verbose))
-            elif pat_block.match(data):
+            url = dbs_url('filelumis')
+            if  pat_block.match(data):
                 params = {'block_name': data}
-                run_lumi = parse_runlumis(get_data(dbs_url('filelumis'), params, verbose))
+                run_lumi = parse_runlumis(get_data(url, params, verbose=verbose))
+            elif pat_dataset.match(data):
+                run_lumi = dataset_runlumis(data, verbose)
             elif pat_lfn.match(data):
                 params = {'logical_file_name': data}
-                run_lumi = parse_runlumis(get_data(dbs_url('filelumis'), params, verbose))
+                run_lumi = parse_runlumis(get_data(url, params, verbose=verbose))
             elif pat_run.match(data):
                 params = {'run_num': data}
-                run_lumi = parse_runlumis(get_data(dbs_url('filelumis'), params, verbose))
+                run_lumi = parse_runlumis(get_data(url, params, verbose=verbose))
+            run_lumi = sorted_runlumis(run_lumi)
     return run_lumi
 
 def run_lumi_info(arg, verbose=None):
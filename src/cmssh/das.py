@@ -12,16 +12,24 @@ import re
 import sys
 import time
 import json
+import random
 import urllib
 import urllib2
 import httplib
+import threading
 from   optparse import OptionParser
 
 # cmssh modules
-from cmssh.auth_utils import HTTPSClientAuthHandler, get_key_cert
+from cmssh.auth_utils import get_opener, get_key_cert, HTTPCompressionProcessor
 from cmssh.auth_utils import PEMMGR, working_pem
+from cmssh.iprint import print_warning
+from cmssh.metrics import METRICS
+try:
+    from cmssh.pycurl_manager import RequestHandler
+except:
+    RequestHandler = None
 
-def convet_time(val):
+def convert_time(val):
     "Convert given timestamp into human readable format"
     if  isinstance(val, int) or isinstance(val, float):
         return time.strftime('%d/%b/%Y_%H:%M:%S_GMT', time.gmtime(val))
@@ -69,7 +77,8 @@ def unique_filter(rows):
         if  old_row:
             yield old_row
         old_row = row
-    yield row
+    if  row is not None:
+        yield row
 
 def get_value(data, filters):
     """Filter data from a row for given list of filters"""
@@ -109,10 +118,44 @@ def fullpath(path):
         path = os.path.join(os.environ['HOME'], path)
     return path
 
-def get_data(host, query, idx, limit, debug, threshold=300, ckey=None, cert=None):
-    """Contact DAS server and retrieve data for given DAS query"""
+def das_opener(ckey=None, cert=None, debug=0):
+    "Create urllib2 opener for DAS requests"
+    if  ckey and cert:
+        ckey = fullpath(ckey)
+        cert = fullpath(cert)
+        return get_opener(ckey, cert)
+    hdlr = urllib2.HTTPHandler(debuglevel=debug)
+    if  int(os.environ.get('CMSSH_HTTP_COMPRESSION', 1)):
+        return urllib2.build_opener(hdlr, HTTPCompressionProcessor())
+    return urllib2.build_opener(hdlr)
+
+def das_fetch(url, params, headers, ckey=None, cert=None, debug=0, opener=None):
+    """
+    Fetch DAS data for given set of parameters. The pycurl RequestHandler
+    is used when available, so all DAS calls share pooled connection to
+    DAS server, otherwise we use provided urllib2 opener.
+    """
+    if  RequestHandler:
+        mgr = RequestHandler()
+        return mgr.get_data(url, params, headers, ckey=ckey, cert=cert,
+                verbose=debug).read()
+    encoded_data = urllib.urlencode(params, doseq=True)
+    req   = urllib2.Request(url=url + '?%s' % encoded_data, headers=headers)
+    fdesc = opener.open(req)
+    data  = fdesc.read()
+    fdesc.close()
+    return data
+
+def get_data(host, query, idx, limit, debug, threshold=300, ckey=None, cert=None,
+        cancel=None):
+    """
+    Contact DAS server and retrieve data for given DAS query. While DAS
+    process the query we poll it with jittered exponential backoff,
+    polling stops if optional cancel event is set.
+    """
     if  not ckey and not cert:
         ckey, cert = get_key_cert()
+    time0   = time.time()
     params  = {'input':query, 'idx':idx, 'limit':limit}
     path    = '/das/cache'
     pat     = re.compile('http[s]{0,1}://')
@@ -121,53 +164,150 @@ def get_data(host, query, idx, limit, debug, threshold=300, ckey=None, cert=None
         raise Exception(msg)
     url = host + path
     headers = {"Accept": "application/json"}
-    encoded_data = urllib.urlencode(params, doseq=True)
-    url += '?%s' % encoded_data
-    req  = urllib2.Request(url=url, headers=headers)
-    if  ckey and cert:
-        ckey = fullpath(ckey)
-        cert = fullpath(cert)
-        hdlr = HTTPSClientAuthHandler(ckey, cert)
-    else:
-        hdlr = urllib2.HTTPHandler(debuglevel=debug)
-    opener = urllib2.build_opener(hdlr)
-    fdesc = opener.open(req)
-    data = fdesc.read()
-    fdesc.close()
+    opener = None
+    if  not RequestHandler:
+        opener = das_opener(ckey, cert, debug)
+    if  not cancel:
+        cancel = threading.Event()
+    status  = 200
+    try:
+        data = das_fetch(url, params, headers, ckey, cert, debug, opener)
+        data = poll(url, params, headers, ckey, cert, debug, opener,
+                    data, threshold, cancel)
+    except DASError as err:
+        status = None
+        data = json.dumps({"status":"fail", "reason":str(err)})
+    METRICS.record(url, time.time() - time0, status, len(data),
+            label='DAS query')
+    return data
 
-    pat = re.compile(r'^[a-z0-9]{32}')
+class DASError(Exception):
+    "DAS query failure"
+    pass
+
+def poll(url, params, headers, ckey, cert, debug, opener, data,
+        threshold, cancel):
+    """
+    Poll DAS server until it returns data for given query, raise
+    DASError if query is cancelled, timed out or failed
+    """
+    pat     = re.compile(r'^[a-z0-9]{32}')
     if  data and isinstance(data, str) and pat.match(data) and len(data) == 32:
         pid = data
     else:
         pid = None
-    sleep   = 1  # initial waiting time in seconds
-    wtime   = 30 # final waiting time in seconds
+    sleep   = 0.5 # initial waiting time in seconds
+    wtime   = 30  # final waiting time in seconds
     time0   = time.time()
     while pid:
+        # decorrelated jitter, such that concurrent queries do not poll
+        # DAS server in lock-step
+        sleep = min(wtime, random.uniform(0.5, sleep*3))
+        if  cancel.wait(sleep):
+            raise DASError("query is cancelled")
+        if  (time.time()-time0) > threshold:
+            reason = "client timeout after %s sec" % int(time.time()-time0)
+            raise DASError(reason)
         params.update({'pid':data})
-        encoded_data = urllib.urlencode(params, doseq=True)
-        url  = host + path + '?%s' % encoded_data
-        req  = urllib2.Request(url=url, headers=headers)
         try:
-            fdesc = opener.open(req)
-            data = fdesc.read()
-            fdesc.close()
-        except urllib2.HTTPError as err:
-            return json.dumps({"status":"fail", "reason":str(err)})
+            data = das_fetch(url, params, headers, ckey, cert, debug, opener)
+        except Exception as err:
+            raise DASError(str(err))
         if  data and isinstance(data, str) and pat.match(data) and len(data) == 32:
             pid = data
         else:
             pid = None
-        time.sleep(sleep)
-        if  sleep < wtime:
-            sleep *= 2
-        else:
-            sleep = wtime
-        if  (time.time()-time0) > threshold:
-            reason = "client timeout after %s sec" % int(time.time()-time0)
-            return json.dumps({"status":"fail", "reason":reason})
     return data
 
+class DASQuery(object):
+    """
+    Asynchronous DAS query. The query is submitted and polled in
+    background thread, such that several queries can run concurrently.
+    The result method waits for query completion, Ctrl-C cancels it.
+    """
+    def __init__(self, host, query, idx=0, limit=0, debug=0,
+            ckey=None, cert=None):
+        self.query  = query
+        self.data   = None
+        self.cancel = threading.Event()
+        self.done   = threading.Event()
+        args = (host, query, idx, limit, debug)
+        kwds = {'ckey': ckey, 'cert': cert, 'cancel': self.cancel}
+        self.thread = threading.Thread(target=self.run, args=args, kwargs=kwds)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, *args, **kwds):
+        "Thread target, fetch DAS data"
+        try:
+            self.data = get_data(*args, **kwds)
+        except Exception as err:
+            self.data = json.dumps({"status":"fail", "reason":str(err)})
+        self.done.set()
+
+    def result(self):
+        "Wait for and return query result (JSON dict)"
+        try:
+            while not self.done.wait(0.1):
+                pass
+        except KeyboardInterrupt:
+            self.cancel.set()
+            raise
+        return json.loads(self.data)
+
+# aggregated results are not paginated
+PAT_AGGREGATOR = re.compile(r'\|.*\b(sum|count|min|max|avg|median)\(')
+
+def page_size(query, limit, page=None):
+    """
+    Return number of records to request per DAS call for given query,
+    aggregated results are requested at once
+    """
+    if  PAT_AGGREGATOR.search(query):
+        return limit
+    if  not page:
+        page = int(os.environ.get('CMSSH_DAS_PAGE', 100))
+    return min(page, limit) if limit else page
+
+def das_records(host, query, idx=0, limit=0, debug=0, ckey=None, cert=None,
+        page=None, head=None):
+    """
+    Generator of DAS records for given query. Records are requested in
+    pages of given size (default CMSSH_DAS_PAGE or 100), the next page
+    is fetched in background while current one is consumed. Optional
+    head is the already fetched result of the first page.
+    """
+    paged = not PAT_AGGREGATOR.search(query)
+    size = page_size(query, limit, page)
+    if  head is None:
+        head = DASQuery(host, query, idx, size, debug, ckey, cert).result()
+    jsondict = head
+    start = idx
+    while True:
+        if  jsondict.get('status') != 'ok':
+            raise Exception('DAS query failed: %s' \
+                    % jsondict.get('reason', 'N/A'))
+        nres = jsondict.get('nresults', 0)
+        stop = min(nres, idx + limit) if limit else nres
+        start += size
+        prefetch = None
+        if  paged and start < stop and isinstance(jsondict['data'], list):
+            prefetch = DASQuery(host, query, start, min(size, stop - start),
+                            debug, ckey, cert)
+        try:
+            data = jsondict['data']
+            if  isinstance(data, list):
+                for row in data:
+                    yield row
+            else:
+                yield data
+            if  not prefetch:
+                break
+            jsondict = prefetch.result()
+        finally:
+            if  prefetch:
+                prefetch.cancel.set()
+
 def prim_value(row):
     """Extract primary key value from DAS record"""
     prim_key = row['das']['primary_key']
@@ -179,82 +319,110 @@ def prim_value(row):
     else:
         return row[key][att]
 
+def print_records(jsondict, rows, idx, limit):
+    """
+    Print DAS records in plain format, jsondict is DAS result of the
+    first page and rows is generator over records of all pages
+    """
+    if  not jsondict.has_key('status'):
+        print 'DAS record without status field:\n%s' % jsondict
+        return
+    if  jsondict['status'] != 'ok':
+        print "status: %s reason: %s" \
+            % (jsondict.get('status'), jsondict.get('reason', 'N/A'))
+        return
+    nres = jsondict['nresults']
+    if  not limit:
+        drange = '%s' % nres
+    else:
+        drange = '%s-%s out of %s' % (idx+1, idx+limit, nres)
+    if  limit:
+        msg  = "\nShowing %s results" % drange
+        msg += ", for more results use --idx/--limit options\n"
+        print msg
+    mongo_query = jsondict['mongo_query']
+    unique  = False
+    fdict   = mongo_query.get('filters', {})
+    filters = fdict.get('filters', [])
+    aggregators = mongo_query.get('aggregators', [])
+    if  'unique' in fdict.keys():
+        unique = True
+    if  filters and not aggregators:
+        data = jsondict['data']
+        if  isinstance(data, dict):
+            rows = [r for r in get_value(data, filters)]
+            print ' '.join(rows)
+        elif isinstance(data, list):
+            if  unique:
+                rows = unique_filter(rows)
+            for row in rows:
+                print ' '.join(get_value(row, filters))
+        else:
+            print jsondict
+    elif aggregators:
+        if  unique:
+            rows = unique_filter(rows)
+        for row in rows:
+            if  row['key'].find('size') != -1 and \
+                row['function'] == 'sum':
+                val = size_format(row['result']['value'])
+            else:
+                val = row['result']['value']
+            print '%s(%s)=%s' \
+            % (row['function'], row['key'], val)
+    else:
+        data = jsondict['data']
+        if  isinstance(data, list):
+            old = None
+            val = None
+            for row in rows:
+                val = prim_value(row)
+                if  not limit:
+                    if  val != old:
+                        print val
+                        old = val
+                else:
+                    print val
+            if  val != old and not limit:
+                print val
+        elif isinstance(data, dict):
+            print prim_value(data)
+        else:
+            print data
+
 def das_client(host, query, idx, limit, debug, dformat):
-    "DAS client"
+    """
+    DAS client. Query can be either single DAS query or list of them,
+    in latter case queries are processed concurrently. In plain format
+    results are printed as they arrive page by page, otherwise JSON
+    dict (or list of dicts for list of queries) is returned. Ctrl-C
+    cancels outstanding queries.
+    """
     if  not query:
         raise Exception('You must provide input query')
+    queries = query if isinstance(query, list) else [query]
     ckey = None
     cert = os.path.join(os.environ['HOME'], '.globus/usercert.pem')
     with working_pem(PEMMGR.pem) as ckey:
-        data = get_data(host, query, idx, limit, debug, ckey, cert)
-    if  dformat == 'plain':
-        jsondict = json.loads(data)
-        if  not jsondict.has_key('status'):
-            print 'DAS record without status field:\n%s' % jsondict
-            return
-        if  jsondict['status'] != 'ok':
-            print "status: %s reason: %s" \
-                % (jsondict.get('status'), jsondict.get('reason', 'N/A'))
-            return
-        nres = jsondict['nresults']
-        if  not limit:
-            drange = '%s' % nres
+        if  dformat == 'plain':
+            jobs = [DASQuery(host, q, idx, page_size(q, limit), debug,
+                        ckey, cert) for q in queries]
         else:
-            drange = '%s-%s out of %s' % (idx+1, idx+limit, nres)
-        if  limit:
-            msg  = "\nShowing %s results" % drange
-            msg += ", for more results use --idx/--limit options\n"
-            print msg
-        mongo_query = jsondict['mongo_query']
-        unique  = False
-        fdict   = mongo_query.get('filters', {})
-        filters = fdict.get('filters', [])
-        aggregators = mongo_query.get('aggregators', [])
-        if  'unique' in fdict.keys():
-            unique = True
-        if  filters and not aggregators:
-            data = jsondict['data']
-            if  isinstance(data, dict):
-                rows = [r for r in get_value(data, filters)]
-                print ' '.join(rows)
-            elif isinstance(data, list):
-                if  unique:
-                    data = unique_filter(data)
-                for row in data:
-                    rows = [r for r in get_value(row, filters)]
-                    print ' '.join(rows)
-            else:
-                print jsondict
-        elif aggregators:
-            data = jsondict['data']
-            if  unique:
-                data = unique_filter(data)
-            for row in data:
-                if  row['key'].find('size') != -1 and \
-                    row['function'] == 'sum':
-                    val = size_format(row['result']['value'])
-                else:
-                    val = row['result']['value']
-                print '%s(%s)=%s' \
-                % (row['function'], row['key'], val)
-        else:
-            data = jsondict['data']
-            if  isinstance(data, list):
-                old = None
-                val = None
-                for row in data:
-                    val = prim_value(row)
-                    if  not limit:
-                        if  val != old:
-                            print val
-                            old = val
-                    else:
-                        print val
-                if  val != old and not limit:
-                    print val
-            elif isinstance(data, dict):
-                print prim_value(data)
-            else:
-                print data
-    else:
-        return json.loads(data)
+            jobs = [DASQuery(host, q, idx, limit, debug, ckey, cert) \
+                        for q in queries]
+        try:
+            if  dformat != 'plain':
+                res = [job.result() for job in jobs]
+                return res if isinstance(query, list) else res[0]
+            for job in jobs:
+                if  len(jobs) > 1:
+                    print "\nDAS query: %s" % job.query
+                head = job.result()
+                rows = das_records(host, job.query, idx, limit, debug,
+                            ckey, cert, head=head)
+                print_records(head, rows, idx, limit)
+        except KeyboardInterrupt:
+            print_warning('DAS query is cancelled')
+        finally:
+            for job in jobs:
+                job.cancel.set()
@@ -60,6 +60,18 @@ def list_files(dataset, run=None):
     plist  = [File(f) for f in files]
     return plist
 
+def file_names(key, value):
+    """
+    Return list of LFNs for given key (dataset, block or file) value,
+    file value is LFN pattern
+    """
+    oper   = 'like' if key == 'file' else '='
+    query  = 'find file where %s %s %s' % (key, oper, value)
+    params = {"api":"executeQuery", "apiversion": "DBS_2_0_9", "query":query}
+    data   = urllib2.urlopen(dbs_url(), urllib.urlencode(params))
+    gen    = qlxml_parser(data, 'file')
+    return [rec['file']['file'] for rec in gen]
+
 def dataset_info(dataset, verbose=None):
     query  = 'find dataset.name, datatype, dataset.status, dataset.createdate, dataset.createby, dataset.moddate, dataset.modby, sum(block.size), count(block), sum(block.numfiles), sum(block.numevents) where dataset=%s' % dataset
     params = {"api":"executeQuery", "apiversion": "DBS_2_0_9", "query":query}
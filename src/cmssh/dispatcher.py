@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+
+"""
+Query parser and dispatcher of find command. The grammar is
+
+    query     := head ('|' filter)*
+    head      := [entity] condition* | [entity] argument
+    condition := key=value
+
+Values can be quoted, bare words which follow a condition are part of
+its value (e.g. user=John Doe). Every route maps an entity (or no
+entity) and a set of conditions to a controller. Conditions can be
+given in any order, optional ones are marked by trailing '?' and every
+value is validated by its pattern. A route can also take free-form
+argument instead of conditions. Routes are compiled into dispatch
+table keyed by entity, such that query is tokenized once and only
+routes of its entity are tried.
+"""
+
+# system modules
+import re
+
+# key=value condition (value can be quoted) or bare word
+PAT_TOKEN = re.compile(r'\s*(?:(\w+)=("[^"]*"|\'[^\']*\'|[^\s"\']*)|(\S+))')
+
+def unquote(value):
+    "Strip quotes around given value"
+    if  len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+def split_pipes(query):
+    "Split query into its head and list of filters, quoted pipes are kept"
+    parts = ['']
+    quote = None
+    for char in query:
+        if  quote:
+            if  char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '|':
+            parts.append('')
+            continue
+        parts[-1] += char
+    return parts[0].strip(), [p.strip() for p in parts[1:]]
+
+class Route(object):
+    """
+    Route of a query to a controller. Conditions is a dict of condition
+    keys (optional ones end with '?') and value patterns, names maps
+    condition keys to controller arguments. Route with argument, i.e.
+    (name, pattern) pair, matches free-form remainder of the query.
+    """
+    def __init__(self, entity, controller, conditions=None, names=None,
+            argument=None):
+        self.entity     = entity
+        self.controller = controller
+        self.names      = names or {}
+        self.required   = {}
+        self.optional   = {}
+        for key, pat in (conditions or {}).items():
+            pat = re.compile('(?:%s)$' % pat)
+            if  key.endswith('?'):
+                self.optional[key[:-1]] = pat
+            else:
+                self.required[key] = pat
+        self.argument = None
+        if  argument:
+            self.argument = (argument[0], re.compile('(?:%s)$' % argument[1]))
+
+    def match(self, conditions):
+        "Return controller arguments for given conditions or None"
+        if  self.argument or not set(self.required) <= set(conditions):
+            return None
+        kwargs = {}
+        for key, value in conditions.items():
+            pat = self.required.get(key) or self.optional.get(key)
+            if  not pat or not pat.match(value):
+                return None
+            kwargs[self.names.get(key, key)] = value
+        return kwargs
+
+    def match_argument(self, arg):
+        "Return controller arguments for given free-form argument or None"
+        if  not self.argument or not self.argument[1].match(arg):
+            return None
+        return {self.argument[0]: arg}
+
+class Dispatcher(object):
+    "Compiled dispatch table of queries"
+    def __init__(self, routes):
+        self.table = {} # entity => list of routes
+        for route in routes:
+            self.table.setdefault(route.entity, []).append(route)
+
+    def tokenize(self, query):
+        """
+        Split query into (entity, conditions, remainder), conditions is
+        None if remainder is not a list of conditions
+        """
+        tokens = []
+        pos = 0
+        while pos < len(query):
+            match = PAT_TOKEN.match(query, pos)
+            if  not match or match.end() == pos:
+                break
+            tokens.append((match.start(), match.groups()))
+            pos = match.end()
+        entity = None
+        if  tokens and tokens[0][1][2] and tokens[0][1][2] in self.table:
+            entity = tokens[0][1][2]
+            tokens = tokens[1:]
+        rest = query[tokens[0][0]:].strip() if tokens else ''
+        conditions = {}
+        last = None
+        for _pos, (key, value, word) in tokens:
+            if  key:
+                if  key in conditions:
+                    return entity, None, rest
+                conditions[key] = unquote(value)
+                last = key
+            elif last:
+                conditions[last] += ' ' + word
+            else:
+                return entity, None, rest
+        return entity, conditions, rest
+
+    def match(self, query):
+        """
+        Match given query (without filters), return dict of controller
+        arguments along with controller name or None
+        """
+        entity, conditions, rest = self.tokenize(query.strip())
+        routes = self.table.get(entity, [])
+        if  conditions is not None:
+            for route in routes:
+                kwargs = route.match(conditions)
+                if  kwargs is not None:
+                    kwargs['controller'] = route.controller
+                    return kwargs
+        for route in routes:
+            kwargs = route.match_argument(rest)
+            if  kwargs is not None:
+                kwargs['controller'] = route.controller
+                return kwargs
+        return None
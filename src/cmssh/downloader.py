@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+
+"""
+Multi-stream downloader. A file is split into chunks which are read by
+several parallel byte-range streams, spread over all given replicas, and
+written with positional writes into a file preallocated to its full size
+(<file>.part). Completed chunks are journaled into <file>.part.chunks,
+such that interrupted download is resumed. Once all chunks are in place
+adler32 checksum of the whole file is verified and the file is renamed
+to its final name.
+
+Readers are chosen by URL scheme: root:// URLs are read by XRootD python
+bindings (if available), file:// URLs and plain paths are read locally,
+the latter is also a stand-in for xrootd servers in tests. It is used by
+cmssh for large files and can be run standalone:
+
+    python -m cmssh.downloader [options] <dst> <url> [<url> ...]
+"""
+
+# system modules
+import os
+import sys
+import zlib
+import time
+import Queue
+import urlparse
+import threading
+from   optparse import OptionParser
+
+# optional XRootD python bindings
+try:
+    from XRootD import client as xrd_client
+except:
+    xrd_client = None
+
+class FileReader(object):
+    "Byte-range reader of local file"
+    def __init__(self, url, timeout=None):
+        self.fdesc = open(urlparse.urlparse(url).path, 'rb')
+
+    def size(self):
+        "Return file size"
+        return os.fstat(self.fdesc.fileno()).st_size
+
+    def read(self, offset, size):
+        "Read size bytes at given offset"
+        self.fdesc.seek(offset)
+        return self.fdesc.read(size)
+
+    def close(self):
+        "Close the file"
+        self.fdesc.close()
+
+class XRootDReader(object):
+    "Byte-range reader of remote file via XRootD python bindings"
+    def __init__(self, url, timeout=60):
+        self.timeout = timeout
+        self.fobj = xrd_client.File()
+        status, _ = self.fobj.open(url, timeout=timeout)
+        if  not status.ok:
+            raise IOError('Unable to open %s, %s' % (url, status.message))
+
+    def size(self):
+        "Return file size"
+        status, info = self.fobj.stat(timeout=self.timeout)
+        if  not status.ok:
+            raise IOError(status.message)
+        return info.size
+
+    def read(self, offset, size):
+        "Read size bytes at given offset"
+        status, data = self.fobj.read(offset, size, timeout=self.timeout)
+        if  not status.ok:
+            raise IOError(status.message)
+        return data
+
+    def close(self):
+        "Close the file"
+        self.fobj.close()
+
+# URL scheme => reader class, None if reader is not available
+READERS = {
+    'root': XRootDReader if xrd_client else None,
+    'file': FileReader,
+    '': FileReader,
+}
+
+def reader_class(url):
+    "Return reader class of given URL or None if URL can't be read"
+    return READERS.get(urlparse.urlparse(url).scheme)
+
+def write_all(fdes, offset, data):
+    "Positional write of given data"
+    os.lseek(fdes, offset, os.SEEK_SET)
+    while data:
+        nbytes = os.write(fdes, data)
+        data = data[nbytes:]
+
+class Download(object):
+    """
+    Download of single file from given replica URLs into given path
+    with given number of streams and chunk size
+    """
+    def __init__(self, urls, path, streams=4, chunk=32*1024*1024,
+            adler32=None, retries=3, timeout=60):
+        self.urls    = [u for u in urls if reader_class(u)]
+        if  not self.urls:
+            raise ValueError('No readable URLs among %s' % ', '.join(urls))
+        self.path    = path
+        self.part    = path + '.part'
+        self.journal = self.part + '.chunks'
+        self.streams = max(1, streams)
+        self.chunk   = max(1, chunk)
+        self.adler32 = adler32.lower().zfill(8) if adler32 else None
+        self.retries = retries
+        self.timeout = timeout
+        self.size    = None
+        self.done    = 0
+        self.error   = None
+        self.queue   = Queue.Queue()
+        self.tries   = {} # chunk offset => number of failures
+        self.bad     = {} # URL => error of replicas which can't be opened
+        self.lock    = threading.Lock()
+
+    def open(self, idx):
+        """
+        Open reader of the first replica starting with idx-th URL,
+        replicas which can't be opened are not tried again
+        """
+        idx %= len(self.urls)
+        for url in self.urls[idx:] + self.urls[:idx]:
+            if  url in self.bad:
+                continue
+            try:
+                return reader_class(url)(url, self.timeout)
+            except Exception as exc:
+                with self.lock:
+                    self.bad[url] = str(exc)
+        raise IOError('Unable to open any replica, %s' \
+                % '; '.join(self.bad.values()))
+
+    def file_size(self):
+        "Return size of the file from the first replica which answers"
+        reader = self.open(0)
+        try:
+            return reader.size()
+        finally:
+            reader.close()
+
+    def prepare(self):
+        "Preallocate part file or resume it, return offsets of chunks to read"
+        done = set()
+        if  os.path.isfile(self.part) and os.path.isfile(self.journal) and \
+            os.path.getsize(self.part) == self.size:
+            with open(self.journal) as stream:
+                for line in stream:
+                    if  line.strip().isdigit():
+                        done.add(int(line))
+        else:
+            if  os.path.isfile(self.journal):
+                os.remove(self.journal)
+            fdes = os.open(self.part, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0644)
+            try:
+                os.ftruncate(fdes, self.size)
+            finally:
+                os.close(fdes)
+        offsets = []
+        for offset in xrange(0, self.size, self.chunk):
+            if  offset in done:
+                self.done += min(self.chunk, self.size - offset)
+            else:
+                offsets.append(offset)
+        return offsets
+
+    def stream(self, idx):
+        "Read chunks from the queue, idx defines the replica to start with"
+        fdes   = os.open(self.part, os.O_WRONLY)
+        reader = None
+        try:
+            while not self.error:
+                try:
+                    offset = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    if  not reader:
+                        reader = self.open(idx)
+                    length = min(self.chunk, self.size - offset)
+                    data = reader.read(offset, length)
+                    if  len(data) != length:
+                        raise IOError('short read at %s, %s out of %s bytes' \
+                                % (offset, len(data), length))
+                    write_all(fdes, offset, data)
+                    with self.lock:
+                        with open(self.journal, 'a') as stream:
+                            stream.write('%d\n' % offset)
+                        self.done += length
+                except Exception as exc:
+                    # retry the chunk, this stream moves to the next replica
+                    if  reader:
+                        try:
+                            reader.close()
+                        except Exception:
+                            pass
+                    reader = None
+                    idx += 1
+                    with self.lock:
+                        self.tries[offset] = self.tries.get(offset, 0) + 1
+                        if  self.tries[offset] > self.retries:
+                            self.error = 'chunk at %s, %s' % (offset, exc)
+                            break
+                    self.queue.put(offset)
+        finally:
+            os.close(fdes)
+            if  reader:
+                reader.close()
+
+    def checksum(self):
+        "Return adler32 checksum of part file"
+        value = 1
+        with open(self.part, 'rb') as stream:
+            while True:
+                data = stream.read(self.chunk)
+                if  not data:
+                    break
+                value = zlib.adler32(data, value)
+        return '%08x' % (value & 0xffffffff)
+
+    def progress(self):
+        "Return download progress in percents"
+        if  not self.size:
+            return 100. if self.size == 0 else 0.
+        return self.done*100./self.size
+
+    def run(self, callback=None, interval=0.5):
+        "Download the file, report progress via callback"
+        self.size = self.file_size()
+        for offset in self.prepare():
+            self.queue.put(offset)
+        threads = []
+        for idx in range(min(self.streams, self.queue.qsize())):
+            thr = threading.Thread(target=self.stream, args=(idx,))
+            thr.daemon = True
+            thr.start()
+            threads.append(thr)
+        while [t for t in threads if t.is_alive()]:
+            if  callback:
+                callback(self.progress())
+            time.sleep(interval)
+        if  self.error or self.done != self.size:
+            # part file is kept and resumed by the next attempt
+            raise IOError('Download of %s failed, %s' \
+                    % (self.path, self.error or 'incomplete file'))
+        if  self.adler32:
+            value = self.checksum()
+            if  value != self.adler32:
+                os.remove(self.part)
+                os.remove(self.journal)
+                raise IOError('Checksum mismatch of %s, %s != %s' \
+                        % (self.path, value, self.adler32))
+        os.rename(self.part, self.path)
+        if  os.path.isfile(self.journal):
+            os.remove(self.journal)
+        if  callback:
+            callback(self.progress())
+        return self.path
+
+def main():
+    "Main function"
+    usage  = 'usage: %prog [options] <dst> <url> [<url> ...]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-s', '--streams', action='store', type='int',
+        default=4, dest='streams', help='number of parallel streams')
+    parser.add_option('-c', '--chunk', action='store', type='int',
+        default=32*1024*1024, dest='chunk', help='chunk size in bytes')
+    parser.add_option('-a', '--adler32', action='store', type='string',
+        default=None, dest='adler32', help='expected adler32 checksum')
+    parser.add_option('-r', '--retries', action='store', type='int',
+        default=3, dest='retries', help='number of retries of every chunk')
+    opts, args = parser.parse_args()
+    if  len(args) < 2:
+        parser.error('destination and at least one URL are required')
+    dst, urls = args[0], args[1:]
+    if  os.path.isdir(dst):
+        dst = os.path.join(dst, urlparse.urlparse(urls[0]).path.split('/')[-1])
+    def progress(value):
+        "Print progress in xrdcp format"
+        sys.stdout.write('[%3d%%]\r' % value)
+        sys.stdout.flush()
+    try:
+        download = Download(urls, dst, opts.streams, opts.chunk,
+                opts.adler32, opts.retries)
+        download.run(progress)
+    except (IOError, OSError, ValueError) as exc:
+        print >> sys.stderr, '\n%s' % exc
+        sys.exit(1)
+    print '\n%s' % dst
+
+if __name__ == '__main__':
+    main()
@@ -8,12 +8,13 @@ import re
 import sys
 import json
 import stat
+import zlib
 import time
-import thread
 import urllib
+import subprocess
+import threading
 import urllib2
 import datetime
-from multiprocessing import Process
 
 # for DBS2 XML parsing
 import xml.etree.ElementTree as ET
@@ -26,8 +27,12 @@ from cmssh.cms_urls import phedex_url, dbs_url, dbs_instances
 from cmssh.cms_objects import CMSObj
 from cmssh.utils import execmd
 from cmssh.utils import PrintProgress, qlxml_parser
-from cmssh.url_utils import get_data
-from cmssh.sitedb import SiteDBManager
+from cmssh.url_utils import get_data, get_data_multi
+from cmssh.sitedb import SITEDB
+from cmssh.tfc import TFCMGR, TFC_TTL
+from cmssh.cache import cached
+from cmssh.sources import SOURCES, XRD_REDIRECTOR, source_key
+from cmssh.downloader import reader_class
 from cmssh.srmls import srmls_printer, srm_ls_printer
 
 def get_dbs_se(lfn):
@@ -145,9 +150,7 @@ def get_username(verbose=None):
     if  not userdn:
         msg = 'Unable to determine your DN, please run grid-proxy-init'
         raise Exception(msg)
-    mgr  = SiteDBManager()
-    user = mgr.get_user(userdn)
-    return user
+    return SITEDB.get_user(userdn)
 
 def nodes(select=True):
     """
@@ -166,13 +169,13 @@ def nodes(select=True):
     for row in lnodes:
         print row
 
+@cached(ttl=TFC_TTL, maxsize=256, key=lambda node, verbose=None: node)
 def resolve_srm_path(node, verbose=None):
     """
     Use TFC phedex API to resolve srm path for given node
     """
-    params = {'node':node}
-    result = get_data(phedex_url('tfc'), params)
-    for row in result['phedex']['storage-mapping']['array']:
+    rules = TFCMGR.rules(node, verbose)
+    for row in rules.rows:
         if  row['protocol'] == 'srmv2' and row['element_name'] == 'lfn-to-pfn':
             yield (row['result'], row['path-match'])
 
@@ -182,28 +185,149 @@ def resolve_user_srm_path(node, ldir='/store/user', verbose=None):
     """
     # change ldir if user supplied full path, e.g. /xrootdfs/cms/store/...
     ldir   = '/store/' + ldir.split('/store/')[-1]
+    pfn    = TFCMGR.lfn2pfn(node, ldir, verbose=verbose)
+    if  pfn:
+        yield pfn
+        return
     params = {'node':node, 'lfn':ldir, 'protocol': 'srmv2'}
     result = get_data(phedex_url('lfn2pfn'), params)
     for row in result['phedex']['mapping']:
         yield row['pfn']
 
+class PFNResolver(object):
+    """
+    Batched LFN to PFN resolver. Replicas (PhEDEx fileReplicas) and PFNs
+    are looked-up for many LFNs at once. PFNs are resolved locally by
+    TFC rules of the node (see cmssh.tfc), LFNs which TFC can't resolve
+    are grouped by node and resolved with one PhEDEx lfn2pfn request per
+    node which carries multiple lfn parameters. Requests are split into
+    chunks to fit URL length limit (CMSSH_URL_MAXLEN) and executed
+    concurrently. Results are kept in memory, replicas for 10 minutes
+    and PFNs for a day.
+    """
+    def __init__(self, protocol='srmv2', maxlen=None):
+        self.protocol = protocol
+        self.maxlen   = int(maxlen or os.environ.get('CMSSH_URL_MAXLEN', 4000))
+        self.replicas = {} # lfn => (tstamp, [(node, se), ...])
+        self.pfns     = {} # (node, lfn) => (tstamp, [pfn, ...])
+        self.ttl      = {'replicas': 10*60, 'pfns': 24*60*60}
+        self.lock     = threading.Lock()
+
+    def lookup(self, name, key):
+        "Look-up given key in given store, return None if it is expired"
+        store = getattr(self, name)
+        with self.lock:
+            tstamp, val = store.get(key, (0, None))
+        if  time.time() - tstamp > self.ttl[name]:
+            return None
+        return val
+
+    def update(self, name, records):
+        "Update given store with dict of records"
+        now = time.time()
+        store = getattr(self, name)
+        with self.lock:
+            for key, val in records.iteritems():
+                store[key] = (now, val)
+
+    def chunks(self, url, params, lfns):
+        "Split list of LFNs into chunks which fit into URL length limit"
+        base  = len(url) + len(urllib.urlencode(params)) + 1
+        chunk = []
+        size  = base
+        for lfn in lfns:
+            length = len(urllib.urlencode({'lfn': lfn})) + 1
+            if  chunk and size + length > self.maxlen:
+                yield chunk
+                chunk = []
+                size  = base
+            chunk.append(lfn)
+            size += length
+        if  chunk:
+            yield chunk
+
+    def requests(self, url, params, lfns):
+        "Return list of (url, params) requests for given LFNs"
+        reqs = []
+        for chunk in self.chunks(url, params, lfns):
+            args = dict(params)
+            args['lfn'] = chunk
+            reqs.append((url, args))
+        return reqs
+
+    def file_replicas(self, lfns, verbose=None):
+        "Return dict of LFN => list of (node, se) replicas for given LFNs"
+        missing = set(l for l in lfns if self.lookup('replicas', l) is None)
+        reqs = self.requests(phedex_url('fileReplicas'), {'se':'*'}, missing)
+        for _url, params, result in get_data_multi(reqs, verbose=verbose):
+            found = dict((l, []) for l in params['lfn'])
+            for block in result['phedex']['block']:
+                for fdict in block['file']:
+                    found[fdict['name']] = \
+                        [(r['node'], r['se']) for r in fdict['replica']]
+            self.update('replicas', found)
+        return dict((l, self.lookup('replicas', l) or []) for l in lfns)
+
+    def resolve(self, pairs, verbose=None):
+        """
+        Resolve given list of (node, lfn) pairs, return dict of
+        (node, lfn) => list of PFNs
+        """
+        local  = TFCMGR.resolve(pairs, self.protocol, verbose)
+        bynode = {}
+        for node, lfn in pairs:
+            if  (node, lfn) in local:
+                continue
+            if  self.lookup('pfns', (node, lfn)) is None:
+                bynode.setdefault(node, set()).add(lfn)
+        reqs = []
+        for node, lfns in bynode.iteritems():
+            params = {'node':node, 'protocol':self.protocol}
+            reqs  += self.requests(phedex_url('lfn2pfn'), params, lfns)
+        for _url, params, result in get_data_multi(reqs, verbose=verbose):
+            found = dict(((params['node'], l), []) for l in params['lfn'])
+            try:
+                for item in result['phedex']['mapping']:
+                    key = (item.get('node', params['node']), item['lfn'])
+                    pfnlist = found.setdefault(key, [])
+                    if  item['pfn'] and item['pfn'] not in pfnlist:
+                        pfnlist.append(item['pfn'])
+            except:
+                msg = "Fail to look-up PFNs in Phedex\n" + str(result)
+                print msg
+                continue
+            self.update('pfns', found)
+        res = {}
+        for pair in pairs:
+            if  pair in local:
+                res[pair] = [local[pair]]
+            else:
+                res[pair] = list(self.lookup('pfns', pair) or [])
+        return res
+
+    def prefetch(self, lfns, verbose=None):
+        """
+        Look-up replicas and PFNs for given list of LFNs, such that
+        subsequent get_pfns/pfn_dst calls are served from memory
+        """
+        pairs = []
+        for lfn, replicas in self.file_replicas(lfns, verbose).iteritems():
+            for node, _se in replicas:
+                if  node.count('T0', 0, 2) != 1: # skip T0's
+                    pairs.append((node, lfn))
+        return self.resolve(pairs, verbose)
+
+# Singleton
+PFNMGR = PFNResolver()
+
 def lfn2pfn(lfn, sename, mgr=None):
     "Find PFN for given LFN and SE"
     pfnlist = []
     if  not mgr:
-        mgr = SiteDBManager()
+        mgr = SITEDB
     cmsname = mgr.get_name(sename)
     if  cmsname:
-        params = {'protocol':'srmv2', 'lfn':lfn, 'node':cmsname}
-        result = get_data(phedex_url('lfn2pfn'), params)
-        try:
-            for item in result['phedex']['mapping']:
-                pfn = item['pfn']
-                if  pfn not in pfnlist:
-                    pfnlist.append(pfn)
-        except:
-            msg = "Fail to look-up PFNs in Phedex\n" + str(result)
-            print msg
+        pfnlist = PFNMGR.resolve([(cmsname, lfn)])[(cmsname, lfn)]
     return pfnlist
 
 def get_pfns(lfn, verbose=None):
@@ -212,29 +336,18 @@ def get_pfns(lfn, verbose=None):
     """
     pfnlist   = []
     selist    = []
-    params    = {'se':'*', 'lfn':lfn}
-    json_dict = get_data(phedex_url('fileReplicas'), params)
-    ddict     = DotDict(json_dict)
-    if  not json_dict['phedex']['block']:
+    replicas  = PFNMGR.file_replicas([lfn], verbose)[lfn]
+    if  not replicas:
         return pfnlist, selist
-    for fname in ddict.get('phedex.block.file'):
-        for replica in fname['replica']:
-            cmsname = replica['node']
-            se      = replica['se']
-            if  se not in selist:
-                selist.append(se)
-            # query Phedex for PFN
-            params = {'protocol':'srmv2', 'lfn':lfn, 'node':cmsname}
-            result = get_data(phedex_url('lfn2pfn'), params)
-            try:
-                for item in result['phedex']['mapping']:
-                    pfn = item['pfn']
-                    if  pfn not in pfnlist:
-                        pfnlist.append(pfn)
-            except:
-                msg = "Fail to look-up PFNs in Phedex\n" + str(result)
-                print msg
-                continue
+    for _node, se in replicas:
+        if  se not in selist:
+            selist.append(se)
+    # PFN look-ups for all replicas are done in one go
+    pfns = PFNMGR.resolve([(node, lfn) for node, _se in replicas], verbose)
+    for node, _se in replicas:
+        for pfn in pfns[(node, lfn)]:
+            if  pfn not in pfnlist:
+                pfnlist.append(pfn)
     return pfnlist, selist
 
 def pfn_dst(lfn, dst, verbose=None):
@@ -289,73 +402,69 @@ def pfn_dst(lfn, dst, verbose=None):
             pfn = 'file:///%s' % pfn
         pfnlist   = [pfn]
     else:
-        if  lfn.find(':') != -1:
-            node, lfn = lfn.split(':')
-            params    = {'node':node, 'lfn':lfn, 'protocol':'srmv2'}
-            method    = 'lfn2pfn'
-        else:
-            params    = {'se':'*', 'lfn':lfn}
-            method    = 'fileReplicas'
-        json_dict = get_data(phedex_url(method), params)
-        ddict     = DotDict(json_dict)
         if  verbose:
             print "Look-up LFN:"
             print lfn
-        phedex = json_dict['phedex']
-        if  phedex.has_key('mapping'):
-            if  not phedex['mapping']:
+        if  lfn.find(':') != -1:
+            node, lfn = lfn.split(':')
+            pfnlist = PFNMGR.resolve([(node, lfn)], verbose)[(node, lfn)]
+            if  not pfnlist:
                 msg  = "LFN: %s\n" % lfn
-                msg += 'No replicas found\n'
-                msg += str(json_dict)
+                msg += 'No replicas found on %s\n' % node
                 raise Exception(msg)
-            filelist = ddict.get('phedex.mapping.pfn')
-            if  not filelist:
-                filelist = []
-            if  isinstance(filelist, basestring):
-                filelist = [filelist]
-            for fname in filelist:
-                pfnlist.append(fname)
-        elif  phedex.has_key('block') and not phedex['block']:
-            msg = 'No replicas found in PhEDEx, will try to get original SE from DBS'
-            print_warning(msg)
-            sename = get_dbs_se(lfn)
-            msg = 'Orignal LFN site %s' % sename
-            print_info(msg)
-            mgr = SiteDBManager()
-            pfnlist = lfn2pfn(lfn, sename, mgr)
-        filelist = ddict.get('phedex.block.file')
-        if  not filelist:
-            filelist = []
-        for fname in filelist:
-            for replica in fname['replica']:
-                cmsname = replica['node']
-                se      = replica['se']
+        else:
+            replicas = PFNMGR.file_replicas([lfn], verbose)[lfn]
+            if  not replicas:
+                msg = 'No replicas found in PhEDEx, will try to get original SE from DBS'
+                print_warning(msg)
+                sename = get_dbs_se(lfn)
+                msg = 'Orignal LFN site %s' % sename
+                print_info(msg)
+                pfnlist = lfn2pfn(lfn, sename)
+            pairs = []
+            for cmsname, se in replicas:
                 if  verbose:
                     print "found LFN on node=%s, se=%s" % (cmsname, se)
                 if  cmsname.count('T0', 0, 2) == 1:
                     continue # skip T0's
-                # query Phedex for PFN
-                params = {'protocol':'srmv2', 'lfn':lfn, 'node':cmsname}
-                result = get_data(phedex_url('lfn2pfn'), params)
-                try:
-                    for item in result['phedex']['mapping']:
-                        pfn = item['pfn']
-                        if  pfn not in pfnlist:
-                            pfnlist.append(pfn)
-                except:
-                    msg = "Fail to look-up PFNs in Phedex\n" + str(result)
-                    print msg
-                    continue
+                pairs.append((cmsname, lfn))
+            # PFN look-ups for all replicas are done in one go
+            pfns = PFNMGR.resolve(pairs, verbose)
+            for pair in pairs:
+                for pfn in pfns[pair]:
+                    if  pfn not in pfnlist:
+                        pfnlist.append(pfn)
     if  verbose > 1:
         print "PFN list:"
         for pfn in pfnlist:
             print pfn
 
+    # order replicas by measured throughput of their sources
+    pfnlist = rank_sources(pfnlist, verbose)
+
     # finally return pfn and dst paths w/ file for further processing
     for item in pfnlist:
         ifile = item.split("/")[-1] if not dstfname else dstfname
         yield item, '%s/%s' % (dst, ifile)
 
+def rank_sources(pfnlist, verbose=None):
+    """
+    Order given PFNs by measured throughput and reliability of their
+    sources. If CMSSH_SOURCE_PROBE is set, sources without history are
+    probed by size request first.
+    """
+    if  len(pfnlist) < 2:
+        return pfnlist
+    if  int(os.environ.get('CMSSH_SOURCE_PROBE', 0)):
+        for pfn in pfnlist:
+            if  not SOURCES.stats(source_key(pfn)):
+                if  not SOURCES.probe(pfn, SRM_SIZES.get) and verbose:
+                    print "Probe of %s failed" % source_key(pfn)
+    pfnlist = SOURCES.rank(pfnlist)
+    if  verbose:
+        print "Ranked sources:", ', '.join(source_key(p) for p in pfnlist)
+    return pfnlist
+
 def get_size(surl, verbose=None):
     """
     Execute srm-ls <surl> command and retrieve file size information
@@ -397,12 +506,345 @@ def get_size(surl, verbose=None):
                 return 0
     return orig_size
 
+class SizeCache(object):
+    """
+    Cache of sizes of transfer sources, i.e. files which do not change,
+    such that srm ls tool is called once per SURL
+    """
+    def __init__(self):
+        self.sizes = {}
+        self.lock  = threading.Lock()
+
+    def get(self, surl, verbose=None):
+        "Return size of given SURL"
+        with self.lock:
+            if  surl in self.sizes:
+                return self.sizes[surl]
+        size = get_size(surl, verbose)
+        if  size and size != 'null':
+            with self.lock:
+                self.sizes[surl] = size
+        return size
+
+# Singleton
+SRM_SIZES = SizeCache()
+
+def local_path(url):
+    "Return local path of given file:/// URL or path, None for remote URLs"
+    if  url.find('file:///') != -1:
+        return url.split('file:///')[-1]
+    if  url.find('://') == -1 and url.find(':') == -1:
+        return url
+    return None
+
+def in_place(src, dst, verbose=None):
+    """
+    Check if destination file is already in place before the transfer.
+    Only local destinations are checked (by stat), remote destinations
+    are verified once after the transfer.
+    """
+    path = local_path(dst)
+    if  path and os.path.isfile(path):
+        return check_file(src, dst, verbose)
+    return False
+
+class Adler32Reader(object):
+    """
+    Streaming adler32 checksum of a file which is written sequentially,
+    e.g. by transfer tool. Every update reads data appended since the
+    previous one, the computation starts over if file was truncated or
+    replaced.
+    """
+    def __init__(self, path, chunk=1024*1024):
+        self.path   = path
+        self.chunk  = chunk
+        self.value  = 1
+        self.offset = 0
+        self.fdesc  = None
+
+    def reset(self):
+        "Start checksum computation over"
+        if  self.fdesc:
+            self.fdesc.close()
+        self.fdesc  = None
+        self.value  = 1
+        self.offset = 0
+
+    def update(self, final=False):
+        "Read data written so far, or the whole file if final"
+        if  not os.path.isfile(self.path):
+            return
+        fstat = os.stat(self.path)
+        size  = fstat.st_size
+        if  size < self.offset or \
+            (self.fdesc and os.fstat(self.fdesc.fileno()).st_ino != fstat.st_ino):
+            self.reset()
+        if  not self.fdesc:
+            self.fdesc = open(self.path, 'rb')
+        while final or self.offset < size:
+            data = self.fdesc.read(self.chunk)
+            if  not data:
+                break
+            self.value   = zlib.adler32(data, self.value)
+            self.offset += len(data)
+        if  final:
+            self.fdesc.close()
+            self.fdesc = None
+
+    def hexdigest(self):
+        "Return checksum in DBS format"
+        return '%08x' % (self.value & 0xffffffff)
+
+class KnownChecksum(object):
+    "Checksum of a file which is verified by the transfer tool itself"
+    def __init__(self, value):
+        self.value = value.lower().zfill(8)
+
+    def update(self, final=False):
+        "Nothing to read, the checksum is known"
+        pass
+
+    def hexdigest(self):
+        "Return checksum in DBS format"
+        return self.value
+
+class ChecksumCache(object):
+    "Cache of DBS checksums (adler32 and cksum) and sizes of LFNs"
+    def __init__(self):
+        self.sums = {}
+        self.lock = threading.Lock()
+
+    def update(self, rows):
+        "Update cache from DBS files records"
+        with self.lock:
+            for row in rows:
+                adler = row.get('adler32')
+                if  not adler or adler == 'NOTSET':
+                    adler = None
+                else:
+                    adler = adler.lower().zfill(8)
+                cksum = row.get('check_sum')
+                if  cksum == 'NOTSET':
+                    cksum = None
+                self.sums[row['logical_file_name']] = \
+                        {'adler32': adler, 'cksum': cksum,
+                         'size': row.get('file_size')}
+
+    def get(self, lfn, verbose=None):
+        "Return dict of checksums of given LFN"
+        with self.lock:
+            if  lfn in self.sums:
+                return self.sums[lfn]
+        if  dbs_url().find('cmsdbsprod') != -1: # DBS2
+            return {}
+        params = {'logical_file_name': lfn, 'detail': 'True'}
+        try:
+            self.update(get_data(dbs_url('files'), params, verbose=verbose))
+        except Exception as exc:
+            print_warning('Unable to get checksum of %s from DBS, %s' % (lfn, exc))
+            return {}
+        with self.lock:
+            return self.sums.get(lfn, {})
+
+# Singleton
+CHECKSUMS = ChecksumCache()
+
+def partial_file(lfn, path, verbose=None):
+    """
+    Check if given local file is partially downloaded LFN, i.e. it is
+    smaller than the LFN size known to DBS
+    """
+    if  not int(os.environ.get('CMSSH_RESUME', 1)) or not os.path.isfile(path):
+        return False
+    size = CHECKSUMS.get(lfn, verbose).get('size')
+    return bool(size) and file_size(path) < int(size)
+
+def verify_checksum(lfn, dst, reader=None, verbose=None):
+    """
+    Verify checksum of local destination file against DBS, adler32 is
+    preferred over cksum. Corrupted file is removed. Return True if file
+    is fine or can't be verified, e.g. it is remote, DBS does not know
+    its checksum or verification is disabled by CMSSH_CHECKSUM=0.
+    """
+    path = local_path(dst)
+    if  not path or not int(os.environ.get('CMSSH_CHECKSUM', 1)):
+        return True
+    sums = CHECKSUMS.get(lfn, verbose)
+    if  sums.get('adler32'):
+        expect, value = sums['adler32'], None
+        if  reader:
+            reader.update(final=True)
+            value = reader.hexdigest()
+        if  value != expect:
+            # checksum computed while the file was written is not trusted
+            # for a mismatch, it is recomputed from the finished file
+            reader = Adler32Reader(path)
+            reader.update(final=True)
+            value = reader.hexdigest()
+    elif sums.get('cksum'):
+        stdout, _ = execmd('cksum "%s"' % path)
+        expect, value = str(sums['cksum']), (stdout.split() or [''])[0]
+    else:
+        return True
+    if  verbose:
+        print "%s, checksum %s, DBS checksum %s" % (path, value, expect)
+    if  value != expect:
+        print_warning('Checksum mismatch of %s, %s != %s, file is removed' \
+                % (path, value, expect))
+        if  os.path.isfile(path):
+            os.remove(path)
+        return False
+    return True
+
+def resume_cmd(cmd, dst):
+    """
+    Return xrdcp command which resumes partially downloaded local file,
+    or None if there is nothing to resume or resume is disabled via
+    CMSSH_RESUME=0
+    """
+    path = local_path(dst)
+    if  not cmd.startswith('xrdcp ') or cmd.find('--continue') != -1 or \
+        not int(os.environ.get('CMSSH_RESUME', 1)):
+        return None
+    if  path and os.path.isdir(path):
+        path = os.path.join(path, cmd.split()[-2].split('/')[-1])
+    if  not path or not file_size(path):
+        return None
+    return cmd.replace('xrdcp ', 'xrdcp --continue ', 1)
+
+def stream_urls(lfn, verbose=None):
+    """
+    Return URLs of replicas of given LFN which can be read by multi-stream
+    downloader, i.e. xrootd PFNs of replica nodes resolved by their TFC
+    followed by XRootD redirector, ordered by source ranking
+    """
+    replicas = PFNMGR.file_replicas([lfn], verbose)[lfn] or []
+    pairs = [(node, lfn) for node, _se in replicas]
+    pfns  = TFCMGR.resolve(pairs, 'xrootd', verbose)
+    urls  = []
+    for pair in pairs:
+        if  pair in pfns and pfns[pair] not in urls:
+            urls.append(pfns[pair])
+    urls = SOURCES.rank([u for u in urls if reader_class(u)])
+    redirector = 'root://%s/%s' % (XRD_REDIRECTOR, lfn)
+    if  reader_class(redirector):
+        urls.append(redirector)
+    return urls
+
+def stream_cmd(lfn, dst, verbose=None):
+    """
+    Return multi-stream download command of given LFN into local directory
+    or None if it does not apply, i.e. the file is smaller than
+    CMSSH_STREAMS_SIZE (default 1GB), CMSSH_STREAMS (number of streams,
+    default 4) is less than 2 or there is no readable replica
+    """
+    streams = int(os.environ.get('CMSSH_STREAMS', 4))
+    if  streams < 2 or not os.path.isdir(dst):
+        return None
+    sums = CHECKSUMS.get(lfn, verbose)
+    if  int(sums.get('size') or 0) < \
+        int(os.environ.get('CMSSH_STREAMS_SIZE', 1024*1024*1024)):
+        return None
+    urls = stream_urls(lfn, verbose)
+    if  not urls:
+        return None
+    opts = '-s %s -c %s' % (streams, \
+            int(os.environ.get('CMSSH_CHUNK_SIZE', 32*1024*1024)))
+    if  sums.get('adler32'):
+        opts += ' -a %s' % sums['adler32']
+    return '%s -m cmssh.downloader %s %s %s' \
+            % (sys.executable, opts, dst, ' '.join('"%s"' % u for u in urls))
+
+# transfer tools which may write chunks of the file in parallel
+PARALLEL_WRITERS = ['xrdcp']
+
+# multi-stream downloader command and its checksum option
+PAT_DOWNLOADER = re.compile(r' -m cmssh\.downloader ')
+PAT_DOWNLOADER_ADLER = re.compile(r' -m cmssh\.downloader .*-a ([0-9a-fA-F]+) ')
+
+# xrdcp progress bar, e.g. [1.2GB/2.4GB][ 50%][=====>    ][10MB/s]
+PAT_XRD_PROGRESS = re.compile(r'\[\s*(\d+)%\]')
+
+class TransferCmd(object):
+    """
+    Transfer command whose progress is taken from the tool output (xrdcp
+    progress bar) or from size of local destination file
+    """
+    def __init__(self, cmd, dst, total=0):
+        self.cmd    = cmd
+        self.path   = local_path(dst)
+        self.total  = float(total or 0)
+        # checksum of local destination is computed while it is written,
+        # unless the tool may write chunks out of order (xrdcp)
+        # multi-stream downloader verifies adler32 on its own
+        self.reader = None
+        verified = PAT_DOWNLOADER_ADLER.search(cmd)
+        if  self.path and verified:
+            self.reader = KnownChecksum(verified.group(1))
+        elif self.path and cmd.split()[0] not in PARALLEL_WRITERS and \
+            not PAT_DOWNLOADER.search(cmd):
+            self.reader = Adler32Reader(self.path)
+        self.proc   = None
+        self.output = []
+        self.tool_progress = None
+        self.thread = None
+
+    def start(self, **kwargs):
+        "Start transfer command"
+        self.proc = subprocess.Popen(self.cmd, shell=True,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                close_fds=True, **kwargs)
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.proc
+
+    def read(self):
+        "Read tool output, progress bar is re-drawn using carriage returns"
+        while True:
+            data = os.read(self.proc.stdout.fileno(), 4096)
+            if  not data:
+                break
+            self.output.append(data)
+            found = PAT_XRD_PROGRESS.findall(data)
+            if  found:
+                self.tool_progress = float(found[-1])
+
+    def progress(self):
+        "Return transfer progress in percents or None if it is unknown"
+        if  self.tool_progress is not None:
+            return self.tool_progress
+        if  self.path and self.total:
+            return min(100., file_size(self.path)*100/self.total)
+        return None
+
+    def wait(self, callback=None, interval=0.5):
+        "Wait for the command and report its progress, return exit code"
+        while self.proc.poll() is None:
+            if  callback:
+                callback(self.progress())
+            if  self.reader:
+                self.reader.update()
+            time.sleep(interval)
+        self.thread.join()
+        self.proc.stdout.close()
+        if  self.proc.returncode and isinstance(self.reader, KnownChecksum):
+            self.reader = None # checksum was not verified
+        if  callback:
+            callback(self.progress())
+        return self.proc.returncode
+
+    def stdout(self):
+        "Return tool output with progress bar updates stripped"
+        lines = ''.join(self.output).replace('\r', '\n').split('\n')
+        return '\n'.join(l for l in lines if l and not PAT_XRD_PROGRESS.search(l))
+
 def check_file(src, dst, verbose):
     """
     Check if file is transfered and return dst, dst_size upon success.
     """
     # find file size from replica
-    orig_size = get_size(src, verbose)
+    orig_size = SRM_SIZES.get(src, verbose)
     if  verbose:
         print "%s, size %s" % (src, orig_size)
 
@@ -425,14 +867,14 @@ def execute(cmds, src, dst, verbose):
     """
     Execute given command, but also check if file is in place at dst
     """
-    status = check_file(src, dst, verbose)
+    status = in_place(src, dst, verbose)
     if  status:
         return status
     else:
         if  isinstance(cmds, basestring):
             stdout, stderr = execmd(cmds)
             if  verbose:
-                print_info('Output of %s' % cmd)
+                print_info('Output of %s' % cmds)
                 print stdout + stderr
             status = check_file(src, dst, verbose)
         elif isinstance(cmds, list):
@@ -448,44 +890,21 @@ def execute(cmds, src, dst, verbose):
                     return status
     return status
 
-def active_jobs(queue):
-    "Return number of active jobs in a queue"
-    njobs = 0
-    for _, (proc, _status) in queue.items():
-        if  proc.is_alive():
-            njobs += 1
-    return njobs
-
-def worker(queue, threshold):
-    """
-    Worker which start processes in a queue and monitor that number of
-    jobs does not exceed a given threshold
-    """
-    while True:
-        njobs = active_jobs(queue)
-        if  njobs < threshold:
-            # start process
-            for lfn, (proc, status) in queue.items():
-                if  active_jobs(queue) >= threshold:
-                    break
-                if  not status and not proc.is_alive():
-                    proc.start()
-                    queue[lfn] = (proc, 'started')
-        time.sleep(5)
-
 class FileMover(object):
     def __init__(self):
         self.instance = "Instance at %d" % self.__hash__()
-        self.queue = {} # download queue
-        threshold = os.environ.get('CMSSH_TRANSFER_LIMIT', 3)
-        thread.start_new_thread(worker, (self.queue, threshold))
         self.methods = ['xrdcp', 'lcgcp', 'srmcp']
 
     def transfer_cmds(self, lfn, dst, verbose=0):
         "Generate transfer commands"
-        xrdcmd = 'xrdcp root://cms-xrd-global.cern.ch/%s %s' % (lfn, dst)
+        xrdcmd = 'xrdcp root://%s/%s %s' % (XRD_REDIRECTOR, lfn, dst)
         if  not os.path.isdir(dst):
             xrdcmd = ''
+        else:
+            # large files are read by parallel streams, otherwise
+            # partially downloaded file (if any) is resumed
+            xrdcmd = stream_cmd(lfn, dst, verbose) or \
+                    resume_cmd(xrdcmd, dst) or xrdcmd
         srmcp  = os.environ.get('SRM_CP', '')
         if  srmcp.find('srm-copy') != -1:
             srmargs = '-pushmode -statuswaittime 30 -3partycopy -delegation false -dcau false'
@@ -507,7 +926,7 @@ class FileMover(object):
                 srmcmd = '%s %s %s %s' % (srmcp, srmargs, pfn, pdst)
             yield xrdcmd, lcgcmd, srmcmd, pfn, pdst
 
-    def copy(self, lfn, dst, method='xrdcp', verbose=0, background=False):
+    def copy(self, lfn, dst, method='xrdcp', verbose=0):
         """Copy LFN to given destination"""
         if  method not in self.methods:
             print_error('Unknown transfer method "%s"' % method)
@@ -521,32 +940,31 @@ class FileMover(object):
                 cmd = srmcmd
             if  not cmd:
                 return 'fail'
-            if  background:
-                # I need to pass list of commands for transfer method
-                # for that I'll use background variable
-                background = [xrdcmd, lcgcmd, srmcmd]
-            status = self.transfer(cmd, lfn, pfn, pdst, verbose, background)
-            if  status == 'success' or status == 'accepted':
+            source = XRD_REDIRECTOR if method == 'xrdcp' else source_key(pfn)
+            tstart = time.time()
+            status = self.transfer(cmd, lfn, pfn, pdst, verbose)
+            rcmd = resume_cmd(cmd, pdst)
+            if  status != 'success' and method == 'xrdcp' and rcmd:
+                print_info('Resume partially downloaded file')
+                status = self.transfer(rcmd, lfn, pfn, pdst, verbose)
+            nbytes = SRM_SIZES.get(pfn) if status == 'success' else 0
+            SOURCES.record(source, status == 'success', \
+                    int(nbytes or 0), time.time() - tstart)
+            if  status == 'success':
                 return status
         return 'fail'
 
-    def transfer(self, cmd, lfn, pfn, pdst, verbose=0, background=False):
+    def transfer(self, cmd, lfn, pfn, pdst, verbose=0):
         """Copy LFN to given destination"""
         err  = 'Unable to identify total size of the file,'
         err += ' GRID middleware fails.'
-        if  not background:
-            bar  = PrintProgress('Fetching LFN info')
+        bar  = PrintProgress('Fetching LFN info')
         if  verbose:
             print_info(cmd)
-        if  background:
-            # here background is a list of commands
-            if  not isinstance(background, list):
-                return 'fail'
-            proc = Process(target=execute, args=(background, pfn, pdst, 0))
-            self.queue[lfn] = (proc, None)
-            return 'accepted'
-        elif verbose:
+        if  verbose:
             status = execute(cmd, pfn, pdst, verbose)
+            if  status and not verify_checksum(lfn, pdst, verbose=verbose):
+                status = False
             if  not status:
                 return 'fail'
             else:
@@ -561,31 +979,26 @@ class FileMover(object):
                         % (dst, size_format(dst_size))
                 return 'success'
         else:
-            ifile = pdst
-            pfn_size = get_size(pfn)
+            pfn_size = SRM_SIZES.get(pfn)
             if  pfn_size and pfn_size != 'null':
                 tot_size = float(pfn_size)
                 bar.print_msg('LFN size=%s' % size_format(tot_size))
                 bar.init('Download in progress:')
-                proc = Process(target=execute, args=(cmd, pfn, pdst, verbose))
-                proc.start()
-                while True:
-                    if  proc.is_alive():
-                        size = get_size(ifile)
-                        if  not size or size == 'null':
-                            bar.refresh('')
-                            pass
-                        else:
-                            progress = float(size)*100/tot_size
-                            bar.refresh(progress)
-                            if  progress == 100:
-                                break
-                    else:
-                        break
-                    time.sleep(0.5)
-                bar.clear()
-                status = check_file(pfn, pdst, verbose)
+                status = in_place(pfn, pdst, verbose)
+                tcmd = None
+                if  not status:
+                    tcmd = TransferCmd(cmd, pdst, tot_size)
+                    tcmd.start()
+                    def refresh(progress):
+                        "Refresh progress bar"
+                        bar.refresh(progress if progress is not None else '')
+                    tcmd.wait(refresh)
+                    bar.clear()
+                    status = check_file(pfn, pdst, verbose)
                 if  status:
+                    reader = tcmd.reader if tcmd else None
+                    if  not verify_checksum(lfn, pdst, reader, verbose):
+                        return 'fail'
                     return 'success'
             else:
                 print_error(err)
@@ -722,8 +1135,11 @@ def lfn_exists(lfn, dst):
     return False
 
 FM_SINGLETON = FileMover()
-def copy_lfn(lfn, dst, verbose=0, background=False, overwrite=False):
-    """Copy lfn to destination"""
+def copy_lfn(lfn, dst, verbose=0, overwrite=False):
+    """
+    Copy lfn to destination in foreground, background copies are
+    handled by cmssh.transfers engine
+    """
     if  overwrite:
         if  os.path.isfile(dst):
             os.remove(dst)
@@ -743,48 +1159,21 @@ def copy_lfn(lfn, dst, verbose=0, background=False, overwrite=False):
             else:
                 fname = None
                 print_warning('Destination %s is not local disk')
-            if  fname:
+            if  fname and partial_file(lfn, fname, verbose):
+                print_info('File %s is partially downloaded, resume it' % fname)
+            elif fname:
                 print_warning('File %s already exists' % fname)
                 return 'fail'
     method = os.environ.get('CMSSH_TRANSFER_METHOD', 'xrdcp')
-    status = FM_SINGLETON.copy(lfn, dst, method, verbose, background)
+    status = FM_SINGLETON.copy(lfn, dst, method, verbose)
     if  status == 'fail':
         print_warning('xrdcp fails to copy file, fallback to GRID middleware mechanism')
         if  os.environ.get('LCG_CP', ''):
-            status = FM_SINGLETON.copy(lfn, dst, 'lcgcp', verbose, background)
+            status = FM_SINGLETON.copy(lfn, dst, 'lcgcp', verbose)
         else:
-            status = FM_SINGLETON.copy(lfn, dst, 'srmcp', verbose, background)
+            status = FM_SINGLETON.copy(lfn, dst, 'srmcp', verbose)
     return status
 
-def dqueue(arg=None):
-    """Return download queue"""
-    download_queue = FM_SINGLETON.queue
-    alive   = []
-    waiting = []
-    ended   = []
-    for lfn, (proc, status) in download_queue.items():
-        if not status:
-            waiting.append(lfn)
-        elif  proc.is_alive():
-            alive.append(lfn)
-        else:
-            ended.append((lfn, proc.exitcode))
-            del download_queue[lfn]
-    print "In progress: %s jobs" % len(alive)
-    if  arg and arg == 'list':
-        for lfn in alive:
-            print lfn
-        if  len(alive): print
-    print "Waiting    : %s jobs" % len(waiting)
-    if  arg and arg == 'list':
-        for lfn in waiting:
-            print lfn
-        if  len(waiting): print
-    print "Finished   : %s jobs" % len(ended)
-    if  arg and arg == 'list':
-        for lfn, code in ended:
-            print "%s, exit code %s" % (lfn, code)
-
 def list_lfn(lfn, verbose=0):
     """List lfn info"""
     return FM_SINGLETON.list_lfn(lfn, verbose)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+
+"""
+Metrics of data-service calls. Every HTTP request made by cmssh is
+recorded into in-memory ring buffer along with its latency break-down
+(DNS look-up, connect, TLS handshake, time to first byte and total
+time), number of received bytes, HTTP status and cache status. The
+size of the buffer is controlled by CMSSH_METRICS_SIZE environment.
+"""
+
+# system modules
+import os
+import time
+import urlparse
+import threading
+from   collections import deque
+
+# cmssh modules
+from   cmssh.utils import size_format
+
+# map of URL patterns to service names, the first matched pattern wins
+SERVICES = [
+    ('/dbs/', 'DBS'),
+    ('cmsdbsprod', 'DBS'),
+    ('/phedex/', 'PhEDEx'),
+    ('/sitedb/', 'SiteDB'),
+    ('/das/', 'DAS'),
+    ('cmssdt.cern.ch/tc', 'TagCollector'),
+    ('dashb-', 'Dashboard'),
+    ('conddb', 'CondDB'),
+    ('/reqmgr/', 'ReqMgr'),
+    ('login.cern.ch', 'SSO'),
+]
+
+def service(url):
+    "Return service name for given URL"
+    for pat, name in SERVICES:
+        if  url.find(pat) != -1:
+            return name
+    return urlparse.urlparse(url).netloc or url
+
+def percentile(values, pct):
+    "Return given percentile of sorted list of values (nearest rank)"
+    if  not values:
+        return None
+    idx = int(round(pct/100.*len(values) + 0.5)) - 1
+    return values[min(max(idx, 0), len(values)-1)]
+
+class Metrics(object):
+    """
+    Thread-safe ring buffer of request records. Each record is a dict
+    with the following keys: service, url, tstamp, total, dns, connect,
+    tls, ttfb (sec), bytes, status and cache. The latter is hit for
+    responses read from cache, shared for results of identical request
+    which was in flight, and None otherwise.
+    """
+    def __init__(self, size=None):
+        if  not size:
+            size = int(os.environ.get('CMSSH_METRICS_SIZE', 1000))
+        self.records = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, url, total, status=None, nbytes=0, cache=None,
+            label=None, **timing):
+        "Record single request"
+        rec = {'service': label or service(url), 'url': url,
+               'tstamp': time.time(), 'total': total, 'status': status,
+               'bytes': nbytes, 'cache': cache}
+        for key in ['dns', 'connect', 'tls', 'ttfb']:
+            rec[key] = timing.get(key)
+        with self.lock:
+            self.records.append(rec)
+        return rec
+
+    def last(self, nrec=20):
+        "Return list of last records"
+        with self.lock:
+            return list(self.records)[-nrec:]
+
+    def clear(self):
+        "Clear all records"
+        with self.lock:
+            self.records.clear()
+
+    def summary(self):
+        """
+        Return dict of per-service statistics, i.e. number of calls,
+        errors, cache hits, received bytes and latency percentiles
+        """
+        with self.lock:
+            records = list(self.records)
+        services = {}
+        for rec in records:
+            services.setdefault(rec['service'], []).append(rec)
+        res = {}
+        for name, recs in services.iteritems():
+            stats = {'calls': len(recs), 'bytes': sum(r['bytes'] or 0 for r in recs),
+                     'hits': len([r for r in recs if r['cache']]),
+                     'errors': len([r for r in recs if not r['cache'] \
+                        and (r['status'] is None or r['status'] >= 400)])}
+            for key in ['total', 'dns', 'connect', 'tls', 'ttfb']:
+                values = sorted(r[key] for r in recs \
+                        if r[key] is not None and not r['cache'])
+                for pct in [50, 90, 99]:
+                    stats['%s_p%s' % (key, pct)] = percentile(values, pct)
+            res[name] = stats
+        return res
+
+    def __str__(self):
+        "Format summary table"
+        def msec(val):
+            "Format time in msec"
+            return '-' if val is None else '%d' % (val*1000)
+        cols = '%-14s %6s %6s %6s %9s %8s %8s %8s %8s %8s %8s %8s'
+        out  = [cols % ('service', 'calls', 'errors', 'hits', 'bytes',
+                'p50,ms', 'p90,ms', 'p99,ms', 'dns', 'connect', 'tls', 'ttfb')]
+        for name, stats in sorted(self.summary().items()):
+            out.append(cols % (name, stats['calls'], stats['errors'],
+                stats['hits'], size_format(stats['bytes']),
+                msec(stats['total_p50']), msec(stats['total_p90']),
+                msec(stats['total_p99']), msec(stats['dns_p50']),
+                msec(stats['connect_p50']), msec(stats['tls_p50']),
+                msec(stats['ttfb_p50'])))
+        return '\n'.join(out)
+
+# Singleton
+METRICS = Metrics()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+
+"""
+Lazy pipeline of result filters, e.g.
+
+    find file dataset=/a/b/c | grep -i run2012 | sort -r size | head 5
+
+Controllers yield records and every filter wraps its input iterator,
+such that records flow through the pipeline one by one and nothing is
+materialized unless filter needs all records (sort) or distinct ones
+(uniq). The head filter stops consuming its input, i.e. upstream
+controllers are not asked for more records than needed. Supported
+filters are
+
+    grep [-i|-v|-iv|-vi] <pattern>  records which contain the pattern
+    count, wc                       number of records
+    head [N]                        first N records, default is 10
+    sort [-r] [field]               records sorted by field or by text
+    uniq                            distinct records, first one is kept
+    select field[,field...]         projection of records into fields
+
+Fields are keys of record data, e.g. name, size, nevents. Sorting by
+size uses raw number of bytes.
+"""
+
+# system modules
+import itertools
+
+# cmssh modules
+from   cmssh.dispatcher import unquote
+
+class Projection(dict):
+    "Record projected into selected fields, shown as their values"
+    def __init__(self, fields, values):
+        dict.__init__(self, zip(fields, values))
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join(str(self[f]) for f in self.fields)
+
+    __repr__ = __str__
+
+def rows(res):
+    "Return iterator over records of given result"
+    if  res is None:
+        return iter([])
+    if  isinstance(res, (basestring, dict)):
+        return iter([res])
+    try:
+        return iter(res)
+    except TypeError:
+        return iter([res])
+
+def text(row):
+    "Return text of given record which is matched by grep"
+    if  isinstance(row, basestring):
+        return row
+    return repr(row)
+
+def field(row, key):
+    "Return value of given field of a record or None"
+    data = getattr(row, 'data', row)
+    if  not isinstance(data, dict):
+        return None
+    if  key == 'size' and 'bytes' in data:
+        return data['bytes']
+    return data.get(key)
+
+def grep_filter(args, gen):
+    "Records which contain (or do not contain) given pattern"
+    opt = None
+    if  args and args[0] in ('-i', '-v', '-iv', '-vi'):
+        opt = args[0]
+        args = args[1:]
+    if  not args:
+        raise NotImplementedError('grep requires a pattern')
+    pattern = unquote(' '.join(args))
+    invert = opt in ('-v', '-iv', '-vi')
+    if  opt in ('-i', '-iv', '-vi'):
+        pattern = pattern.lower()
+        for row in gen:
+            if  (text(row).lower().find(pattern) != -1) != invert:
+                yield row
+    else:
+        for row in gen:
+            if  (text(row).find(pattern) != -1) != invert:
+                yield row
+
+def count_filter(args, gen):
+    "Number of records"
+    if  args:
+        raise NotImplementedError('count does not accept arguments')
+    res = 0
+    for _ in gen:
+        res += 1
+    yield res
+
+def head_filter(args, gen):
+    "First N records"
+    if  len(args) > 1 or (args and not args[0].lstrip('-').isdigit()):
+        raise NotImplementedError('usage: head [N]')
+    num = abs(int(args[0])) if args else 10
+    return itertools.islice(gen, num)
+
+def sort_filter(args, gen):
+    "Records sorted by given field or by their text"
+    reverse = False
+    if  args and args[0] == '-r':
+        reverse = True
+        args = args[1:]
+    if  len(args) > 1:
+        raise NotImplementedError('usage: sort [-r] [field]')
+    if  args:
+        key = lambda row: (field(row, args[0]) is None, field(row, args[0]))
+    else:
+        key = lambda row: row if isinstance(row, basestring) else str(row)
+    for row in sorted(gen, key=key, reverse=reverse):
+        yield row
+
+def uniq_filter(args, gen):
+    "Distinct records, only the first one of duplicates is kept"
+    if  args:
+        raise NotImplementedError('uniq does not accept arguments')
+    seen = set()
+    for row in gen:
+        key = text(row)
+        if  key not in seen:
+            seen.add(key)
+            yield row
+
+def select_filter(args, gen):
+    "Projection of records into given fields"
+    fields = [f for f in ','.join(args).split(',') if f]
+    if  not fields:
+        raise NotImplementedError('usage: select field[,field...]')
+    for row in gen:
+        if  len(fields) == 1:
+            yield field(row, fields[0])
+        else:
+            yield Projection(fields, [field(row, f) for f in fields])
+
+# filter name => function(args, iterator) which returns an iterator
+FILTERS = {
+    'grep': grep_filter,
+    'count': count_filter,
+    'wc': count_filter,
+    'head': head_filter,
+    'sort': sort_filter,
+    'uniq': uniq_filter,
+    'select': select_filter,
+}
+
+def make_filter(flt):
+    """
+    Parse given filter, return function which applies it to an iterator.
+    Unknown filters and wrong arguments raise NotImplementedError.
+    """
+    arr = flt.split()
+    if  not arr or arr[0] not in FILTERS:
+        raise NotImplementedError('Unsupported filter: %s' % flt)
+    func, args = FILTERS[arr[0]], arr[1:]
+    # validate arguments before any record is consumed
+    list(func(args, iter([])))
+    return lambda records: func(args, records)
+
+def pipeline(res, filters):
+    "Lazily apply given list of filters to records of given result"
+    funcs = [make_filter(flt) for flt in filters]
+    gen = rows(res)
+    for func in funcs:
+        gen = func(gen)
+    return gen
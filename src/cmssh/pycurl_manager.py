@@ -19,21 +19,249 @@ followed by N requests to filesummaries API.
 
 import os
 import sys
+import json
 import stat
+import time
 import urllib
 import thread
 import pycurl
 import urllib
 import urllib2
+import urlparse
 import tempfile
+import threading
 import traceback
 import subprocess
+from collections import deque
 from cmssh.auth_utils import PEMMGR, read_pem, working_pem, get_key_cert, HTTPSClientAuthHandler
+from cmssh.utils import HTTP_BYTES
+from cmssh.metrics import METRICS
 try:
     import cStringIO as StringIO
 except:
     import StringIO
 
+def url_host(url):
+    "Return scheme://host:port part of given URL"
+    if  isinstance(url, unicode):
+        url = url.encode('ascii', 'ignore')
+    parts = urlparse.urlparse(url)
+    return '%s://%s' % (parts.scheme, parts.netloc)
+
+class CurlPool(object):
+    """
+    Process-wide pool of keep-alive curl handles. Handles are grouped
+    by (host, client cert) pair, such that subsequent requests to the same
+    data-service re-use already established TCP/SSL connection instead of
+    doing new handshake for every call. Pool parameters can be adjusted
+    via environment:
+
+    - CMSSH_CURL_POOL_SIZE, max number of idle handles kept per host/cert
+    - CMSSH_CURL_POOL_IDLE, time (in sec) after which idle handle is closed
+    """
+    def __init__(self, size=None, idle=None):
+        self.size = int(size or os.environ.get('CMSSH_CURL_POOL_SIZE', 4))
+        self.idle = int(idle or os.environ.get('CMSSH_CURL_POOL_IDLE', 300))
+        self.handles = {} # (host, cert) => [(curl, timestamp), ...]
+        self.lock = threading.Lock()
+
+    def acquire(self, url, cert=None):
+        "Get curl handle for given url/cert, create new one if necessary"
+        key = (url_host(url), cert)
+        now = time.time()
+        with self.lock:
+            self.evict(now)
+            idle = self.handles.get(key, [])
+            while idle:
+                curl, _tstamp = idle.pop()
+                if  self.healthy(curl):
+                    curl.reset() # reset options but keep live connection
+                    return curl
+                curl.close()
+        return pycurl.Curl()
+
+    def release(self, curl, url, cert=None):
+        "Return curl handle back to the pool"
+        key = (url_host(url), cert)
+        if  not self.healthy(curl):
+            curl.close()
+            return
+        with self.lock:
+            idle = self.handles.setdefault(key, [])
+            if  len(idle) < self.size:
+                idle.append((curl, time.time()))
+                return
+        curl.close()
+
+    def discard(self, curl):
+        "Close curl handle which should not be re-used, e.g. after failure"
+        try:
+            curl.close()
+        except pycurl.error:
+            pass
+
+    def healthy(self, curl):
+        """
+        Check that given handle finished its last transfer properly,
+        i.e. server responded with valid HTTP code
+        """
+        try:
+            code = curl.getinfo(pycurl.RESPONSE_CODE)
+        except pycurl.error:
+            return False
+        return code > 0 and code < 500
+
+    def evict(self, now=None):
+        "Close handles which were idle longer than pool idle time"
+        if  not now:
+            now = time.time()
+        for key in self.handles.keys():
+            alive = []
+            for curl, tstamp in self.handles[key]:
+                if  now - tstamp > self.idle:
+                    curl.close()
+                else:
+                    alive.append((curl, tstamp))
+            if  alive:
+                self.handles[key] = alive
+            else:
+                del self.handles[key]
+
+    def clear(self):
+        "Close all handles in a pool"
+        with self.lock:
+            for idle in self.handles.values():
+                for curl, _tstamp in idle:
+                    curl.close()
+            self.handles = {}
+
+# Singleton
+CURL_POOL = CurlPool()
+
+def parse_headers(hbuf):
+    """
+    Parse content of curl header buffer into dict with lower-case keys.
+    Buffer may contain several responses, e.g. redirects, we use the last.
+    """
+    headers = {}
+    for line in hbuf.getvalue().splitlines():
+        if  line.startswith('HTTP/'):
+            headers = {}
+        elif line.find(':') != -1:
+            key, val = line.split(':', 1)
+            headers[key.strip().lower()] = val.strip()
+    return headers
+
+def account(curl, url, nbytes=0, failed=False):
+    """
+    Account finished transfer of given curl handle: count received bytes
+    and record request latency break-down into METRICS
+    """
+    if  not failed:
+        HTTP_BYTES.add(curl.getinfo(pycurl.SIZE_DOWNLOAD), nbytes)
+    dns   = curl.getinfo(pycurl.NAMELOOKUP_TIME)
+    conn  = curl.getinfo(pycurl.CONNECT_TIME)
+    tls   = curl.getinfo(pycurl.APPCONNECT_TIME)
+    pre   = curl.getinfo(pycurl.PRETRANSFER_TIME)
+    start = curl.getinfo(pycurl.STARTTRANSFER_TIME)
+    status = None if failed else curl.getinfo(pycurl.RESPONSE_CODE)
+    METRICS.record(url, curl.getinfo(pycurl.TOTAL_TIME), status, nbytes,
+            dns=dns, connect=max(conn - dns, 0),
+            tls=max(tls - conn, 0) if tls else 0, ttfb=max(start - pre, 0))
+
+def decode(bbuf, decoder):
+    "Decode content of given buffer with given decoder"
+    bbuf.seek(0)
+    if  decoder == 'json':
+        return json.load(bbuf)
+    return bbuf.read()
+
+class CurlStream(object):
+    """
+    File-like object which provides body of pycurl request as it
+    arrives. The transfer is driven by CurlMulti interface on demand
+    of read calls, therefore response body is never fully buffered.
+    """
+    def __init__(self, pool, curl, url, cert=None, hbuf=None):
+        self.pool   = pool
+        self.curl   = curl
+        self.url    = url
+        self.cert   = cert
+        self.hbuf   = hbuf
+        self.code   = None
+        self.chunks = []
+        self.size   = 0
+        self.total  = 0
+        self.done   = False
+        self.error  = None
+        self.curl.setopt(pycurl.WRITEFUNCTION, self.write)
+        self.multi  = pycurl.CurlMulti()
+        self.multi.add_handle(self.curl)
+
+    def write(self, data):
+        "pycurl write callback"
+        self.chunks.append(data)
+        self.size  += len(data)
+        self.total += len(data)
+
+    def pump(self):
+        "Perform single step of the transfer"
+        size = self.size
+        while True:
+            ret, _nhandles = self.multi.perform()
+            if  ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        _nqueued, succeeded, failed = self.multi.info_read()
+        if  succeeded or failed:
+            self.done = True
+            for _curl, errno, errmsg in failed:
+                self.error = pycurl.error(errno, errmsg)
+        elif self.size == size:
+            self.multi.select(1.0)
+
+    def start(self):
+        "Start transfer and wait for first portion of data"
+        while not self.done and not self.size:
+            self.pump()
+        if  self.error:
+            raise self.error
+        self.code = self.curl.getinfo(pycurl.RESPONSE_CODE)
+        if  self.code >= 400:
+            raise IOError('HTTP error %s, url=%s' % (self.code, self.url))
+
+    def info(self):
+        "Return response headers"
+        return parse_headers(self.hbuf)
+
+    def read(self, size=-1):
+        "Read up to size bytes from the stream"
+        while not self.done and (size < 0 or self.size < size):
+            self.pump()
+        if  self.error:
+            raise self.error
+        data = ''.join(self.chunks)
+        if  size < 0 or len(data) <= size:
+            self.chunks = []
+            self.size = 0
+            return data
+        self.chunks = [data[size:]]
+        self.size = len(data) - size
+        return data[:size]
+
+    def close(self):
+        "Close the stream and return curl handle to the pool"
+        if  not self.multi:
+            return
+        self.multi.remove_handle(self.curl)
+        self.multi.close()
+        self.multi = None
+        # stream closed before the end of transfer is not a failure
+        account(self.curl, self.url, self.total, failed=bool(self.error))
+        if  self.done and not self.error:
+            self.pool.release(self.curl, self.url, self.cert)
+        else:
+            self.pool.discard(self.curl)
+
 class RequestHandler(object):
     """
     RequestHandler provides APIs to fetch single/multiple
@@ -48,7 +276,18 @@ class RequestHandler(object):
         self.connecttimeout = config.get('connecttimeout', 30)
         self.followlocation = config.get('followlocation', 1)
         self.maxredirs = config.get('maxredirs', 5)
-        self.cache = {} # fill at run time
+        self.pool = config.get('pool', CURL_POOL)
+        self.compression = config.get('compression', \
+                int(os.environ.get('CMSSH_HTTP_COMPRESSION', 1)))
+        # cookie jar is kept at fixed location, not in current directory
+        self.cookie = config.get('cookie', os.environ.get('CMSSH_COOKIE', \
+                os.path.join(os.environ['HOME'], '.cmssh', 'cookie')))
+        cdir = os.path.dirname(self.cookie)
+        if  cdir and not os.path.isdir(cdir):
+            try:
+                os.makedirs(cdir, 0700)
+            except OSError:
+                pass
 
     def set_opts(self, curl, url, params, headers,
                  ckey=None, cert=None, post=None, doseq=True, verbose=None):
@@ -58,8 +297,11 @@ class RequestHandler(object):
         curl.setopt(pycurl.CONNECTTIMEOUT, self.connecttimeout)
         curl.setopt(pycurl.FOLLOWLOCATION, self.followlocation)
         curl.setopt(pycurl.MAXREDIRS, self.maxredirs)
-        curl.setopt(pycurl.COOKIEJAR, '.cookie')
-        curl.setopt(pycurl.COOKIEFILE, '.cookie')
+        curl.setopt(pycurl.COOKIEJAR, self.cookie)
+        curl.setopt(pycurl.COOKIEFILE, self.cookie)
+        if  self.compression:
+            # negotiate gzip/deflate, libcurl decompress body transparently
+            curl.setopt(pycurl.ENCODING, 'gzip, deflate')
 
         encoded_data = urllib.urlencode(params, doseq=doseq)
         if  not post:
@@ -100,15 +342,101 @@ class RequestHandler(object):
     def get_data(self, url, params, headers=None, post=None,
                 ckey=None, cert=None, doseq=True, verbose=None):
         """Fetch data for given set of parameters"""
-        if  self.cache.has_key(thread):
-            curl = self.cache.get(thread)
-        else:
-            curl = pycurl.Curl()
-            self.cache[thread] = curl
+        curl = self.pool.acquire(url, cert)
         bbuf, hbuf = self.set_opts(curl, url, params, headers,
                 ckey, cert, post, doseq, verbose)
-        curl.perform()
+        try:
+            curl.perform()
+        except:
+            account(curl, url, failed=True)
+            self.pool.discard(curl)
+            raise
+        account(curl, url, bbuf.tell())
+        self.pool.release(curl, url, cert)
         bbuf.seek(0)# to use file description seek to the begining of the stream
         data = bbuf # leave StringIO object, which will serve as file descriptor
         hbuf.flush()
         return data
+
+    def get_stream(self, url, params, headers=None, post=None,
+                ckey=None, cert=None, doseq=True, verbose=None):
+        """
+        Fetch data for given set of parameters and return CurlStream
+        file-like object which yields response body as it arrives
+        """
+        curl = self.pool.acquire(url, cert)
+        _bbuf, hbuf = self.set_opts(curl, url, params, headers,
+                ckey, cert, post, doseq, verbose)
+        stream = CurlStream(self.pool, curl, url, cert, hbuf)
+        try:
+            stream.start()
+        except:
+            stream.close()
+            raise
+        return stream
+
+    def get_multi(self, requests, headers=None, post=None, ckey=None,
+                cert=None, doseq=True, verbose=None, decoder='json', limit=None):
+        """
+        Fetch data for given list of (url, params) pairs concurrently
+        using pycurl CurlMulti interface. No more than limit requests
+        (default CMSSH_CURL_MULTI_LIMIT or 10) are in flight at any time.
+        Results are yielded as (url, params, data, headers, error) tuples
+        in order of their completion, where data is decoded with given
+        decoder, headers is a dict of response headers with lower-case
+        keys and error is an exception object for failed requests (data
+        is None).
+        """
+        if  not limit:
+            limit = int(os.environ.get('CMSSH_CURL_MULTI_LIMIT', 10))
+        pending = deque(requests)
+        active  = {} # curl => (url, params, bbuf, hbuf)
+        multi   = pycurl.CurlMulti()
+        try:
+            while pending or active:
+                while pending and len(active) < limit:
+                    url, params = pending.popleft()
+                    curl = self.pool.acquire(url, cert)
+                    bbuf, hbuf = self.set_opts(curl, url, params, headers,
+                            ckey, cert, post, doseq, verbose)
+                    multi.add_handle(curl)
+                    active[curl] = (url, params, bbuf, hbuf)
+                while True:
+                    ret, _nhandles = multi.perform()
+                    if  ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    nqueued, succeeded, failed = multi.info_read()
+                    for curl in succeeded:
+                        multi.remove_handle(curl)
+                        url, params, bbuf, hbuf = active.pop(curl)
+                        code = curl.getinfo(pycurl.RESPONSE_CODE)
+                        rhdrs = parse_headers(hbuf)
+                        account(curl, url, bbuf.tell())
+                        self.pool.release(curl, url, cert)
+                        if  code >= 400:
+                            err = IOError('HTTP error %s, url=%s' % (code, url))
+                            yield url, params, None, rhdrs, err
+                            continue
+                        try:
+                            data = decode(bbuf, decoder)
+                        except Exception as exc:
+                            yield url, params, None, rhdrs, exc
+                            continue
+                        yield url, params, data, rhdrs, None
+                    for curl, errno, errmsg in failed:
+                        multi.remove_handle(curl)
+                        url, params, _bbuf, _hbuf = active.pop(curl)
+                        account(curl, url, failed=True)
+                        self.pool.discard(curl)
+                        yield url, params, None, {}, pycurl.error(errno, errmsg)
+                    if  not nqueued:
+                        break
+                if  active:
+                    multi.select(1.0)
+        finally:
+            # clean-up handles left by generator which was not exhausted
+            for curl in active.keys():
+                multi.remove_handle(curl)
+                self.pool.discard(curl)
+            multi.close()
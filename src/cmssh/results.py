@@ -2,48 +2,124 @@
 #-*- coding: ISO-8859-1 -*-
 #pylint: disable-msg=E1101,C0103,R0902,R0903
 """
-ResultManager holds current data returned by cms-sh
+ResultManager holds current data returned by cms-sh. Streamed results,
+e.g. generators, are consumed lazily and their records are kept as
+they pass by, such that results can be iterated, indexed and counted
+afterwards. At most CMSSH_RESULTS_SIZE (default 10000) records of a
+stream are kept.
 """
 
-import types
+import os
 
 class ResultManager(object):
     """This class holds results of every command used in cms-sh"""
-    def __init__(self, debug=0):
+    def __init__(self, debug=0, limit=None):
         self.debug = debug
+        if  limit is None:
+            limit = int(os.environ.get('CMSSH_RESULTS_SIZE', 10000))
+        self.limit = limit
         self.data = None
         self.type = None
-        
+        self.stream = None  # iterator of not yet consumed records
+        self.streamed = False
+        self.count = 0      # number of consumed records of the stream
+        self.truncated = False
+
     def assign(self, data):
         """Assign data to Result Manager"""
-        self.data = data
         self.type = type(data)
-        
+        self.stream = None
+        self.streamed = False
+        self.count = 0
+        self.truncated = False
+        try:
+            streamed = iter(data) is data
+        except TypeError:
+            streamed = False
+        if  streamed:
+            self.data = []
+            self.stream = data
+            self.streamed = True
+        else:
+            self.data = data
+
     def __xattrs__(self, mode="default"):
         """data attributes"""
         return ("data")
 
+    def pull(self):
+        """Consume next record of the stream, raise StopIteration at its end"""
+        try:
+            row = self.stream.next()
+        except StopIteration:
+            self.stream = None
+            raise
+        self.count += 1
+        if  len(self.data) < self.limit:
+            self.data.append(row)
+        else:
+            self.truncated = True
+        return row
+
+    def drain(self):
+        """Consume the rest of the stream"""
+        while self.stream is not None:
+            try:
+                self.pull()
+            except StopIteration:
+                pass
+
+    def records(self):
+        """Kept records followed by the rest of the stream"""
+        idx = 0
+        while True:
+            if  idx < len(self.data):
+                row = self.data[idx]
+            elif idx == self.count and self.stream is not None:
+                try:
+                    row = self.pull()
+                except StopIteration:
+                    return
+            else:
+                return
+            idx += 1
+            yield row
+
     def __iter__(self):
         """local iterator"""
+        if  self.streamed:
+            return self.records()
         return iter(self.data)
 
+    def __nonzero__(self):
+        """truth value, stream which is not consumed yet is true"""
+        if  self.streamed:
+            return self.stream is not None or bool(self.data)
+        return bool(self.data)
+
     def __len__(self):
-        """len operator"""
-        if  isinstance(self.data, types.GeneratorType):
-            return len([i for i in self.data])
-        elif isinstance(self.data, list):
+        """len operator, consumes the stream"""
+        if  self.streamed:
+            self.drain()
+            return self.count
+        elif isinstance(self.data, (list, set, dict)):
             return len(self.data)
         else:
              raise TypeError
 
     def __getitem__(self, idx):
         """getitem operator"""
-        if  isinstance(self.data, types.GeneratorType):
-            if  not idx:
-                return self.data.next()
-            for _ in range(0, idx-1):
-                self.data.next()
-            return self.data.next()
+        if  self.streamed:
+            if  isinstance(idx, slice) or idx < 0:
+                self.drain()
+            else:
+                while idx >= len(self.data) and self.stream is not None \
+                    and not self.truncated:
+                    try:
+                        self.pull()
+                    except StopIteration:
+                        pass
+            return self.data[idx]
         elif isinstance(self.data, list):
             return self.data.__getitem__(idx)
         else:
@@ -4,19 +4,52 @@
 File       : sitedb.py
 Author     : Valentin Kuznetsov <vkuznet@gmail.com>
 Description: SiteDB module
+
+SiteDB data (site names, SE to CMS name mapping and people) are kept in
+process-wide snapshot with indexed look-ups. The snapshot is loaded
+once, from local copy if it is fresh (stale copy is used, with warning,
+only if SiteDB is not reachable), and refreshed in background thread
+when it gets older than threshold, while callers are served from the
+current one. Users are searched via index of normalized name tokens
+which is built once per snapshot. It is configured via environment:
+
+- CMSSH_SITEDB, local copy of the snapshot, default is ~/.cmssh/sitedb.json
+- CMSSH_SITEDB_TTL, snapshot threshold in sec, default is 3 hours
 """
 
 # system modules
 import os
-import sys
+import re
 import json
 import time
-import urllib2
+import bisect
+import tempfile
+import threading
 
 # cmssh modules
-from   cmssh.utils import memoize
-from   cmssh.url_utils import get_data_and_close
-from   cmssh.auth_utils import PEMMGR, working_pem, HTTPSClientAuthHandler
+from   cmssh.url_utils import get_data_multi
+from   cmssh.cache import cached
+from   cmssh.iprint import print_warning
+
+# separators of name tokens and of their parts
+PAT_SEP  = re.compile(r'[\s,;()"\']+')
+PAT_PART = re.compile(r'[-.@]+')
+
+def name_tokens(value):
+    """
+    Return set of normalized tokens of given name or e-mail, compound
+    tokens (e.g. e-mail or hyphenated name) are also split into parts
+    """
+    if  not value:
+        return set()
+    tokens = set(PAT_SEP.split(value.lower()))
+    for token in list(tokens):
+        if  PAT_PART.search(token):
+            tokens.update(PAT_PART.split(token))
+            if  token.find('@') != -1: # local part of e-mail
+                tokens.add(token.split('@')[0])
+    tokens.discard('')
+    return tokens
 
 def rowdict(columns, row):
     """Convert given row list into dict with column keys"""
@@ -39,52 +72,265 @@ def parser(data):
         for row in data['result']:
             yield row
 
+class UserIndex(object):
+    """
+    Index of SiteDB people. Every user is indexed by normalized tokens of
+    its username, forename, surname and e-mail. Prefix look-ups use
+    sorted list of tokens, substring look-ups scan all distinct tokens
+    joined into single string.
+    """
+    def __init__(self, people):
+        self.people = people
+        self.by_dn  = {}
+        self.tokens = {} # token => set of people indexes
+        for idx, row in enumerate(people):
+            if  row.get('dn'):
+                self.by_dn[row['dn']] = row
+            for key in ['username', 'forename', 'surname', 'email']:
+                for token in name_tokens(row.get(key)):
+                    self.tokens.setdefault(token, set()).add(idx)
+        self.keys    = sorted(self.tokens)
+        self.offsets = [] # offsets of keys in blob
+        pos = 0
+        for key in self.keys:
+            self.offsets.append(pos)
+            pos += len(key) + 1
+        self.blob    = u'\n'.join(self.keys)
+
+    def prefix(self, term):
+        "Return tokens which start with given term"
+        idx = bisect.bisect_left(self.keys, term)
+        res = []
+        for key in self.keys[idx:]:
+            if  not key.startswith(term):
+                break
+            res.append(key)
+        return res
+
+    def substring(self, term):
+        "Return tokens which contain given term"
+        res = []
+        pos = self.blob.find(term)
+        while pos != -1:
+            idx = bisect.bisect_right(self.offsets, pos) - 1
+            res.append(self.keys[idx])
+            if  idx + 1 == len(self.keys):
+                break
+            pos = self.blob.find(term, self.offsets[idx+1])
+        return res
+
+    def user(self, dnname):
+        "Return user record of given DN"
+        return self.by_dn.get(dnname)
+
+    def search(self, query):
+        """
+        Return user records which match all words of given query (DN,
+        username, name or e-mail, any of them can be partial). Users
+        whose tokens are equal to query words go first, then those with
+        matching prefixes, then substrings.
+        """
+        query = query.strip()
+        if  query.startswith('/'):
+            row = self.user(query)
+            return [row] if row else []
+        found = None
+        ranks = {}
+        for term in PAT_SEP.split(query.lower()):
+            if  not term:
+                continue
+            if  isinstance(term, str):
+                term = term.decode('utf-8', 'ignore')
+            matches = set()
+            ranked  = {} # token => rank, exact and prefix hits first
+            for key in self.prefix(term):
+                ranked[key] = 0 if key == term else 1
+            for key in self.substring(term):
+                ranked.setdefault(key, 2)
+            for key, rank in ranked.items():
+                for idx in self.tokens[key]:
+                    matches.add(idx)
+                    ranks[idx] = min(rank, ranks.get(idx, rank))
+            found = matches if found is None else found & matches
+        if  not found:
+            return []
+        order = sorted(found, \
+                key=lambda i: (ranks[i], self.people[i].get('username')))
+        return [self.people[idx] for idx in order]
+
+class SiteDBSnapshot(object):
+    "Immutable SiteDB snapshot with look-up indexes"
+    def __init__(self, data):
+        self.data    = data
+        self.tstamp  = data['tstamp']
+        self.mapping = data['mapping'] # SE => CMS name
+        self.users   = None # UserIndex, built on demand
+        self.lock    = threading.Lock()
+        # sorted (lower case name, name) pairs for prefix search
+        names = set(data['names'].keys()) | set(data['mapping'].values())
+        self.names = sorted((name.lower(), name) for name in names if name)
+
+    def user_index(self):
+        "Return index of people"
+        with self.lock:
+            if  self.users is None:
+                self.users = UserIndex(self.data['people'])
+        return self.users
+
+    def site_names(self, prefix=''):
+        "Return site names which start with given prefix (case insensitive)"
+        prefix = prefix.lower()
+        idx = bisect.bisect_left(self.names, (prefix, ''))
+        res = []
+        for key, name in self.names[idx:]:
+            if  not key.startswith(prefix):
+                break
+            res.append(name)
+        return res
+
 class SiteDBManager(object):
-    "SiteDB manager"
-    def __init__(self, url='https://cmsweb.cern.ch/sitedb/data/prod', threshold = 10800):
-        self.resources = []
-        self.names     = []
+    "SiteDB manager, holds current SiteDB snapshot"
+    def __init__(self, url='https://cmsweb.cern.ch/sitedb/data/prod',
+            threshold=None, fname=None):
+        if  not threshold:
+            threshold = int(os.environ.get('CMSSH_SITEDB_TTL', 10800))
+        if  not fname:
+            fname = os.environ.get('CMSSH_SITEDB', \
+                    os.path.join(os.environ['HOME'], '.cmssh', 'sitedb.json'))
         self.url       = url
-        self.mapping   = {} # fill at run time
-        self.users     = {} # fill at run time
-        self.timestamp = time.time()
         self.threshold = threshold # in sec, default 3 hours
-        self.init()
+        self.fname     = fname
+        self.snapshot  = None
+        self.updater   = None # background refresh thread
+        self.lock      = threading.Lock()
 
-    def init(self):
-        "initialize SiteDB connection and retrieve all names"
-        # get site names
-        url = self.url + '/site-names'
+    def fetch(self):
+        "Retrieve site names, site resources and people from SiteDB"
+        # all calls go to the same SiteDB host and are done concurrently
+        apis = ['site-names', 'site-resources', 'people']
+        reqs = [('%s/%s' % (self.url, api), {}) for api in apis]
+        rows = {}
+        for url, _params, data in get_data_multi(reqs):
+            rows[url.split('/')[-1]] = list(parser(data))
         names = {}
-        cert = os.path.join(os.environ['HOME'], '.globus/usercert.pem')
-        with working_pem(PEMMGR.pem) as key:
-            with get_data_and_close(url, key, cert) as data:
-                for row in parser(data.read()):
-                    names[row['site_name']] = row['alias']
-            # get site resources
-            url = self.url + '/site-resources'
-            with get_data_and_close(url, key, cert) as data:
-                for row in parser(data.read()):
-                    fqdn = row['fqdn']
-                    for sename in row['fqdn'].split(','):
-                        self.mapping[sename.strip()] = names[row['site_name']]
-            # get people info
-            url = self.url + '/people'
-            with get_data_and_close(url, key, cert) as data:
-                for row in parser(data.read()):
-                    self.users[row['dn']] = row['username']
+        for row in rows['site-names']:
+            names[row['site_name']] = row['alias']
+        mapping = {}
+        for row in rows['site-resources']:
+            for sename in row['fqdn'].split(','):
+                mapping[sename.strip()] = names.get(row['site_name'])
+        people = [dict((k, row.get(k)) for k in \
+                ['username', 'dn', 'forename', 'surname', 'email']) \
+                for row in rows['people']]
+        return {'tstamp': time.time(), 'names': names, 'mapping': mapping,
+                'people': people}
+
+    def load(self):
+        "Load snapshot from local copy"
+        try:
+            with open(self.fname) as stream:
+                return SiteDBSnapshot(json.load(stream))
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, data):
+        "Atomically write snapshot to local copy"
+        fdir = os.path.dirname(self.fname)
+        try:
+            if  not os.path.isdir(fdir):
+                os.makedirs(fdir, 0700)
+            fdes, tmp = tempfile.mkstemp(suffix='.tmp', dir=fdir)
+            with os.fdopen(fdes, 'w') as stream:
+                json.dump(data, stream)
+            os.rename(tmp, self.fname)
+        except (IOError, OSError):
+            pass # local copy is an optimization
+
+    def refresh(self):
+        "Retrieve new snapshot from SiteDB"
+        data = self.fetch()
+        snapshot = SiteDBSnapshot(data)
+        if  self.snapshot and self.snapshot.users:
+            snapshot.user_index() # keep users index ready for searches
+        self.snapshot = snapshot
+        self.get_user.invalidate()
+        self.find_users.invalidate()
+        self.save(data)
+
+    def update(self):
+        "Refresh snapshot in background unless refresh is in progress"
+        def target():
+            "Background refresh, current snapshot is kept on failure"
+            try:
+                self.refresh()
+            except Exception:
+                pass
+        with self.lock:
+            if  self.updater and self.updater.is_alive():
+                return
+            self.updater = threading.Thread(target=target)
+            self.updater.daemon = True
+            self.updater.start()
+
+    def get(self, load=True):
+        """
+        Return current snapshot, only initial load without fresh local
+        copy blocks. Return None if snapshot is not loaded and load is False.
+        """
+        if  self.snapshot is None and not load:
+            return None
+        if  self.snapshot is None:
+            with self.lock:
+                if  self.snapshot is None:
+                    snapshot = self.load()
+                    if  snapshot is None:
+                        self.refresh()
+                    elif time.time() - snapshot.tstamp > self.threshold:
+                        # local copy is stale, fetch it synchronously and
+                        # fall back to stale copy only if SiteDB is not
+                        # reachable
+                        try:
+                            self.refresh()
+                        except Exception as exc:
+                            stamp = time.strftime('%Y-%m-%d %H:%M:%S',
+                                        time.localtime(snapshot.tstamp))
+                            msg  = 'Unable to refresh SiteDB data, %s\n' % exc
+                            msg += 'Use stale local copy %s of %s' \
+                                    % (self.fname, stamp)
+                            print_warning(msg)
+                            self.snapshot = snapshot
+                    else:
+                        self.snapshot = snapshot
+        snapshot = self.snapshot
+        if  time.time() - snapshot.tstamp > self.threshold:
+            self.update()
+        return snapshot
 
     def get_name(self, sename):
         "Retrieve CMS name for given SE"
         if  not sename:
             return None
-        if  time.time() - self.timestamp > self.threshold:
-            self.init() # refresh data from SiteDB
-        return self.mapping.get(sename, None)
+        return self.get().mapping.get(sename, None)
 
-    @memoize
+    @cached(ttl=10800, maxsize=1024, name='sitedb.get_user')
     def get_user(self, dnname):
         "Get user name for given DN"
-        if  time.time() - self.timestamp > self.threshold:
-            self.init() # refresh data from SiteDB
-        return self.users.get(dnname, None)
+        row = self.get().user_index().user(dnname)
+        return row['username'] if row else None
+
+    def user_index(self, load=True):
+        "Return user index of current snapshot, see get for load"
+        snapshot = self.get(load)
+        return snapshot.user_index() if snapshot else None
+
+    @cached(ttl=10800, maxsize=256, name='sitedb.find_users')
+    def find_users(self, query):
+        "Return list of user records which match given query"
+        return self.user_index().search(query)
+
+    def site_names(self, prefix=''):
+        "Return CMS site names which start with given prefix"
+        return self.get().site_names(prefix)
+
+# Singleton
+SITEDB = SiteDBManager()
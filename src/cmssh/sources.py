@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+
+"""
+Transfer source ranking. Outcome of every transfer is recorded per
+source SE (host of the PFN, or XRootD redirector for xrdcp), i.e. its
+throughput (exponentially weighted average) and success/failure counts.
+The history is kept on disk and used to order replicas of a file: the
+fastest and most reliable sources are tried first, sources with repeated
+failures are put into cooldown and tried last. It is configured via
+environment:
+
+- CMSSH_SOURCES, history file, default is ~/.cmssh/sources.json
+- CMSSH_SOURCE_FAILS, number of consecutive failures which put source
+  into cooldown, default is 3
+- CMSSH_SOURCE_COOLDOWN, cooldown period in sec, default is 1800
+- CMSSH_SOURCE_PROBE, set to 1 to probe unknown sources before use
+"""
+
+# system modules
+import os
+import json
+import time
+import urlparse
+import tempfile
+import threading
+
+# XRootD global redirector, source of all xrdcp transfers
+XRD_REDIRECTOR = 'cms-xrd-global.cern.ch'
+
+def source_key(url):
+    "Return source SE of given transfer URL"
+    return urlparse.urlparse(url).netloc.split(':')[0] or 'local'
+
+class SourceStats(object):
+    "Persistent per-source transfer history"
+    def __init__(self, fname=None, alpha=0.3):
+        if  not fname:
+            fname = os.environ.get('CMSSH_SOURCES', \
+                    os.path.join(os.environ['HOME'], '.cmssh', 'sources.json'))
+        self.fname   = fname
+        self.alpha   = alpha # weight of the last throughput measurement
+        self.fails   = int(os.environ.get('CMSSH_SOURCE_FAILS', 3))
+        self.cooldown = int(os.environ.get('CMSSH_SOURCE_COOLDOWN', 1800))
+        self.sources = None # source => dict of stats, loaded on demand
+        self.lock    = threading.RLock()
+
+    def load(self):
+        "Load history from disk, the lock must be held"
+        if  self.sources is not None:
+            return
+        try:
+            with open(self.fname) as stream:
+                self.sources = json.load(stream)
+        except (IOError, ValueError):
+            self.sources = {}
+
+    def save(self):
+        "Atomically write history to disk, the lock must be held"
+        fdir = os.path.dirname(self.fname)
+        try:
+            if  not os.path.isdir(fdir):
+                os.makedirs(fdir, 0700)
+            fdes, tmp = tempfile.mkstemp(suffix='.tmp', dir=fdir)
+            with os.fdopen(fdes, 'w') as stream:
+                json.dump(self.sources, stream)
+            os.rename(tmp, self.fname)
+        except (IOError, OSError):
+            pass # history is an optimization, do not fail transfers
+
+    def stats(self, source):
+        "Return stats of given source"
+        with self.lock:
+            self.load()
+            return dict(self.sources.get(source, {}))
+
+    def record(self, source, ok, nbytes=0, elapsed=0):
+        "Record outcome of transfer from given source"
+        with self.lock:
+            self.load()
+            rec = self.sources.setdefault(source, {'ok': 0, 'fail': 0,
+                'rate': None, 'failures': 0, 'cooldown': 0})
+            if  ok:
+                rec['ok'] += 1
+                rec['failures'] = 0
+                if  nbytes and elapsed > 0:
+                    rate = nbytes/elapsed
+                    if  rec['rate'] is None:
+                        rec['rate'] = rate
+                    else:
+                        rec['rate'] = self.alpha*rate + (1-self.alpha)*rec['rate']
+            else:
+                rec['fail'] += 1
+                rec['failures'] += 1
+                if  rec['failures'] >= self.fails:
+                    rec['cooldown'] = time.time() + self.cooldown
+                    rec['failures'] = 0
+            rec['tstamp'] = time.time()
+            self.save()
+
+    def in_cooldown(self, source):
+        "Check if given source is in cooldown"
+        return self.stats(source).get('cooldown', 0) > time.time()
+
+    def score(self, source, prior):
+        """
+        Return expected throughput of given source, i.e. its average
+        throughput (prior for unknown sources) times success rate
+        """
+        rec   = self.stats(source)
+        rate  = rec.get('rate') or prior
+        ntot  = rec.get('ok', 0) + rec.get('fail', 0)
+        return rate * (rec.get('ok', 0) + 1.) / (ntot + 2.)
+
+    def prior(self):
+        "Return median throughput of known sources"
+        with self.lock:
+            self.load()
+            rates = sorted(r['rate'] for r in self.sources.values() if r['rate'])
+        return rates[len(rates)/2] if rates else 1.
+
+    def rank(self, urls, key=source_key):
+        """
+        Order given URLs by expected throughput of their sources, sources
+        in cooldown go last (they are still tried if nothing else works)
+        """
+        prior = self.prior()
+        def order(url):
+            "Sort key"
+            source = key(url)
+            return (self.in_cooldown(source), -self.score(source, prior))
+        return sorted(urls, key=order)
+
+    def probe(self, url, func, timeout=30):
+        """
+        Probe given source with func(url) call, e.g. small metadata
+        request, with given timeout. Failure is recorded in history.
+        """
+        res = []
+        thr = threading.Thread(target=lambda: res.append(func(url)))
+        thr.daemon = True
+        thr.start()
+        thr.join(timeout)
+        ok = bool(res and res[0] and res[0] != 'null')
+        if  not ok:
+            self.record(source_key(url), False)
+        return ok
+
+    def listing(self):
+        "Yield (source, stats) pairs ordered by score"
+        prior = self.prior()
+        with self.lock:
+            self.load()
+            sources = list(self.sources)
+        for source in sorted(sources, key=lambda s: -self.score(s, prior)):
+            yield source, self.stats(source)
+
+# Singleton
+SOURCES = SourceStats()
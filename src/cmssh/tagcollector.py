@@ -9,7 +9,8 @@ import os
 import re
 
 # cmssh modules
-from cmssh.utils import Memoize, platform
+from cmssh.utils import platform
+from cmssh.cache import cached
 from cmssh.cms_urls import tc_url
 from cmssh.url_utils import get_data
 from cmssh.regex import pat_release
@@ -24,7 +25,11 @@ def match_platform(arch):
             return True
     return False
 
-@Memoize(interval=3600)
+def releases_key(rel_name=None, rfilter=None):
+    "Cache key of releases, they depend on platform (cache is persistent)"
+    return [rel_name, rfilter, platform()]
+
+@cached(ttl=3600, maxsize=32, persist=True, key=releases_key)
 def releases(rel_name=None, rfilter=None):
     "Return information about CMS releases"
     if  rel_name:
@@ -59,6 +64,7 @@ def releases(rel_name=None, rfilter=None):
             if  match_platform(item['architecture_name']):
                 yield row
 
+@cached(ttl=3600, maxsize=8)
 def architectures(arch_type='production'):
     "Return list of CMSSW known architectures"
     if  not arch_type:
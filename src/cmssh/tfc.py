@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+
+"""
+Trivial File Catalog (TFC) rule engine. The storage-mapping of a node is
+fetched once from PhEDEx tfc API, its lfn-to-pfn rules are compiled and
+kept in memory, such that LFN to PFN resolution is a local operation.
+Rules are applied the same way PhEDEx does it: rules of given protocol
+are tried in order, a rule applies if its destination-match (if any)
+matches destination node and its path-match matches the name; a chained
+rule first converts the name using rules of chained protocol. Rules are
+refreshed after CMSSH_TFC_TTL seconds, default is one day.
+"""
+
+# system modules
+import os
+import re
+import time
+import threading
+
+# cmssh modules
+from cmssh.cms_urls import phedex_url
+from cmssh.url_utils import get_data_multi
+
+# TTL of TFC rules in sec
+TFC_TTL = int(os.environ.get('CMSSH_TFC_TTL', 24*60*60))
+
+# matches $1, ${1} references in TFC results
+PAT_GROUP = re.compile(r'\$\{?(\d+)\}?')
+
+class TFCRule(object):
+    "Compiled lfn-to-pfn TFC rule"
+    def __init__(self, row):
+        self.protocol = row['protocol']
+        self.match    = re.compile(row['path-match'])
+        self.result   = row['result']
+        self.chain    = row.get('chain')
+        dest          = row.get('destination-match')
+        self.dest     = re.compile(dest) if dest else None
+
+    def apply(self, name):
+        "Apply rule to given name, return None if rule does not match"
+        match = self.match.search(name)
+        if  not match:
+            return None
+        def group(gmatch):
+            "Substitute group reference"
+            return match.group(int(gmatch.group(1))) or ''
+        return name[:match.start()] + PAT_GROUP.sub(group, self.result) \
+                + name[match.end():]
+
+class TFCRules(object):
+    "Compiled lfn-to-pfn rules of single node"
+    def __init__(self, node, rows):
+        self.node  = node
+        self.rows  = rows
+        self.rules = {} # protocol => [TFCRule, ...]
+        for row in rows:
+            if  row.get('element_name') != 'lfn-to-pfn':
+                continue
+            try:
+                rule = TFCRule(row)
+            except (KeyError, re.error):
+                continue # rule which we can't handle, leave it to PhEDEx
+            self.rules.setdefault(rule.protocol, []).append(rule)
+
+    def protocols(self):
+        "Return list of protocols known to this node"
+        return self.rules.keys()
+
+    def pfn(self, lfn, protocol='srmv2', dest=None, depth=0):
+        "Return PFN of given LFN for given protocol or None"
+        if  depth > 10: # protect against cyclic chains
+            return None
+        for rule in self.rules.get(protocol, []):
+            if  rule.dest and not rule.dest.search(dest or self.node):
+                continue
+            name = lfn
+            if  rule.chain:
+                name = self.pfn(lfn, rule.chain, dest, depth+1)
+                if  name is None:
+                    continue
+            pfn = rule.apply(name)
+            if  pfn is not None:
+                return pfn
+        return None
+
+class TFCManager(object):
+    "Cache of compiled TFC rules of PhEDEx nodes"
+    def __init__(self, ttl=None):
+        self.ttl   = ttl or TFC_TTL
+        self.nodes = {} # node => (tstamp, TFCRules)
+        self.lock  = threading.Lock()
+
+    def get(self, node):
+        "Return rules of given node if they are loaded and did not expire"
+        with self.lock:
+            tstamp, rules = self.nodes.get(node, (0, None))
+        if  time.time() - tstamp > self.ttl:
+            return None
+        return rules
+
+    def load(self, nodes, verbose=None):
+        "Fetch and compile TFC of given nodes which are not loaded yet"
+        reqs = [(phedex_url('tfc'), {'node':n}) for n in set(nodes) \
+                if self.get(n) is None]
+        for _url, params, result in get_data_multi(reqs, verbose=verbose):
+            try:
+                rows = result['phedex']['storage-mapping']['array']
+            except (KeyError, TypeError):
+                rows = [] # no TFC, resolution falls back to PhEDEx
+            rules = TFCRules(params['node'], rows)
+            with self.lock:
+                self.nodes[params['node']] = (time.time(), rules)
+
+    def rules(self, node, verbose=None):
+        "Return compiled TFC rules of given node"
+        rules = self.get(node)
+        if  rules is None:
+            self.load([node], verbose)
+            rules = self.get(node)
+        return rules
+
+    def lfn2pfn(self, node, lfn, protocol='srmv2', verbose=None):
+        "Resolve given LFN on given node, return None if TFC does not apply"
+        rules = self.rules(node, verbose)
+        if  not rules:
+            return None
+        return rules.pfn(lfn, protocol)
+
+    def resolve(self, pairs, protocol='srmv2', verbose=None):
+        """
+        Resolve given list of (node, lfn) pairs, return dict of
+        (node, lfn) => pfn for pairs which were resolved by TFC
+        """
+        self.load([node for node, _lfn in pairs], verbose)
+        res = {}
+        for node, lfn in pairs:
+            rules = self.get(node)
+            pfn = rules.pfn(lfn, protocol) if rules else None
+            if  pfn is not None:
+                res[(node, lfn)] = pfn
+        return res
+
+    def clear(self):
+        "Clear all rules"
+        with self.lock:
+            self.nodes = {}
+
+# Singleton
+TFCMGR = TFCManager()
@@ -0,0 +1,717 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+
+"""
+Multi-file transfer engine used by cp command. Source of a copy can be
+a dataset, a block, a file with list of LFNs (@file) or LFN pattern.
+Files are copied by pool of worker threads fed from a priority queue,
+the engine bounds number of concurrent transfers per destination and per
+source SE, retries failed files and falls back from one transfer method
+to another (xrdcp, lcg-cp, srmcp). Waiting and running transfers can be
+cancelled and re-prioritized. All job state transitions are recorded in
+append-only journal, such that pending transfers are resumed by the next
+cmssh session, files which were already transferred and verified are
+skipped and finished transfers are kept as history. It is configured via
+environment:
+
+- CMSSH_TRANSFER_LIMIT, number of concurrent transfers, default is 3
+- CMSSH_SITE_LIMIT, concurrent transfers per source SE, default is 2,
+  xrdcp transfers via XRootD redirector are not bounded by it
+- CMSSH_DST_LIMIT, concurrent transfers per destination, default is
+  CMSSH_TRANSFER_LIMIT
+- CMSSH_TRANSFER_RETRIES, number of retries of a file, default is 2
+- CMSSH_TRANSFER_METHOD, preferred (first) transfer method
+- CMSSH_JOURNAL, transfer journal, default is ~/.cmssh/transfers.log
+- CMSSH_JOURNAL_SIZE, number of finished transfers kept in the journal,
+  default is 1000
+"""
+
+# system modules
+import os
+import json
+import errno
+import time
+import fcntl
+import bisect
+import signal
+import fnmatch
+import itertools
+import tempfile
+import threading
+
+# cmssh modules
+from   cmssh import dbs2
+from   cmssh.iprint import print_info, print_warning, print_error, print_status
+from   cmssh.utils import size_format
+from   cmssh.url_utils import get_data
+from   cmssh.cms_urls import dbs_url
+from   cmssh.regex import pat_dataset, pat_block, pat_lfn, pat_se
+from   cmssh.filemover import FM_SINGLETON, PFNMGR, SRM_SIZES, TransferCmd
+from   cmssh.filemover import CHECKSUMS, check_file, in_place, verify_checksum
+from   cmssh.filemover import resume_cmd, partial_file
+from   cmssh.sources import SOURCES, XRD_REDIRECTOR, source_key
+
+# DBS3 files API parameters for supported look-up keys
+DBS3_KEYS = {'dataset': 'dataset', 'block': 'block_name',
+             'file': 'logical_file_name'}
+
+def dbs_files(key, value, verbose=None):
+    "Return list of LFNs of given dataset, block or LFN pattern"
+    if  dbs_url().find('cmsdbsprod') != -1: # DBS2
+        return dbs2.file_names(key, value)
+    # detailed records carry checksums used to verify transferred files
+    params = {DBS3_KEYS[key]: value, 'detail': 'True'}
+    result = get_data(dbs_url('files'), params, verbose=verbose)
+    CHECKSUMS.update(result)
+    return [row['logical_file_name'] for row in result]
+
+def lfn_list(arg, verbose=None):
+    """
+    Return list of LFNs for given cp source, i.e. dataset, block,
+    @file with list of LFNs, LFN pattern or single LFN
+    """
+    arg = arg.strip()
+    if  arg.startswith('@'):
+        lfns = []
+        with open(os.path.expanduser(arg[1:])) as stream:
+            for line in stream:
+                line = line.strip()
+                if  line and not line.startswith('#'):
+                    lfns.append(line.replace('file=', ''))
+        return lfns
+    if  arg.startswith('block=') or pat_block.match(arg):
+        return dbs_files('block', arg.replace('block=', ''), verbose)
+    if  arg.startswith('dataset='):
+        return dbs_files('dataset', arg.replace('dataset=', ''), verbose)
+    arg = arg.replace('file=', '')
+    if  arg.find('*') != -1 or arg.find('?') != -1:
+        # DBS only knows * wildcard, the pattern is applied afterwards
+        lfns = dbs_files('file', arg.replace('?', '*'), verbose)
+        return [lfn for lfn in lfns if fnmatch.fnmatchcase(lfn, arg)]
+    if  pat_dataset.match(arg) and not pat_lfn.match(arg):
+        return dbs_files('dataset', arg, verbose)
+    return [arg]
+
+def multi_source(arg):
+    "Check if given cp source refers to multiple files"
+    arg = arg.strip()
+    if  arg.startswith('@') or arg.startswith('dataset=') \
+        or arg.startswith('block=') or pat_block.match(arg):
+        return True
+    if  arg.find('*') != -1 or arg.find('?') != -1:
+        return True
+    return bool(pat_dataset.match(arg) and not pat_lfn.match(arg))
+
+def dst_key(dst):
+    "Return destination key of given cp destination"
+    if  pat_se.match(dst):
+        return dst.replace('site=', '').split(':')[0]
+    return 'local'
+
+def rate(nbytes, elapsed):
+    "Format transfer rate"
+    if  not elapsed:
+        return 'N/A'
+    return '%s/s' % size_format(nbytes/elapsed)
+
+class TransferJob(object):
+    "Transfer of single LFN"
+    def __init__(self, jid, lfn, dst, verbose=0, priority=0):
+        self.jid     = jid
+        self.priority = priority
+        self.lfn     = lfn
+        self.dst     = dst
+        self.dkey    = dst_key(dst)
+        self.verbose = verbose
+        self.status  = 'waiting'
+        self.method  = None
+        self.source  = None
+        self.size    = 0
+        self.tries   = 0
+        self.error   = ''
+        self.start   = None
+        self.end     = None
+        self.proc    = None # running transfer command
+        self.progress = None # progress of running transfer in percents
+        self.abort   = threading.Event()
+        self.restored = False # finished job of previous session
+
+    def record(self):
+        "Return journal record of the job"
+        return dict((key, getattr(self, key)) for key in JOURNAL_KEYS)
+
+    @classmethod
+    def from_record(cls, rec):
+        "Create job from its journal record"
+        job = cls(rec['jid'], rec['lfn'], rec['dst'])
+        for key in JOURNAL_KEYS:
+            setattr(job, key, rec.get(key, getattr(job, key)))
+        return job
+
+    def finished(self):
+        "Check if job is finished"
+        return self.status in ['done', 'fail', 'cancelled']
+
+    def elapsed(self):
+        "Return transfer time"
+        if  not self.start:
+            return 0
+        return (self.end or time.time()) - self.start
+
+    def __str__(self):
+        if  self.status == 'done':
+            return '%4d %s, %s via %s from %s (%s, %s)' \
+                % (self.jid, self.lfn, self.status, self.method, self.source,
+                   size_format(self.size), rate(self.size, self.elapsed()))
+        if  self.error:
+            return '%4d %s, %s: %s' % (self.jid, self.lfn, self.status, self.error)
+        return '%4d %s, %s' % (self.jid, self.lfn, self.status)
+
+# job attributes kept in the journal
+JOURNAL_KEYS = ['jid', 'lfn', 'dst', 'priority', 'status', 'method', 'source',
+                'size', 'tries', 'error', 'start', 'end']
+
+class TransferJournal(object):
+    """
+    Append-only journal of transfer jobs, every line is JSON record of a
+    job state, the last record of a job wins. Journal is owned by single
+    cmssh session (the first one which loads it), other sessions run
+    without journal.
+    """
+    def __init__(self, fname=None, size=None):
+        if  not fname:
+            fname = os.environ.get('CMSSH_JOURNAL', \
+                    os.path.join(os.environ['HOME'], '.cmssh', 'transfers.log'))
+        self.fname  = fname
+        self.size   = int(size or os.environ.get('CMSSH_JOURNAL_SIZE', 1000))
+        self.owner  = None # lock file of the session which owns the journal
+        self.stream = None
+
+    def acquire(self):
+        "Take ownership of the journal, return False if other session owns it"
+        if  self.owner:
+            return True
+        try:
+            fdir = os.path.dirname(self.fname)
+            if  not os.path.isdir(fdir):
+                os.makedirs(fdir, 0700)
+            owner = open(self.fname + '.lock', 'a')
+        except (IOError, OSError):
+            return False
+        try:
+            fcntl.flock(owner, fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except IOError:
+            owner.close()
+            return False
+        self.owner = owner
+        return True
+
+    def load(self):
+        "Return list of the last records of journaled jobs ordered by id"
+        records = {}
+        try:
+            with open(self.fname) as stream:
+                for line in stream:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue # partially written record
+                    records[rec['jid']] = rec
+        except IOError:
+            pass
+        return [records[jid] for jid in sorted(records)]
+
+    def compact(self, records):
+        """
+        Atomically rewrite journal with given records, only the last
+        finished records are kept
+        """
+        pending  = [r for r in records if r['status'] in ['waiting', 'running']]
+        finished = [r for r in records if r not in pending][-self.size:]
+        keep = sorted(pending + finished, key=lambda r: r['jid'])
+        try:
+            fdes, tmp = tempfile.mkstemp(suffix='.tmp', \
+                    dir=os.path.dirname(self.fname))
+            with os.fdopen(fdes, 'w') as stream:
+                for rec in keep:
+                    stream.write(json.dumps(rec) + '\n')
+            os.rename(tmp, self.fname)
+        except (IOError, OSError):
+            pass
+        return keep
+
+    def record(self, job):
+        "Append state of given job, it is no-op unless journal is owned"
+        if  not self.owner:
+            return
+        try:
+            if  not self.stream:
+                self.stream = open(self.fname, 'a')
+            self.stream.write(json.dumps(job.record()) + '\n')
+            self.stream.flush()
+        except (IOError, OSError):
+            pass # journal is not essential for transfers
+
+class TransferEngine(object):
+    """
+    Transfer engine. Worker threads sleep on condition variable and
+    take the highest priority job from the queue as soon as destination
+    of the job has free slot, source SE slots are acquired for every
+    transfer attempt. Jobs of the same priority are served in order of
+    submission. Workers are started on first submission. All job state
+    changes are done under the engine lock and journaled.
+    """
+    def __init__(self, workers=None, site_limit=None, dst_limit=None,
+            retries=None, journal=None):
+        self.workers    = int(workers or \
+                os.environ.get('CMSSH_TRANSFER_LIMIT', 3))
+        self.site_limit = int(site_limit or \
+                os.environ.get('CMSSH_SITE_LIMIT', 2))
+        self.dst_limit  = int(dst_limit or \
+                os.environ.get('CMSSH_DST_LIMIT', self.workers))
+        if  retries is None:
+            retries = os.environ.get('CMSSH_TRANSFER_RETRIES', 2)
+        self.retries = int(retries)
+        self.cond    = threading.Condition()
+        self.queue   = []      # sorted (-priority, id, job) of waiting jobs
+        self.jobs    = []      # all submitted jobs
+        self.ids     = itertools.count(1)
+        self.active  = {}      # source/destination key => running transfers
+        self.threads = []
+        self.journal = journal or TransferJournal()
+        self.verified = {}     # (lfn, dst) => size of transferred files
+        self.restored = False  # journal has been loaded
+
+    def methods(self):
+        "Return list of transfer methods in fallback order"
+        methods = ['xrdcp']
+        if  os.environ.get('LCG_CP', ''):
+            methods.append('lcgcp')
+        methods.append('srmcp')
+        first = os.environ.get('CMSSH_TRANSFER_METHOD', 'xrdcp')
+        if  first in methods:
+            methods.remove(first)
+            methods.insert(0, first)
+        return methods
+
+    def submit(self, lfns, dst, verbose=0, priority=0):
+        "Submit transfers of given LFNs to given destination"
+        if  not self.restored:
+            self.restore()
+        with self.cond:
+            jobs = [TransferJob(self.ids.next(), lfn, dst, verbose, priority) \
+                    for lfn in lfns]
+            self.jobs += jobs
+            for job in jobs:
+                self.queue.append((-priority, job.jid, job))
+                self.journal.record(job)
+            self.queue.sort()
+            self.start_workers()
+            self.cond.notify_all()
+        return jobs
+
+    def start_workers(self):
+        "Start worker threads, the lock must be held"
+        while len(self.threads) < self.workers:
+            thr = threading.Thread(target=self.worker)
+            thr.daemon = True
+            thr.start()
+            self.threads.append(thr)
+
+    def restore(self):
+        """
+        Restore jobs of previous sessions from the journal, finished jobs
+        are kept as history and pending ones are put back into the queue.
+        Return list of resumed jobs.
+        """
+        if  self.restored:
+            return []
+        self.restored = True
+        if  not self.journal.acquire():
+            print_warning('Transfer journal %s is used by another session' \
+                    % self.journal.fname)
+            return []
+        records = self.journal.compact(self.journal.load())
+        resumed = []
+        with self.cond:
+            for rec in records:
+                job = TransferJob.from_record(rec)
+                if  job.status == 'done':
+                    self.verified[(job.lfn, job.dst)] = job.size
+                if  job.finished():
+                    job.restored = True
+                else:
+                    job.status = 'waiting'
+                    job.start  = None
+                    self.queue.append((-job.priority, job.jid, job))
+                    resumed.append(job)
+                self.jobs.append(job)
+            if  records:
+                self.ids = itertools.count(records[-1]['jid'] + 1)
+            self.queue.sort()
+            if  resumed:
+                self.start_workers()
+                self.cond.notify_all()
+        return resumed
+
+    def is_verified(self, lfn, dst):
+        """
+        Check if given LFN was already transferred and verified to given
+        destination, local file should still be in place
+        """
+        with self.cond:
+            size = self.verified.get((lfn, dst))
+        if  size is None:
+            return False
+        if  dst_key(dst) != 'local':
+            return True
+        fname = os.path.join(dst, lfn.split('/')[-1]) \
+                if os.path.isdir(dst) else dst
+        return os.path.isfile(fname) and os.path.getsize(fname) == size
+
+    def dequeue(self, job):
+        "Remove given waiting job from the queue, the lock must be held"
+        self.queue.remove((-job.priority, job.jid, job))
+
+    def cancel(self, jobs):
+        """
+        Cancel given jobs, running transfer commands are killed.
+        Return number of cancelled jobs.
+        """
+        ncancel = 0
+        with self.cond:
+            for job in jobs:
+                if  job.status == 'waiting':
+                    self.dequeue(job)
+                    job.status = 'cancelled'
+                    self.journal.record(job)
+                elif job.status == 'running':
+                    job.abort.set()
+                    if  job.proc and job.proc.poll() is None:
+                        # kill the shell along with the tool it runs
+                        try:
+                            os.killpg(job.proc.pid, signal.SIGTERM)
+                        except OSError as exc:
+                            if  exc.errno != errno.ESRCH: # already exited
+                                raise
+                else:
+                    continue
+                ncancel += 1
+            self.cond.notify_all()
+        return ncancel
+
+    def reprioritize(self, jobs, priority):
+        "Change priority of given waiting jobs"
+        with self.cond:
+            for job in jobs:
+                if  job.status == 'waiting':
+                    self.dequeue(job)
+                    job.priority = priority
+                    bisect.insort(self.queue, (-priority, job.jid, job))
+                    self.journal.record(job)
+            self.cond.notify_all()
+
+    def find(self, ids=None):
+        "Return list of jobs with given ids, or all jobs"
+        with self.cond:
+            if  ids is None:
+                return list(self.jobs)
+            return [job for job in self.jobs if job.jid in ids]
+
+    def snapshot(self):
+        "Return consistent copy of jobs state as list of dicts"
+        with self.cond:
+            return [dict(job.__dict__, elapsed=job.elapsed()) \
+                    for job in self.jobs]
+
+    def wait(self, jobs):
+        "Yield given jobs as they finish"
+        pending = list(jobs)
+        while pending:
+            with self.cond:
+                finished = [job for job in pending if job.finished()]
+                if  not finished:
+                    # timeout keeps the caller responsive to Ctrl-C
+                    self.cond.wait(1)
+                    continue
+            for job in finished:
+                pending.remove(job)
+                yield job
+
+    def next_job(self):
+        "Wait for a job whose destination has free slot and take it"
+        with self.cond:
+            while True:
+                for item in self.queue:
+                    job = item[-1]
+                    if  self.active.get(job.dkey, 0) < self.dst_limit:
+                        self.queue.remove(item)
+                        self.active[job.dkey] = self.active.get(job.dkey, 0) + 1
+                        job.status = 'running'
+                        job.start  = time.time()
+                        self.journal.record(job)
+                        return job
+                self.cond.wait()
+
+    def acquire(self, key, job):
+        "Wait for free slot of given source SE, return False if job is aborted"
+        with self.cond:
+            while self.active.get(key, 0) >= self.site_limit:
+                if  job.abort.is_set():
+                    return False
+                self.cond.wait()
+            self.active[key] = self.active.get(key, 0) + 1
+        return True
+
+    def release(self, key):
+        "Release slot of given source SE or destination"
+        with self.cond:
+            self.active[key] -= 1
+            self.cond.notify_all()
+
+    def worker(self):
+        "Worker thread"
+        while True:
+            job = self.next_job()
+            try:
+                status = self.run(job)
+            except Exception as exc:
+                job.error = str(exc).strip()
+                status = 'fail'
+            with self.cond:
+                job.end = time.time()
+                job.status = 'cancelled' if job.abort.is_set() else status
+                if  job.status == 'done':
+                    self.verified[(job.lfn, job.dst)] = job.size
+                self.journal.record(job)
+            self.release(job.dkey)
+
+    def commands(self, job):
+        "Return list of (method, cmd, pfn, dst, source) transfer attempts"
+        cmds = []
+        seen = set()
+        names = ['xrdcp', 'lcgcp', 'srmcp']
+        cands = [c for c in FM_SINGLETON.transfer_cmds(job.lfn, job.dst, job.verbose)]
+        for method in self.methods():
+            for cand in cands:
+                cmd, pfn, pdst = cand[names.index(method)], cand[3], cand[4]
+                if  not cmd or cmd in seen:
+                    continue
+                seen.add(cmd)
+                if  method == 'xrdcp':
+                    source = XRD_REDIRECTOR
+                else:
+                    source = source_key(pfn)
+                cmds.append((method, cmd, pfn, pdst, source))
+        return cmds
+
+    def execute(self, job, cmd, pfn, pdst):
+        """
+        Execute transfer command of given job unless destination file
+        is already in place, return check_file status or None if
+        checksum of transferred file does not match
+        """
+        status = in_place(pfn, pdst, job.verbose)
+        if  status:
+            if  not verify_checksum(job.lfn, pdst, verbose=job.verbose):
+                return None
+            return status
+        if  job.verbose:
+            print_info(cmd)
+        tcmd = TransferCmd(cmd, pdst, SRM_SIZES.get(pfn))
+        with self.cond:
+            job.proc = tcmd.start(preexec_fn=os.setsid)
+        def progress(value):
+            "Update job progress"
+            job.progress = value
+        tcmd.wait(progress)
+        with self.cond:
+            job.proc = None
+            job.progress = None
+        if  job.verbose:
+            print_info('Output of %s' % cmd)
+            print tcmd.stdout()
+        if  job.abort.is_set():
+            return False
+        status = check_file(pfn, pdst, job.verbose)
+        if  status and not verify_checksum(job.lfn, pdst, tcmd.reader, job.verbose):
+            return None
+        return status
+
+    def run(self, job):
+        "Transfer given job, return its final status"
+        for attempt in xrange(self.retries + 1):
+            if  attempt:
+                job.abort.wait(min(60, 5 * 2**(attempt-1)))
+            if  job.abort.is_set():
+                return 'cancelled'
+            job.tries += 1
+            try:
+                cmds = self.commands(job)
+            except Exception as exc: # e.g. no replicas were found
+                job.error = str(exc).strip().split('\n')[-1]
+                continue
+            if  not cmds:
+                job.error = 'no transfer method is available'
+            for method, cmd, pfn, pdst, source in cmds:
+                # real source of redirected xrdcp is not known, it is not
+                # bounded by per-site limit
+                skey = None if source == XRD_REDIRECTOR else source
+                if  skey and not self.acquire(skey, job):
+                    return 'cancelled'
+                tstart = time.time()
+                try:
+                    status = self.execute(job, cmd, pfn, pdst)
+                    rcmd = resume_cmd(cmd, pdst)
+                    if  status is False and rcmd and not job.abort.is_set():
+                        # resume partially downloaded file before fallback
+                        status = self.execute(job, rcmd, pfn, pdst)
+                finally:
+                    if  skey:
+                        self.release(skey)
+                if  job.abort.is_set():
+                    return 'cancelled'
+                SOURCES.record(source, bool(status), \
+                        status[1] if status else 0, time.time() - tstart)
+                if  status:
+                    job.method = method
+                    job.source = source
+                    job.size   = status[1]
+                    job.error  = ''
+                    return 'done'
+                if  status is None:
+                    job.error = '%s from %s, checksum mismatch' % (method, source)
+                else:
+                    job.error = '%s from %s failed' % (method, source)
+        return 'fail'
+
+    def summary(self, jobs=None):
+        "Return summary of given (or all jobs of this session)"
+        if  jobs is None:
+            with self.cond:
+                jobs = [job for job in self.jobs if not job.restored]
+        counts = {}
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        done   = [job for job in jobs if job.status == 'done']
+        nbytes = sum(job.size for job in done)
+        starts = [job.start for job in jobs if job.start]
+        ends   = [job.end or time.time() for job in jobs if job.start]
+        elapsed = max(ends) - min(starts) if starts else 0
+        msg  = '%s files: ' % len(jobs)
+        msg += ', '.join('%s %s' % (counts[s], s) for s in sorted(counts))
+        msg += '; %s in %.1f sec, %s' \
+                % (size_format(nbytes), elapsed, rate(nbytes, elapsed))
+        return msg
+
+# Singleton
+TRANSFERS = TransferEngine()
+
+def resume_jobs():
+    "Resume pending transfers of previous sessions"
+    jobs = TRANSFERS.restore()
+    if  jobs:
+        print_info('%s pending transfer(s) are resumed, see jobs command' \
+                % len(jobs))
+
+def copy_files(src, dst, verbose=0, background=False, overwrite=False,
+        priority=None):
+    """
+    Copy files of given dataset, block, file list, LFN pattern or single
+    LFN to given destination. Single file copies have higher priority
+    than bulk ones by default.
+    """
+    multi = multi_source(src)
+    if  multi and not pat_se.match(dst) and not os.path.isdir(dst):
+        print_error('Destination %s is not a directory' % dst)
+        return 'fail'
+    if  priority is None:
+        priority = 0 if multi else 1
+    resume_jobs() # journal of previous sessions is loaded once
+    lfns = []
+    nskip = 0
+    for lfn in lfn_list(src, verbose):
+        if  not overwrite and TRANSFERS.is_verified(lfn, dst):
+            nskip += 1
+            continue
+        fname = dst
+        if  os.path.isdir(dst):
+            fname = os.path.join(dst, lfn.split('/')[-1])
+        if  dst_key(dst) == 'local' and os.path.isfile(fname):
+            if  overwrite:
+                os.remove(fname)
+            elif not partial_file(lfn, fname, verbose): # partial one is resumed
+                print_warning('File %s already exists' % fname)
+                continue
+        lfns.append(lfn)
+    if  nskip:
+        print_info('%s file(s) were already transferred, skipped' % nskip)
+    if  not lfns:
+        print_warning('No files to copy for %s' % src)
+        return 'fail'
+    # resolve replicas and PFNs of all files in a few requests, local
+    # files (uploads) have no replicas
+    PFNMGR.prefetch([l for l in lfns if not os.path.isfile(l)], verbose)
+    jobs = TRANSFERS.submit(lfns, dst, verbose, priority)
+    if  background:
+        print_info('%s transfer(s) queued, see jobs command' % len(jobs))
+        return 'accepted'
+    try:
+        for idx, job in enumerate(TRANSFERS.wait(jobs)):
+            print '[%s/%s] %s' % (idx+1, len(jobs), job)
+    except KeyboardInterrupt:
+        ncancel = TRANSFERS.cancel(jobs)
+        print_warning('%s waiting transfers are cancelled' % ncancel)
+    print_info(TRANSFERS.summary(jobs))
+    if  [job for job in jobs if job.status != 'done']:
+        return 'fail'
+    return 'success'
+
+def dqueue(arg=None):
+    "Print status of transfer queue, arg can be list"
+    states = [('running', 'In progress'), ('waiting', 'Waiting    '),
+              ('done', 'Finished   '), ('fail', 'Failed     '),
+              ('cancelled', 'Cancelled  ')]
+    jobs = TRANSFERS.snapshot()
+    for state, title in states:
+        rows = [job for job in jobs if job['status'] == state]
+        print "%s: %s jobs" % (title, len(rows))
+        if  arg and arg == 'list':
+            for job in rows:
+                msg = '%4d %s => %s' % (job['jid'], job['lfn'], job['dst'])
+                if  state == 'waiting':
+                    msg += ', priority %s' % job['priority']
+                elif state == 'running' and job['progress'] is not None:
+                    msg += ', %d%%' % job['progress']
+                elif state == 'done':
+                    msg += ', %s in %.1f sec' \
+                        % (size_format(job['size']), job['elapsed'])
+                if  job['restored'] and job['end']:
+                    msg += ', %s' % time.strftime('%Y-%m-%d %H:%M', \
+                            time.localtime(job['end']))
+                elif job['error']:
+                    msg += ', %s' % job['error']
+                print msg
+            if  rows:
+                print
+    if  [job for job in jobs if not job['restored']]:
+        print_info(TRANSFERS.summary())
+
+def job_ids(arg):
+    "Parse comma separated list of job ids, all stands for all jobs"
+    if  arg.strip() == 'all':
+        return None
+    return set(int(jid) for jid in arg.replace(',', ' ').split())
+
+def cancel_jobs(arg):
+    "Cancel transfer jobs with given ids"
+    ncancel = TRANSFERS.cancel(TRANSFERS.find(job_ids(arg)))
+    print_status('%s job(s) cancelled' % ncancel)
+
+def top_jobs(arg):
+    "Move transfer jobs with given ids to the head of the queue"
+    jobs = TRANSFERS.find(job_ids(arg))
+    with TRANSFERS.cond:
+        top = max([job.priority for job in TRANSFERS.jobs] + [0]) + 1
+    TRANSFERS.reprioritize(jobs, top)
+    print_status('%s job(s) moved to priority %s' % (len(jobs), top))
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+
+"""
+Persistent (on-disk) cache of HTTP responses used by url_utils.get_data.
+Every entry consists of raw response body and its meta-data (JSON) file.
+Entries are keyed by URL, request parameters and DBS instance, they
+expire according to per-service TTL and afterwards are re-validated
+via ETag/Last-Modified headers if service provided them. The total size
+of the cache is bounded, least recently used entries are evicted first.
+Cache is configured via environment:
+
+- CMSSH_CACHE, set to 0 to disable the cache
+- CMSSH_CACHE_DIR, cache location, default is ~/.cmssh/cache
+- CMSSH_CACHE_SIZE, max size of the cache in MB, default is 256
+"""
+
+# system modules
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from cStringIO import StringIO
+
+# cmssh modules
+from cmssh.utils import size_format
+
+# TTL (in sec) of cached responses, the first matched URL pattern wins,
+# services which are not listed here are not cached (e.g. SiteDB, whose
+# snapshot is kept and refreshed by sitedb module)
+CACHE_TTL = [
+    ('/phedex/datasvc/json/prod/lfn2pfn', 24*60*60),
+    ('/phedex/datasvc/json/prod/tfc', 24*60*60),
+    ('/phedex/datasvc/json/prod/nodes', 24*60*60),
+    ('/phedex/datasvc/json/prod/', 10*60),
+    ('/DBSReader/', 30*60),
+    ('cmssdt.cern.ch/tc/', 24*60*60),
+    ('cms-conddb.cern.ch', 60*60),
+]
+
+class CacheWriter(object):
+    """
+    File-like wrapper around HTTP response body which copies data into
+    the cache while the body is read. Entry is committed to the cache
+    once the whole body has been read.
+    """
+    def __init__(self, cache, meta, fdesc, chunk=65536):
+        self.cache = cache
+        self.meta  = meta
+        self.fdesc = fdesc
+        self.chunk = chunk
+        self.eof   = False
+        fdes, self.tmp = tempfile.mkstemp(suffix='.tmp', dir=cache.cdir)
+        self.stream = os.fdopen(fdes, 'wb')
+
+    def read(self, size=-1):
+        "Read up to size bytes of response body"
+        data = self.fdesc.read(size)
+        if  data:
+            self.stream.write(data)
+        if  not data or size < 0:
+            self.eof = True
+        return data
+
+    def close(self):
+        """
+        Close the response and commit cache entry. A small remainder of
+        the body which was not read by the consumer, e.g. trailing keys
+        of JSON document, is read here, otherwise entry is discarded.
+        """
+        if  not self.stream:
+            return
+        drained = 0
+        while not self.eof and drained <= self.chunk:
+            drained += len(self.read(self.chunk))
+        self.fdesc.close()
+        self.stream.close()
+        self.stream = None
+        if  self.eof:
+            self.cache.commit(self.meta, self.tmp)
+        else:
+            os.remove(self.tmp)
+
+    def __del__(self):
+        if  self.stream:
+            self.stream.close()
+            if  os.path.isfile(self.tmp):
+                os.remove(self.tmp)
+
+class ResponseCache(object):
+    "On-disk cache of HTTP responses"
+    def __init__(self, cdir=None, size=None):
+        if  not cdir:
+            cdir = os.environ.get('CMSSH_CACHE_DIR', \
+                    os.path.join(os.environ['HOME'], '.cmssh', 'cache'))
+        if  not size:
+            size = int(os.environ.get('CMSSH_CACHE_SIZE', 256))
+        self.cdir  = cdir
+        self.size  = size*1024*1024
+        self.lock  = threading.Lock()
+        self.hits  = 0
+        self.miss  = 0
+        self.valid = 0 # number of successfully re-validated entries
+
+    def enabled(self):
+        "Check if cache is enabled"
+        return bool(int(os.environ.get('CMSSH_CACHE', 1)))
+
+    def ttl(self, url):
+        "Return TTL for given url, zero means that url is not cached"
+        if  not self.enabled():
+            return 0
+        for pat, ttl in CACHE_TTL:
+            if  url.find(pat) != -1:
+                return ttl
+        return 0
+
+    def key(self, url, params):
+        "Return cache key for given url/params"
+        inst = os.environ.get('DBS_INSTANCE', '')
+        data = json.dumps([url, params, inst], sort_keys=True)
+        return hashlib.sha1(data).hexdigest()
+
+    def path(self, key, ext):
+        "Return path to entry file with given key and extension"
+        return os.path.join(self.cdir, key + ext)
+
+    def count(self, attr):
+        "Increment given counter"
+        with self.lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def lookup(self, url, params):
+        "Look-up cache entry for given url/params, return its meta-data"
+        key = self.key(url, params)
+        if  not os.path.isfile(self.path(key, '.data')):
+            return None
+        return self.lookup_key(key)
+
+    def fresh(self, meta):
+        "Check if given entry did not expire yet"
+        return meta['expire'] > time.time()
+
+    def validators(self, meta):
+        "Return conditional request headers for given entry"
+        headers = {}
+        if  meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if  meta.get('modified'):
+            headers['If-Modified-Since'] = meta['modified']
+        return headers
+
+    def open(self, meta):
+        "Open body of given entry and mark it as recently used"
+        fname = self.path(meta['key'], '.data')
+        os.utime(fname, None)
+        return open(fname, 'rb')
+
+    def new(self, url, params, headers):
+        "Create meta-data of new entry for given response headers"
+        return {'key': self.key(url, params), 'url': url, 'params': params,
+                'created': time.time(), 'expire': time.time() + self.ttl(url),
+                'etag': headers.get('etag'),
+                'modified': headers.get('last-modified')}
+
+    def writer(self, url, params, headers, fdesc):
+        "Return file-like object which reads given response into the cache"
+        if  not os.path.isdir(self.cdir):
+            os.makedirs(self.cdir, 0700)
+        return CacheWriter(self, self.new(url, params, headers), fdesc)
+
+    def store(self, url, params, data, headers=None):
+        "Store given response body in the cache"
+        fdesc = self.writer(url, params, headers or {}, StringIO(data))
+        fdesc.read()
+        fdesc.close()
+
+    def refresh(self, meta, headers):
+        "Update expiration time (and validators) of re-validated entry"
+        meta['expire'] = time.time() + self.ttl(meta['url'])
+        if  headers.get('etag'):
+            meta['etag'] = headers['etag']
+        if  headers.get('last-modified'):
+            meta['modified'] = headers['last-modified']
+        self.write_meta(meta)
+        self.count('valid')
+
+    def write_meta(self, meta):
+        "Atomically write meta-data file of given entry"
+        fdes, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.cdir)
+        with os.fdopen(fdes, 'w') as stream:
+            json.dump(meta, stream)
+        os.rename(tmp, self.path(meta['key'], '.json'))
+
+    def commit(self, meta, tmp):
+        "Move downloaded body into the cache and evict old entries"
+        meta['size'] = os.path.getsize(tmp)
+        os.rename(tmp, self.path(meta['key'], '.data'))
+        self.write_meta(meta)
+        self.evict()
+
+    def remove(self, key):
+        "Remove entry with given key"
+        for ext in ['.json', '.data']:
+            try:
+                os.remove(self.path(key, ext))
+            except OSError:
+                pass
+
+    def entries(self):
+        "Return list of (last access, size, key) of all cache entries"
+        if  not os.path.isdir(self.cdir):
+            return []
+        res = []
+        now = time.time()
+        for name in os.listdir(self.cdir):
+            fname = os.path.join(self.cdir, name)
+            try:
+                fstat = os.stat(fname)
+            except OSError:
+                continue
+            if  name.endswith('.data'):
+                res.append((fstat.st_mtime, fstat.st_size, name[:-5]))
+            elif name.endswith('.tmp') and now - fstat.st_mtime > 60*60:
+                try: # left over of interrupted download
+                    os.remove(fname)
+                except OSError:
+                    pass
+        return res
+
+    def evict(self):
+        "Remove least recently used entries which do not fit into the cache"
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if  total <= self.size:
+                break
+            self.remove(key)
+            total -= size
+
+    def clear(self, pattern=None):
+        "Remove entries whose URL contains given pattern, or all of them"
+        for _, _, key in self.entries():
+            if  pattern:
+                meta = self.lookup_key(key)
+                if  meta and meta['url'].find(pattern) == -1:
+                    continue
+            self.remove(key)
+
+    def lookup_key(self, key):
+        "Return meta-data of entry with given key"
+        try:
+            with open(self.path(key, '.json')) as stream:
+                return json.load(stream)
+        except (IOError, ValueError):
+            return None
+
+    def listing(self):
+        "Yield meta-data of cache entries in most recently used order"
+        for _, _, key in sorted(self.entries(), reverse=True):
+            meta = self.lookup_key(key)
+            if  meta:
+                yield meta
+
+    def __str__(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        return '%s: %s entries, %s out of %s, hits %s, misses %s, re-validated %s' \
+            % (self.cdir, len(entries), size_format(total),
+               size_format(self.size), self.hits, self.miss, self.valid)
+
+# Singleton
+HTTP_CACHE = ResponseCache()
@@ -8,60 +8,302 @@ URL utils
 # system modules
 import os
 import json
+import time
 import urllib
 import urllib2
+import threading
 import subprocess
+from cStringIO import StringIO
 from contextlib import contextmanager
 
 # cmssh modules
 from cmssh.iprint import print_info, print_warning, print_error
+from cmssh.utils import json_stream_parser
 from cmssh.auth_utils import PEMMGR, working_pem
-from cmssh.auth_utils import get_key_cert, HTTPSClientAuthHandler
+from cmssh.auth_utils import get_key_cert, get_opener
+from cmssh.url_cache import HTTP_CACHE
+from cmssh.metrics import METRICS
 try:
     from cmssh.pycurl_manager import RequestHandler
 except:
-    pass
+    RequestHandler = None
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent identical calls. The first caller for given key
+    performs the call, while others wait for it and share its result
+    (or exception).
+    """
+    def __init__(self):
+        self.lock  = threading.Lock()
+        self.calls = {} # key => (event, [result, error])
+
+    def call(self, key, func, *args):
+        "Call given function unless identical call is already in flight"
+        with self.lock:
+            leader = key not in self.calls
+            if  leader:
+                self.calls[key] = (threading.Event(), [None, None])
+            event, res = self.calls[key]
+        if  not leader:
+            while not event.wait(0.1): # wait with timeout to allow Ctrl-C
+                pass
+            if  res[1]:
+                raise res[1]
+            return res[0]
+        try:
+            res[0] = func(*args)
+        except Exception as exc:
+            res[1] = exc
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            event.set()
+        return res[0]
+
+# Singleton
+INFLIGHT = SingleFlight()
 
 def get_data(url, kwargs=None, headers=None,
-        verbose=None, decoder='json', post=False):
-    "Retrive data"
+        verbose=None, decoder='json', post=False, jpath=None):
+    """
+    Retrive data. Supported decoders are json, jsonstream and None (raw
+    data). The jsonstream decoder returns generator over elements of
+    JSON array located at given jpath (dot-separated keys, e.g.
+    phedex.block), which are decoded as response body arrives.
+    Responses of services listed in url_cache.CACHE_TTL are served
+    through on-disk response cache. Concurrent identical GET requests
+    (same url, parameters and credentials) share single fetch of the
+    raw data, which is decoded by every caller on its own since
+    callers may modify decoded data.
+    """
     if  not headers and url.find('DBSReader') != -1:
         headers =  {'Accept': 'application/json' } # DBS3 always needs that
+    if  not kwargs:
+        kwargs = {}
+    if  post or decoder == 'jsonstream':
+        return fetch_data(url, kwargs, headers, verbose, decoder, post, jpath)
+    cert = os.path.join(os.environ['HOME'], '.globus/usercert.pem')
+    key  = (url, json.dumps(kwargs, sort_keys=True),
+            json.dumps(headers, sort_keys=True),
+            os.environ.get('DBS_INSTANCE'), cert, hash(PEMMGR.pem))
+    time0 = time.time()
+    leader = []
+    def fetch():
+        "Fetch raw data, executed by the first caller only"
+        leader.append(1)
+        return fetch_data(url, kwargs, headers, verbose, None)
+    data = INFLIGHT.call(key, fetch)
+    if  not leader:
+        METRICS.record(url, time.time() - time0, nbytes=len(data),
+                cache='shared')
+    if  decoder == 'json':
+        return json.loads(data)
+    return data
+
+def fetch_data(url, kwargs, headers=None,
+        verbose=None, decoder='json', post=False, jpath=None):
+    """
+    Retrieve data either from response cache or from data-service.
+    The jsonstream decoder returns generator of records, its failure
+    before the first record falls back to urllib as well, while failure
+    in the middle of the stream is raised to the caller since consumed
+    records can't be taken back.
+    """
+    if  not post and HTTP_CACHE.ttl(url):
+        return get_data_cached(url, kwargs, headers, verbose, decoder, jpath)
     ckey = None
     cert = os.path.join(os.environ['HOME'], '.globus/usercert.pem')
+    def fallback(exc):
+        "urllib data look-up, fallback mechanism"
+        if  verbose:
+            print_error(exc)
+            msg = 'Fall back to urllib'
+            print_warning(msg)
+        with working_pem(PEMMGR.pem) as ckey:
+            return get_data_helper(url, kwargs, headers,
+                    verbose, decoder, post, ckey, cert, jpath)
     try:
         # pycurl data look-up, primary way to get the data
+        # RequestHandler takes curl handles from process-wide pool,
+        # so connections to the same host/cert are kept alive between calls
         mgr = RequestHandler()
         with working_pem(PEMMGR.pem) as ckey:
+            if  decoder == 'jsonstream':
+                res = mgr.get_stream(url, kwargs, headers, post,
+                        ckey, cert, verbose=verbose)
+                return stream_fallback(json_stream_parser(res, jpath),
+                        fallback)
             res = mgr.get_data(url, kwargs, headers, post, ckey, cert, verbose=verbose)
             if  decoder == 'json':
                 data = json.load(res)
             else:
                 data = res.read()
             return data
+    except Exception as exc:
+        return fallback(exc)
+
+def stream_fallback(gen, fallback):
+    """
+    Yield records of given generator, if it fails before the first
+    record yield records of fallback(exc) call instead
+    """
+    try:
+        first = next(gen)
+    except StopIteration:
+        return
+    except Exception as exc:
+        for row in fallback(exc):
+            yield row
+        return
+    yield first
+    for row in gen:
+        yield row
+
+def get_data_cached(url, kwargs, headers=None, verbose=None,
+        decoder='json', jpath=None):
+    """
+    Retrieve data through on-disk response cache. Fresh entries are read
+    from disk, expired ones are re-validated via ETag/Last-Modified if
+    service provided them, otherwise data is fetched and stored in the
+    cache while it is decoded. If service is not reachable we fall back
+    to expired entry.
+    """
+    time0 = time.time()
+    meta = HTTP_CACHE.lookup(url, kwargs)
+    if  meta and HTTP_CACHE.fresh(meta):
+        HTTP_CACHE.count('hits')
+        fdesc = HTTP_CACHE.open(meta)
+        METRICS.record(url, time.time() - time0, nbytes=meta.get('size', 0),
+                cache='hit')
+        return decode_data(fdesc, decoder, jpath)
+    HTTP_CACHE.count('miss')
+    hdrs = dict(headers) if headers else {}
+    if  meta:
+        hdrs.update(HTTP_CACHE.validators(meta))
+    try:
+        code, rhdrs, fdesc = get_response(url, kwargs, hdrs, verbose)
+    except Exception as exc:
+        if  not meta:
+            raise
+        print_warning('%s, use cached data for %s' % (exc, url))
+        return decode_data(HTTP_CACHE.open(meta), decoder, jpath)
+    if  code == 304:
+        fdesc.close()
+        HTTP_CACHE.refresh(meta, rhdrs)
+        return decode_data(HTTP_CACHE.open(meta), decoder, jpath)
+    fdesc = HTTP_CACHE.writer(url, kwargs, rhdrs, fdesc)
+    return decode_data(fdesc, decoder, jpath)
+
+def get_response(url, kwargs, headers=None, verbose=None):
+    """
+    Open given URL and return (code, headers, fdesc) triplet, where
+    headers is a dict with lower-case keys and fdesc is file-like
+    object which provides response body.
+    """
+    cert = os.path.join(os.environ['HOME'], '.globus/usercert.pem')
+    try:
+        mgr = RequestHandler()
+        with working_pem(PEMMGR.pem) as ckey:
+            res = mgr.get_stream(url, kwargs, headers, ckey=ckey, cert=cert,
+                    verbose=verbose)
+            return res.code, res.info(), res
     except Exception as exc:
         if  verbose:
             print_error(exc)
             msg = 'Fall back to urllib'
             print_warning(msg)
-        # urllib data look-up, fallback mechanism
+    with working_pem(PEMMGR.pem) as ckey:
+        try:
+            res = open_url(url, kwargs, headers, verbose, False, ckey, cert)
+        except urllib2.HTTPError as err:
+            if  err.code != 304:
+                raise
+            res = err
+        headers = dict((key.lower(), val) for key, val in res.info().items())
+        return res.code, headers, res
+
+def decode_data(fdesc, decoder='json', jpath=None):
+    "Decode data from given file-like object with given decoder"
+    if  decoder == 'jsonstream':
+        return json_stream_parser(fdesc, jpath)
+    try:
+        if  decoder == 'json':
+            return json.load(fdesc)
+        return fdesc.read()
+    finally:
+        fdesc.close()
+
+def get_data_multi(requests, headers=None, verbose=None, decoder='json',
+        limit=None):
+    """
+    Retrieve data for given list of (url, params) pairs. Requests are
+    executed concurrently via pycurl CurlMulti interface (no more than
+    limit of them at a time) and yield (url, params, data) tuples in
+    order of their completion. Failed requests are re-tried one by one
+    via get_data, while without pycurl all requests are done serially.
+    Fresh responses are taken from on-disk response cache, and fetched
+    ones are stored there.
+    """
+    requests = [(url, params if params else {}) for url, params in requests]
+    if  not headers and requests and requests[0][0].find('DBSReader') != -1:
+        headers =  {'Accept': 'application/json' } # DBS3 always needs that
+    pending = []
+    for url, params in requests:
+        time0 = time.time()
+        meta = HTTP_CACHE.lookup(url, params) if HTTP_CACHE.ttl(url) else None
+        if  meta and HTTP_CACHE.fresh(meta):
+            HTTP_CACHE.count('hits')
+            fdesc = HTTP_CACHE.open(meta)
+            METRICS.record(url, time.time() - time0,
+                    nbytes=meta.get('size', 0), cache='hit')
+            yield url, params, decode_data(fdesc, decoder)
+        else:
+            pending.append((url, params))
+    cert = os.path.join(os.environ['HOME'], '.globus/usercert.pem')
+    if  not RequestHandler: # pycurl is not available
+        failed = pending
+    else:
+        failed = []
+        mgr = RequestHandler()
         with working_pem(PEMMGR.pem) as ckey:
-            return get_data_helper(url, kwargs, headers,
-                    verbose, decoder, post, ckey, cert)
+            for url, params, data, rhdrs, err in mgr.get_multi(pending, headers,
+                    ckey=ckey, cert=cert, verbose=verbose,
+                    decoder=None, limit=limit):
+                if  err:
+                    if  verbose:
+                        print_error(err)
+                    failed.append((url, params))
+                    continue
+                if  HTTP_CACHE.ttl(url):
+                    HTTP_CACHE.count('miss')
+                    HTTP_CACHE.store(url, params, data, rhdrs)
+                yield url, params, decode_data(StringIO(data), decoder)
+    for url, params in failed:
+        yield url, params, get_data(url, params, headers, verbose, decoder)
 
 def get_data_helper(url, kwargs=None, headers=None,
-        verbose=None, decoder='json', post=False, ckey=None, cert=None):
+        verbose=None, decoder='json', post=False, ckey=None, cert=None,
+        jpath=None):
     """Retrieve data helper function"""
+    res = open_url(url, kwargs, headers, verbose, post, ckey, cert)
+    return decode_data(res, decoder, jpath)
+
+def open_url(url, kwargs=None, headers=None,
+        verbose=None, post=False, ckey=None, cert=None):
+    """
+    Open given url via urllib2 and return its response, request
+    latency (till response headers are received) is recorded in METRICS
+    """
+    base = url
     if  url.find('https') != -1:
         if  not ckey and not cert:
             ckey, cert = get_key_cert()
     else:
         ckey = None
         cert = None
-    if  kwargs:
-        params = kwargs
-    else:
-        params = {}
+    params = dict(kwargs) if kwargs else {}
     if  url.find('/datasets') != -1: # DBS3 use case
         params.update({'dataset_access_type':'PRODUCTION', 'detail':'True'})
     encoded_data = urllib.urlencode(params, doseq=True)
@@ -75,20 +317,25 @@ def get_data_helper(url, kwargs=None, headers=None,
             req.add_header(key, val)
     else:
         headers = {'Accept':'application/json;text/json'}
-    if  cert:
-        handler = HTTPSClientAuthHandler(ckey, cert)
-        opener  = urllib2.build_opener(handler)
-        urllib2.install_opener(opener)
-    if  post:
-        print "POST", req, url, encoded_data, params
-        res = urllib2.urlopen(req, json.dumps(params))
-    else:
-        res = urllib2.urlopen(req)
-    if  decoder == 'json':
-        data = json.load(res)
-    else:
-        data = res.read()
-    return data
+    # cached opener keeps connections alive between calls
+    opener = get_opener(ckey, cert)
+    time0 = time.time()
+    try:
+        if  post:
+            print "POST", req, url, encoded_data, params
+            res = opener.open(req, json.dumps(params))
+        else:
+            res = opener.open(req)
+    except urllib2.HTTPError as err:
+        METRICS.record(base, time.time() - time0, err.code)
+        raise
+    except:
+        METRICS.record(base, time.time() - time0)
+        raise
+    elapsed = time.time() - time0
+    nbytes  = int(res.info().get('Content-Length', 0) or 0)
+    METRICS.record(base, elapsed, res.code, nbytes, ttfb=elapsed)
+    return res
 
 def send_email(to_user, from_user, title, ticket):
     "Send email about user ticket"
@@ -107,10 +354,8 @@ def get_data_and_close(url, ckey=None, cert=None, headers={'Accept':'*/*'}):
         for key, val in headers.items():
             req.add_header(key, val)
 
-    handler = HTTPSClientAuthHandler(ckey, cert)
-    opener  = urllib2.build_opener(handler)
-    urllib2.install_opener(opener)
-    data    = urllib2.urlopen(req)
+    opener  = get_opener(ckey, cert)
+    data    = opener.open(req)
     try:
         yield data
     finally:
@@ -7,26 +7,28 @@ Common utilities
 # system modules
 import os
 import re
+import errno
 import sys
+import json
 import stat
 import time
 import shlex
-import pydoc
 import types
 import readline
+import threading
 import traceback
 import subprocess
 import itertools
-import functools
-from   types import GeneratorType, InstanceType
+from   types import InstanceType
 from   cStringIO import StringIO
 import xml.etree.cElementTree as ET
-from   decorator import decorator
 
 # cmssh modules
 from   cmssh.iprint import format_dict, msg_green
 from   cmssh.iprint import print_warning, print_error, print_info
 from   cmssh.regex import float_number_pattern, int_number_pattern
+from   cmssh.dispatcher import split_pipes
+from   cmssh.pipeline import pipeline, rows
 
 def ranges(ilist):
     """
@@ -56,16 +58,6 @@ def access2file(fname):
         return False
     return True
 
-def memoize(obj):
-    "Keep things in cache"
-    cache = obj.cache = {}
-    @functools.wraps(obj)
-    def memoizer(*args, **kwargs):
-        if args not in cache:
-            cache[args] = obj(*args, **kwargs)
-        return cache[args]
-    return memoizer
-
 class working_dir(object):
     "ContextManager to switch for given directory"
     def __init__(self, new_dir, debug=None):
@@ -166,29 +158,6 @@ def run(cmd, cdir=None, log=None, msg=None, debug=None, shell=False, call=False)
         msg = 'Fail to ' + msg + ', error=%s' % str(err)
         print_error(msg)
 
-class Memoize(object):
-    def __init__(self, interval=1*60*60):
-        self.interval = interval # cache expiration time, default 1h
-        self.expire = time.time() + self.interval
-
-    def __call__(self, func):
-        "Wrap for decorator function call"
-        return decorator(self.check_cache, func)
-
-    def check_cache(self, func, *args):
-        "Set/get results from cache"
-        if  not hasattr(func, 'results'):
-            func.results = {}
-        if  time.time() > self.expire:
-            func.results = {}
-            self.expire = time.time() + self.interval
-        if  args not in func.results:
-            result = func(*args)
-            if  isinstance(result, GeneratorType):
-                result = [r for r in result]
-            func.results[args] = result
-        return func.results[args]
-
 def print_progress(progress, msg='Download in progress:'):
     "Print on stdout progress message"
     if  progress == 'N/A':
@@ -287,6 +256,43 @@ def size_format(i):
             return "%3.1f%s" % (num, x)
         num /= 1024.
 
+class ByteCounter(object):
+    """
+    Thread-safe counter of HTTP traffic. It keeps number of bytes
+    received over the wire and number of bytes after decompression,
+    such that we can see how much response compression saves.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        "Reset counters"
+        self.wire = 0
+        self.body = 0
+        self.requests = 0
+
+    def add(self, wire, body, requests=1):
+        "Account given number of wire/decoded bytes"
+        with self.lock:
+            self.wire += wire
+            self.body += body
+            self.requests += requests
+
+    def saving(self):
+        "Return percentage of bytes saved by compression"
+        if  not self.body:
+            return 0
+        return 100.*(self.body - self.wire)/self.body
+
+    def __str__(self):
+        return '%s requests, %s received, %s decoded, saving %.1f%%' \
+            % (self.requests, size_format(self.wire),
+               size_format(self.body), self.saving())
+
+# Singleton
+HTTP_BYTES = ByteCounter()
+
 def whoami():
     # the way to get function name, see http://code.activestate.com/recipes/66062/
     return sys._getframe(1).f_code.co_name
@@ -312,82 +318,63 @@ class Completer:
         except IndexError:
             return None
 
+def pager_command():
+    """
+    Return pager command if CMSSH_PAGER is set, it is either a command
+    or a flag in which case PAGER (default is less) is used
+    """
+    pager = os.environ.get('CMSSH_PAGER', None)
+    if  not pager or pager == '0' or not sys.stdout.isatty():
+        return None
+    if  pager.isdigit() or pager.lower() == 'true':
+        return os.environ.get('PAGER', 'less')
+    return pager
+
+def page_lines(lines, cmd):
+    "Write given lines to the pager as they come"
+    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+    try:
+        for line in lines:
+            proc.stdin.write(line + '\n')
+    except IOError as exc:
+        if  exc.errno != errno.EPIPE: # pager is closed before the end
+            raise
+    finally:
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        proc.wait()
+
 def list_results(res, debug, flt=None):
-    "List results"
+    """
+    List results, records are written out as they come such that
+    streamed results are never held in memory
+    """
     if  not res:
         return
     gen = formatter_output(res, debug)
-    out = '\n'.join([str(r) for r in gen])
     if  flt:
-        out = '\n'.join(filter_output(out, flt))
-    pager = os.environ.get('CMSSH_PAGER', None)
-    if  pager and pager != '0':
-        pydoc.pager(out)
+        head, filters = split_pipes(flt)
+        gen = pipeline(gen, [head] + filters)
+    lines = (str(r) for r in gen)
+    cmd = pager_command()
+    if  cmd:
+        page_lines(lines, cmd)
     else:
-        print out
+        for line in lines:
+            print line
 
 def formatter_output(res, debug):
     "Formatter takes care of results representation"
-    if  isinstance(res, list) or isinstance(res, GeneratorType):
-        for row in res:
-            if  not debug:
-                yield row
-            else:
-                if  isinstance(row, basestring):
-                    yield row
-                else:
-                    yield repr(row)
-    elif  isinstance(res, set):
-        for row in list(res):
-            if  not debug:
-                yield row
-            else:
-                if  isinstance(row, basestring):
-                    yield row
-                else:
-                    yield repr(row)
-    elif isinstance(res, dict):
+    if  isinstance(res, dict):
         yield format_dict(res)
-    else:
-        if  not debug:
-            yield res
-        else:
-            if  isinstance(res, basestring):
-                yield res
-            else:
-                yield repr(res)
-
-def filter_output(output, flt):
-    "Filter given output"
-    match = None
-    if  flt:
-        arr = flt.split()
-        if  arr[0] == 'grep':
-            match = ' '.join(arr[1:]).strip()
-        else:
-            raise NotImplementedError
-    if  flt and match:
-        arr = match.split()
-        opt = None
-        if  len(arr) == 1:
-            match = arr[0]
-        elif len(arr) == 2:
-            opt, match = arr
+        return
+    for row in rows(res):
+        if  not debug or isinstance(row, basestring):
+            yield row
         else:
-            raise NotImplementedError
-        for line in output.split('\n'):
-            if  opt and opt == '-i':
-                if  line.lower().find(match.lower()) != -1:
-                    yield line
-            elif  opt and opt == '-v':
-                if  line.find(match) == -1:
-                    yield line
-            elif  opt and (opt == '-iv' or opt == '-vi'):
-                if  line.lower().find(match.lower()) == -1:
-                    yield line
-            else:
-                if  line.find(match) != -1:
-                    yield line
+            yield repr(row)
 
 def execmd(cmd):
     """Execute given command in subprocess"""
@@ -491,6 +478,110 @@ def xml_parser(source, prim_key, tags=None):
     if  isinstance(source, InstanceType) or isinstance(source, file):
         source.close()
 
+class JSONStreamReader(object):
+    """
+    Incremental reader of JSON document from given file-like source.
+    It keeps in memory only a part of the document which is required
+    to decode next JSON value.
+    """
+    def __init__(self, source, chunk=65536):
+        self.source  = source
+        self.chunk   = chunk
+        self.buf     = ''
+        self.pos     = 0
+        self.eof     = False
+        self.decoder = json.JSONDecoder()
+
+    def more(self):
+        "Read next chunk from the source, return False at the end of stream"
+        if  self.eof:
+            return False
+        data = self.source.read(self.chunk)
+        if  not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data # drop already decoded part
+        self.pos = 0
+        return True
+
+    def peek(self):
+        "Skip white spaces and return next character, empty at the end"
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if  self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if  not self.more():
+                return ''
+
+    def expect(self, char):
+        "Consume given character"
+        if  self.peek() != char:
+            msg = 'JSON stream: expect "%s", found "%s"' \
+                    % (char, self.buf[self.pos:self.pos+20])
+            raise ValueError(msg)
+        self.pos += 1
+
+    def value(self):
+        "Decode next JSON value"
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # value may be truncated by the end of the buffer, e.g.
+                # number 1.23 read as 1, therefore we accept it only if it
+                # is followed by a delimiter or it is the end of stream
+                if  self.eof or \
+                    (end < len(self.buf) and self.buf[end] in ' \t\n\r,:]}'):
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if  self.eof:
+                    raise
+            self.more()
+
+def json_stream_parser(source, path=None, chunk=65536):
+    """
+    JSON parser which yields elements of JSON array located at given
+    dot-separated path, e.g. phedex.block, from given file-like source.
+    Elements are decoded one by one while the source is read, therefore
+    neither full document nor full list of decoded records are kept in
+    memory. If value at given path is not an array it is yielded as is.
+    """
+    reader = JSONStreamReader(source, chunk)
+    keys = path.split('.') if path else []
+    try:
+        for key in keys:
+            reader.expect('{')
+            while True:
+                if  reader.peek() == '}': # path not found
+                    return
+                name = reader.value()
+                reader.expect(':')
+                if  name == key:
+                    break
+                reader.value() # skip value of other key
+                if  reader.peek() == ',':
+                    reader.expect(',')
+        if  reader.peek() != '[':
+            yield reader.value()
+        else:
+            reader.expect('[')
+            if  reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.value()
+                    if  reader.peek() == ']':
+                        reader.expect(']')
+                        break
+                    reader.expect(',')
+    finally:
+        # release the source, e.g. connection, also when consumer stops
+        # iteration before the end of the array
+        if  hasattr(source, 'close'):
+            source.close()
+
 def get_children(elem, event, row, key, notations):
     """
     xml_parser helper function. It gets recursively information about
@@ -27,7 +27,8 @@ from   cmssh.cms_cmds import cmsrel, cmsrun, cms_help, cms_arch, cms_vomsinit
 from   cmssh.cms_cmds import cms_help_msg, results, cms_apt, cms_das, cms_das_json
 from   cmssh.cms_cmds import github_issues, demo, cms_json, cms_jobs
 from   cmssh.cms_cmds import cms_lumi, integration_tests, cms_read
-from   cmssh.cms_cmds import cms_config, cms_commands, cms_pager
+from   cmssh.cms_cmds import cms_config, cms_commands, cms_pager, cms_cache
+from   cmssh.cms_cmds import cms_stats
 
 class ShellName(object):
     def __init__(self):
@@ -142,6 +143,8 @@ cmsMagicList = [ \
     ('demo', demo),
     ('test', integration_tests),
     ('pager', cms_pager),
+    ('cache', cms_cache),
+    ('stats', cms_stats),
 ]
 if  os.environ.get('CMSSH_EOS', 0):
     eos = '/afs/cern.ch/project/eos/installation/cms/bin/eos.select'
@@ -210,6 +213,8 @@ def main(ipython):
     ip.ex("from cmssh.auth_utils import PEMMGR, read_pem")
     ip.ex("read_pem()")
     ip.ex("cms_vomsinit()")
+    ip.ex("from cmssh.transfers import resume_jobs")
+    ip.ex("resume_jobs()")
     ip.ex("os.environ['CMSSH_PAGER']='0'")
 
     # Set cmssh prompt
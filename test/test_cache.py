@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+"""
+Unit tests of cmssh cache
+"""
+
+# system modules
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+# cmssh modules
+from cmssh.cache import FunctionCache, cached, CACHES
+
+class TestCache(unittest.TestCase):
+    """A test class for function cache"""
+    def setUp(self):
+        "Set up cache area and function calls counter"
+        self.calls = []
+        self.tdir  = tempfile.mkdtemp()
+        self.env   = dict((key, os.environ.get(key)) \
+                for key in ['CMSSH_CACHE', 'CMSSH_CACHE_DIR'])
+        os.environ['CMSSH_CACHE'] = '1'
+        os.environ['CMSSH_CACHE_DIR'] = self.tdir
+
+    def tearDown(self):
+        "Restore environment and remove cache area"
+        for key, val in self.env.items():
+            if  val is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = val
+        shutil.rmtree(self.tdir)
+
+    def square(self, ttl=None, maxsize=128, persist=False, name='test.square'):
+        "Return cached function which counts its calls"
+        @cached(ttl=ttl, maxsize=maxsize, persist=persist, name=name)
+        def square(num, power=2):
+            "Square of given number"
+            self.calls.append(num)
+            return num ** power
+        return square
+
+    def test_keys(self):
+        "Test that equivalent calls share the result"
+        func = self.square()
+        self.assertEqual(func(2), 4)
+        self.assertEqual(func(num=2), 4)
+        self.assertEqual(func(2, 2), 4)
+        self.assertEqual(func(2, power=3), 8)
+        self.assertEqual(self.calls, [2, 2])
+        self.assertEqual(func.cache.stats()['hits'], 2)
+        self.assertEqual(func.cache.stats()['misses'], 2)
+        self.assertTrue(CACHES['test.square'] is func.cache)
+
+    def test_generator(self):
+        "Test that results of generators are stored as lists"
+        @cached(name='test.gen')
+        def gen(num):
+            "Generator of numbers"
+            self.calls.append(num)
+            for idx in range(num):
+                yield idx
+        self.assertEqual(gen(3), [0, 1, 2])
+        self.assertEqual(gen(3), [0, 1, 2])
+        self.assertEqual(self.calls, [3])
+
+    def test_ttl(self):
+        "Test that expired results are computed again"
+        func = self.square(ttl=60)
+        func(2)
+        func(2)
+        key, (_tstamp, value) = func.cache.entries.items()[0]
+        func.cache.entries[key] = (time.time() - 61, value)
+        self.assertEqual(func(2), 4)
+        self.assertEqual(self.calls, [2, 2])
+
+    def test_lru(self):
+        "Test that least recently used results are evicted"
+        func = self.square(maxsize=2)
+        func(1)
+        func(2)
+        func(1)
+        func(3) # evicts result of 2
+        self.assertEqual(func.cache.stats()['evictions'], 1)
+        func(1)
+        func(2)
+        self.assertEqual(self.calls, [1, 2, 3, 2])
+        self.assertEqual(len(func.cache.entries), 2)
+
+    def test_invalidate(self):
+        "Test invalidation of given call and of all results"
+        func = self.square()
+        func(1)
+        func(2)
+        func.invalidate(num=1)
+        func(1)
+        func(2)
+        self.assertEqual(self.calls, [1, 2, 1])
+        func.invalidate()
+        self.assertEqual(func.cache.stats()['size'], 0)
+        func(2)
+        self.assertEqual(self.calls, [1, 2, 1, 2])
+
+    def test_persist(self):
+        "Test that persistent cache is shared between instances"
+        func = self.square(persist=True)
+        func(2)
+        self.assertTrue(os.path.isfile(func.cache.fname()))
+        func = self.square(persist=True)
+        self.assertEqual(func(2), 4)
+        self.assertEqual(self.calls, [2])
+        os.environ['CMSSH_CACHE'] = '0'
+        cache = FunctionCache('test.square', persist=True)
+        self.assertFalse(cache.persist)
+        self.assertEqual(cache.get(func.cache.entries.keys()[0]), (False, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+"""
+Unit tests of cmssh dispatcher and of find command routes
+"""
+
+# system modules
+import unittest
+
+# cmssh modules
+from cmssh.dispatcher import Dispatcher, Route, split_pipes
+from cmssh.cmsfs import CMSMGR
+
+DATASET = '/a/b/RECO'
+BLOCK   = '/a/b/RECO#123'
+LFN     = '/store/data/file.root'
+
+# query => expected controller arguments, None stands for unknown query
+QUERIES = [
+    ('run=160915', {'controller': 'list_runs', 'run': '160915'}),
+    ('dataset=/a/b/c*', {'controller': 'list_datasets', 'dataset': '/a/b/c*'}),
+    ('dataset=/a/b/c* status=VALID', {'controller': 'list_datasets',
+        'dataset': '/a/b/c*', 'status': 'VALID'}),
+    ('status=VALID dataset=/a/b/c*', {'controller': 'list_datasets',
+        'dataset': '/a/b/c*', 'status': 'VALID'}),
+    ('T2_US_Nebraska', {'controller': 'list_du4site',
+        'sitename': 'T2_US_Nebraska'}),
+    ('site=T2_US_Nebraska', {'controller': 'list_sites',
+        'sitename': 'T2_US_Nebraska'}),
+    ('user=doe', {'controller': 'list_user', 'username': 'doe'}),
+    ('user=John Doe', {'controller': 'list_user', 'username': 'John Doe'}),
+    ('user="John Doe"', {'controller': 'list_user', 'username': 'John Doe'}),
+    ('release=CMSSW_5_3_2', {'controller': 'list_releases',
+        'name': 'CMSSW_5_3_2'}),
+    ('release=CMSSW_5_3_2_patch1', {'controller': 'list_releases',
+        'name': 'CMSSW_5_3_2_patch1'}),
+    ('file dataset=%s' % DATASET, {'controller': 'list_files',
+        'dataset': DATASET}),
+    ('file dataset=%s run=160915' % DATASET, {'controller': 'list_files',
+        'dataset': DATASET, 'run': '160915'}),
+    ('file dataset=%s site=T1_US_FNAL' % DATASET, {'controller': 'list_files',
+        'dataset': DATASET, 'site': 'T1_US_FNAL'}),
+    ('file dataset=%s run=160915 site=T1_US_FNAL' % DATASET,
+        {'controller': 'list_files', 'dataset': DATASET, 'run': '160915',
+         'site': 'T1_US_FNAL'}),
+    ('file site=T1_US_FNAL run=160915 dataset=%s' % DATASET,
+        {'controller': 'list_files', 'dataset': DATASET, 'run': '160915',
+         'site': 'T1_US_FNAL'}),
+    ('site dataset=%s' % DATASET, {'controller': 'list_sites4dataset',
+        'dataset': DATASET}),
+    ('site file=%s' % LFN, {'controller': 'list_sites4file',
+        'filename': LFN}),
+    ('block site=T1_US_FNAL', {'controller': 'list_block4site',
+        'sitename': 'T1_US_FNAL'}),
+    ('job', {'controller': 'list_jobs'}),
+    ('job user=doe', {'controller': 'list_jobs', 'user': 'doe'}),
+    ('job site=T1_US_FNAL', {'controller': 'list_jobs', 'site': 'T1_US_FNAL'}),
+    ('job user=doe site=T1_US_FNAL', {'controller': 'list_jobs',
+        'user': 'doe', 'site': 'T1_US_FNAL'}),
+    ('release', {'controller': 'list_releases'}),
+    ('releases', {'controller': 'list_releases'}),
+    ('config dataset=%s' % DATASET, {'controller': 'list_configs',
+        'dataset': DATASET}),
+    ('prep dataset=%s' % DATASET, {'controller': 'list_prep',
+        'dataset': DATASET}),
+    ('mcinfo dataset=%s' % DATASET, {'controller': 'list_prep',
+        'dataset': DATASET}),
+    ('run_lumi dataset=%s' % DATASET, {'controller': 'run_lumis',
+        'dataset': DATASET}),
+    ('run_lumi block=%s' % BLOCK, {'controller': 'run_lumis',
+        'block': BLOCK}),
+    ('run_lumi file=%s' % LFN, {'controller': 'run_lumis', 'file': LFN}),
+    ('run_lumi run=160915', {'controller': 'run_lumis', 'run': '160915'}),
+    ('lumi dataset=%s' % DATASET, {'controller': 'list_lumis',
+        'dataset': DATASET}),
+    ('lumi block=%s' % BLOCK, {'controller': 'list_lumis', 'block': BLOCK}),
+    ('lumi file=%s' % LFN, {'controller': 'list_lumis', 'file': LFN}),
+    ('lumi run=160915', {'controller': 'list_lumis', 'run': '160915'}),
+    ('lumi {"160915": [1, 2]}', {'controller': 'list_lumis',
+        'arg': '{"160915": [1, 2]}'}),
+    # unknown queries
+    ('foo=1', None),
+    ('run=abc', None),
+    ('release=5_3_2', None),
+    ('file run=160915', None),
+    ('file dataset=%s site=FNAL' % DATASET, None),
+    ('file dataset=%s dataset=%s' % (DATASET, DATASET), None),
+    ('site file=/store/data/file.txt', None),
+    ('block site=FNAL', None),
+    ('config', None),
+    ('run_lumi dataset=%s run=160915' % DATASET, None),
+    ('FNAL', None),
+    ('', None),
+]
+
+class TestDispatcher(unittest.TestCase):
+    """A test class for the Dispatcher"""
+    def setUp(self):
+        "Set up routes of the test"
+        self.map = Dispatcher([
+            Route(None, 'by_key', {'key': r'\d+', 'opt?': r'[a-z]+'},
+                  {'key': 'number'}),
+            Route('entity', 'by_entity', {'name': r'.*'}),
+            Route('entity', 'by_argument', argument=('arg', r'\d+')),
+        ])
+
+    def test_conditions(self):
+        "Test required, optional and renamed conditions"
+        self.assertEqual(self.map.match('key=1'),
+                {'controller': 'by_key', 'number': '1'})
+        self.assertEqual(self.map.match('opt=a key=1'),
+                {'controller': 'by_key', 'number': '1', 'opt': 'a'})
+        self.assertEqual(self.map.match('opt=a'), None)
+        self.assertEqual(self.map.match('key=1 opt=1'), None)
+        self.assertEqual(self.map.match('key=1 other=a'), None)
+
+    def test_values(self):
+        "Test quoted and multi-word condition values"
+        self.assertEqual(self.map.match('entity name="a | b"'),
+                {'controller': 'by_entity', 'name': 'a | b'})
+        self.assertEqual(self.map.match("entity name='a b'"),
+                {'controller': 'by_entity', 'name': 'a b'})
+        self.assertEqual(self.map.match('entity name=a b c'),
+                {'controller': 'by_entity', 'name': 'a b c'})
+
+    def test_argument(self):
+        "Test free-form argument of a route"
+        self.assertEqual(self.map.match('entity 123'),
+                {'controller': 'by_argument', 'arg': '123'})
+        self.assertEqual(self.map.match('entity abc'), None)
+        self.assertEqual(self.map.match('123'), None)
+
+class TestRoutes(unittest.TestCase):
+    """A test class for routes of find command"""
+    def test_routes(self):
+        "Test that every query is dispatched to its controller"
+        for query, expect in QUERIES:
+            self.assertEqual(CMSMGR.map.match(query), expect,
+                    'query: %r' % query)
+
+    def test_filters(self):
+        "Test that query with filters is dispatched by its head"
+        head, filters = split_pipes('file dataset=%s | grep x' % DATASET)
+        self.assertEqual(CMSMGR.map.match(head),
+                {'controller': 'list_files', 'dataset': DATASET})
+        self.assertEqual(filters, ['grep x'])
+
+if __name__ == '__main__':
+    unittest.main()
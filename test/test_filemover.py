@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+"""
+Unit tests of cmssh filemover, xrootd replicas are replaced by local
+file:// URLs which are read by the multi-stream downloader
+"""
+
+# system modules
+import os
+import zlib
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+# cmssh modules
+from cmssh import filemover
+from cmssh.filemover import CHECKSUMS, PFNMGR, TFCMGR, TransferCmd
+from cmssh.filemover import KnownChecksum, stream_cmd, stream_urls
+from cmssh.filemover import verify_checksum
+
+class TestStreamCmd(unittest.TestCase):
+    "Tests of multi-stream download commands"
+    def setUp(self):
+        "Create replica file and resolve LFN into its file:// URL"
+        self.tmp = tempfile.mkdtemp()
+        self.lfn = '/store/data/Run/file_1.root'
+        self.src = os.path.join(self.tmp, 'replica.root')
+        self.dst = os.path.join(self.tmp, 'dst')
+        os.mkdir(self.dst)
+        data = os.urandom(1000) * 100
+        with open(self.src, 'wb') as stream:
+            stream.write(data)
+        self.adler32 = '%08x' % (zlib.adler32(data) & 0xffffffff)
+        CHECKSUMS.update([{'logical_file_name': self.lfn,
+                'adler32': self.adler32, 'file_size': len(data)}])
+        self.url = 'file://%s' % self.src
+        PFNMGR.file_replicas = lambda lfns, verbose=None: \
+                dict((l, [('T2_A', 'se.a')]) for l in lfns)
+        TFCMGR.resolve = lambda pairs, protocol, verbose=None: \
+                dict((p, self.url) for p in pairs)
+        self.env = dict(os.environ)
+        os.environ['CMSSH_STREAMS_SIZE'] = '1000'
+        os.environ['CMSSH_CHUNK_SIZE'] = '7000'
+
+    def tearDown(self):
+        "Restore services and environment"
+        del PFNMGR.file_replicas
+        del TFCMGR.resolve
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.tmp)
+
+    def test_stream_urls(self):
+        "Replicas are resolved into URLs of the downloader"
+        self.assertEqual(stream_urls(self.lfn)[0], self.url)
+
+    def test_small_file(self):
+        "Files smaller than CMSSH_STREAMS_SIZE are not streamed"
+        os.environ['CMSSH_STREAMS_SIZE'] = str(10**6)
+        self.assertEqual(stream_cmd(self.lfn, self.dst), None)
+
+    def test_download(self):
+        "File is downloaded and its checksum is not read again"
+        cmd = stream_cmd(self.lfn, self.dst)
+        self.assertTrue(cmd.find(' -a %s ' % self.adler32) != -1)
+        tcmd = TransferCmd(cmd, self.dst)
+        self.assertTrue(isinstance(tcmd.reader, KnownChecksum))
+        tcmd.start()
+        self.assertEqual(tcmd.wait(interval=0.1), 0, tcmd.stdout())
+        path = os.path.join(self.dst, 'replica.root')
+        self.assertEqual(open(path, 'rb').read(), open(self.src, 'rb').read())
+        def fail(path):
+            "File must not be read"
+            raise AssertionError('%s is read again' % path)
+        reader, filemover.Adler32Reader = filemover.Adler32Reader, fail
+        try:
+            self.assertTrue(verify_checksum(self.lfn, path, tcmd.reader))
+        finally:
+            filemover.Adler32Reader = reader
+
+if __name__ == '__main__':
+    unittest.main()
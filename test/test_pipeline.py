@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+"""
+Unit tests of cmssh pipeline filters
+"""
+
+# system modules
+import unittest
+
+# cmssh modules
+from cmssh.dispatcher import split_pipes
+from cmssh.pipeline import make_filter, pipeline
+from cmssh.results import ResultManager
+
+class Record(object):
+    "Record with data dict, like cmssh objects"
+    def __init__(self, data):
+        self.data = data
+    def __repr__(self):
+        return self.data['name']
+
+def records(num, pulled):
+    "Yield num records and count how many of them were pulled"
+    for idx in range(num):
+        pulled.append(idx)
+        yield Record({'name': 'file_%s' % idx, 'bytes': num - idx})
+
+class TestPipeline(unittest.TestCase):
+    """A test class for pipeline filters"""
+    def test_split_pipes(self):
+        "Test split of query into its head and filters"
+        self.assertEqual(split_pipes('file dataset=/a/b/c'),
+                ('file dataset=/a/b/c', []))
+        self.assertEqual(split_pipes('file dataset=/a/b/c | grep x|head 5'),
+                ('file dataset=/a/b/c', ['grep x', 'head 5']))
+        self.assertEqual(split_pipes('user="a|b" | grep \'c | d\''),
+                ('user="a|b"', ['grep \'c | d\'']))
+
+    def test_make_filter(self):
+        "Test unknown filters and wrong arguments"
+        for flt in ['', 'foo', 'grep', 'grep -i', 'head a', 'head 1 2',
+                'count x', 'uniq x', 'sort -r a b', 'select', 'select ,']:
+            self.assertRaises(NotImplementedError, make_filter, flt)
+        self.assertRaises(NotImplementedError, pipeline, [], ['head', 'foo'])
+
+    def test_filters(self):
+        "Test results of filters"
+        data = ['b', 'A', 'c', 'a', 'b']
+        self.assertEqual(list(pipeline(data, [])), data)
+        self.assertEqual(list(pipeline(data, ['grep a'])), ['a'])
+        self.assertEqual(list(pipeline(data, ['grep -i a'])), ['A', 'a'])
+        self.assertEqual(list(pipeline(data, ['grep -v b'])), ['A', 'c', 'a'])
+        self.assertEqual(list(pipeline(data, ['grep -iv a'])), ['b', 'c', 'b'])
+        self.assertEqual(list(pipeline(data, ['count'])), [5])
+        self.assertEqual(list(pipeline(data, ['wc'])), [5])
+        self.assertEqual(list(pipeline(data, ['head 2'])), ['b', 'A'])
+        self.assertEqual(list(pipeline(data, ['sort'])),
+                ['A', 'a', 'b', 'b', 'c'])
+        self.assertEqual(list(pipeline(data, ['sort -r', 'uniq'])),
+                ['c', 'b', 'a', 'A'])
+        self.assertEqual(list(pipeline('a', ['count'])), [1])
+        self.assertEqual(list(pipeline(None, ['count'])), [0])
+
+    def test_fields(self):
+        "Test sort by field and projection of records"
+        res = list(pipeline(records(3, []), ['sort size', 'select name']))
+        self.assertEqual(res, ['file_2', 'file_1', 'file_0'])
+        res = list(pipeline(records(3, []), ['select name,size']))
+        self.assertEqual([str(r) for r in res],
+                ['file_0 3', 'file_1 2', 'file_2 1'])
+        self.assertEqual(res[0], {'name': 'file_0', 'size': 3})
+
+    def test_lazy(self):
+        "Test that records are pulled only when they are needed"
+        pulled = []
+        gen = pipeline(records(100, pulled), ['grep file', 'head 3'])
+        self.assertEqual(pulled, [])
+        self.assertEqual([repr(r) for r in gen],
+                ['file_0', 'file_1', 'file_2'])
+        self.assertEqual(len(pulled), 3)
+        pulled = []
+        gen = pipeline(records(100, pulled), ['grep file_9', 'head 2'])
+        self.assertEqual(len(list(gen)), 2)
+        self.assertEqual(len(pulled), 91)
+
+    def test_results(self):
+        "Test that result manager consumes stream lazily and keeps records"
+        pulled = []
+        mgr = ResultManager(limit=5)
+        mgr.assign(pipeline(records(10, pulled), ['select name']))
+        self.assertEqual(pulled, [])
+        self.assertTrue(mgr)
+        self.assertEqual(mgr[1], 'file_1')
+        self.assertEqual(len(pulled), 2)
+        self.assertEqual(list(mgr)[:3], ['file_0', 'file_1', 'file_2'])
+        self.assertEqual(len(mgr), 10)
+        self.assertEqual(len(pulled), 10)
+        self.assertTrue(mgr.truncated)
+        self.assertEqual(len(mgr.data), 5)
+
+if __name__ == '__main__':
+    unittest.main()
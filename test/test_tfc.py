@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+"""
+Unit tests of cmssh TFC rule engine
+"""
+
+# system modules
+import time
+import unittest
+
+# cmssh modules
+from cmssh import tfc
+from cmssh.tfc import TFCRule, TFCRules, TFCManager
+
+def rule(protocol, match, result, chain=None, dest=None, element='lfn-to-pfn'):
+    "Return TFC row as it is provided by PhEDEx tfc API"
+    row = {'element_name': element, 'protocol': protocol,
+           'path-match': match, 'result': result}
+    if  chain:
+        row['chain'] = chain
+    if  dest:
+        row['destination-match'] = dest
+    return row
+
+SRM = 'srm://cmssrm.fnal.gov:8443/srm/managerv2?SFN='
+ROWS = [
+    rule('direct', '/+store/user/(.*)', '/pnfs/cms/user/$1'),
+    rule('direct', '/+store/(.*)', '/pnfs/cms/WAX/11/store/$1'),
+    rule('srmv2', '/+pnfs/(.*)', SRM + '/pnfs/$1', chain='direct'),
+    rule('srmv2', '/+(.*)', SRM + '/other/${1}'),
+    rule('dcap', '/+store/(.*)', 'dcap://disk/store/$1', dest='T1_US_FNAL_Disk'),
+    rule('dcap', '/+store/(.*)', 'dcap://tape/store/$1'),
+    rule('loop', '(.*)', '$1', chain='loop'),
+    rule('broken', '/+store/((.*)', '$1'),
+    rule('direct', '/+store/(.*)', '/ignored/$1', element='pfn-to-lfn'),
+]
+
+class TestTFCRules(unittest.TestCase):
+    """A test class for TFC rules"""
+    def setUp(self):
+        "Set up rules of the test node"
+        self.rules = TFCRules('T1_US_FNAL_Buffer', ROWS)
+
+    def test_apply(self):
+        "Test single rule and substitution of its groups"
+        row = rule('srmv2', '/+store/(data|mc)/(.*)', 'srm://se/$2/${1}')
+        self.assertEqual(TFCRule(row).apply('/store/mc/a.root'),
+                'srm://se/a.root/mc')
+        self.assertEqual(TFCRule(row).apply('/store/user/a.root'), None)
+
+    def test_rules(self):
+        "Test that only lfn-to-pfn rules which we can handle are kept"
+        self.assertEqual(sorted(self.rules.protocols()),
+                ['dcap', 'direct', 'loop', 'srmv2'])
+        self.assertEqual(len(self.rules.rules['direct']), 2)
+
+    def test_order(self):
+        "Test that the first matched rule wins"
+        self.assertEqual(self.rules.pfn('/store/user/a.root', 'direct'),
+                '/pnfs/cms/user/a.root')
+        self.assertEqual(self.rules.pfn('/store/data/a.root', 'direct'),
+                '/pnfs/cms/WAX/11/store/data/a.root')
+        self.assertEqual(self.rules.pfn('/data/a.root', 'direct'), None)
+
+    def test_chain(self):
+        "Test that chained rule converts name by rules of chained protocol"
+        self.assertEqual(self.rules.pfn('/store/data/a.root'),
+                SRM + '/pnfs/cms/WAX/11/store/data/a.root')
+        self.assertEqual(self.rules.pfn('/store/user/a.root', 'srmv2'),
+                SRM + '/pnfs/cms/user/a.root')
+        # name which is not converted by chained protocol goes to next rule
+        self.assertEqual(self.rules.pfn('/data/a.root', 'srmv2'),
+                SRM + '/other/data/a.root')
+        self.assertEqual(self.rules.pfn('/store/a.root', 'loop'), None)
+
+    def test_destination(self):
+        "Test destination-match of rules"
+        self.assertEqual(self.rules.pfn('/store/a.root', 'dcap'),
+                'dcap://tape/store/a.root')
+        self.assertEqual(self.rules.pfn('/store/a.root', 'dcap',
+                dest='T1_US_FNAL_Disk'), 'dcap://disk/store/a.root')
+        self.assertEqual(self.rules.pfn('/store/a.root', 'xrootd'), None)
+
+class TestTFCManager(unittest.TestCase):
+    """A test class for TFC manager"""
+    def setUp(self):
+        "Set up manager which fetches TFC of the test node"
+        self.orig = tfc.get_data_multi
+        tfc.get_data_multi = self.get_data_multi
+        self.requests = []
+        self.mgr = TFCManager(ttl=60)
+
+    def tearDown(self):
+        "Restore data look-up"
+        tfc.get_data_multi = self.orig
+
+    def get_data_multi(self, reqs, verbose=None):
+        "Yield TFC of T1_US_FNAL_Buffer, other nodes do not have TFC"
+        for url, params in reqs:
+            self.requests.append(params['node'])
+            if  params['node'] == 'T1_US_FNAL_Buffer':
+                data = {'phedex': {'storage-mapping': {'array': ROWS}}}
+            else:
+                data = {'phedex': {}}
+            yield url, params, data
+
+    def test_resolve(self):
+        "Test resolution of LFNs of several nodes"
+        lfn = '/store/data/a.root'
+        pairs = [('T1_US_FNAL_Buffer', lfn), ('T2_CH_CERN', lfn)]
+        res = self.mgr.resolve(pairs)
+        self.assertEqual(res, {('T1_US_FNAL_Buffer', lfn):
+                SRM + '/pnfs/cms/WAX/11/store/data/a.root'})
+        self.assertEqual(sorted(self.requests),
+                ['T1_US_FNAL_Buffer', 'T2_CH_CERN'])
+        # rules are fetched once
+        self.assertEqual(self.mgr.lfn2pfn('T1_US_FNAL_Buffer', lfn, 'direct'),
+                '/pnfs/cms/WAX/11/store/data/a.root')
+        self.assertEqual(self.mgr.lfn2pfn('T2_CH_CERN', lfn), None)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_ttl(self):
+        "Test that expired rules are fetched again"
+        self.mgr.rules('T1_US_FNAL_Buffer')
+        self.assertNotEqual(self.mgr.get('T1_US_FNAL_Buffer'), None)
+        tstamp, rules = self.mgr.nodes['T1_US_FNAL_Buffer']
+        self.mgr.nodes['T1_US_FNAL_Buffer'] = (time.time() - 61, rules)
+        self.assertEqual(self.mgr.get('T1_US_FNAL_Buffer'), None)
+        self.mgr.rules('T1_US_FNAL_Buffer')
+        self.assertEqual(self.requests, ['T1_US_FNAL_Buffer'] * 2)
+        self.mgr.clear()
+        self.assertEqual(self.mgr.get('T1_US_FNAL_Buffer'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+"""
+Unit tests of cmssh transfers
+"""
+
+# system modules
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+# cmssh modules
+from cmssh import transfers
+from cmssh.filemover import CHECKSUMS, resume_cmd
+
+class FakeEngine(object):
+    "Transfer engine which records submitted LFNs"
+    def __init__(self):
+        self.lfns = []
+
+    def is_verified(self, lfn, dst):
+        "No file is verified"
+        return False
+
+    def submit(self, lfns, dst, verbose, priority):
+        "Record submitted LFNs"
+        self.lfns += lfns
+        return lfns
+
+class TestCopyFiles(unittest.TestCase):
+    "Tests of copy_files"
+    def setUp(self):
+        "Set up a local destination and fake services"
+        self.lfn = '/store/data/Run/file_1.root'
+        self.dst = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dst, 'file_1.root')
+        CHECKSUMS.update([{'logical_file_name': self.lfn,
+                'adler32': '00000001', 'check_sum': None, 'file_size': 100}])
+        self.orig = dict((name, getattr(transfers, name)) \
+                for name in ['lfn_list', 'resume_jobs', 'TRANSFERS', 'PFNMGR'])
+        transfers.lfn_list = lambda src, verbose: [src]
+        transfers.resume_jobs = lambda: None
+        transfers.TRANSFERS = FakeEngine()
+        transfers.PFNMGR = type('PFNMgr', (object,), \
+                {'prefetch': lambda self, lfns, verbose: None})()
+
+    def tearDown(self):
+        "Restore services and remove destination"
+        for name, value in self.orig.items():
+            setattr(transfers, name, value)
+        shutil.rmtree(self.dst)
+
+    def write(self, size):
+        "Write local file of given size"
+        with open(self.fname, 'wb') as stream:
+            stream.write('x' * size)
+
+    def test_partial_file(self):
+        "Partially downloaded file is kept and resumed"
+        self.write(40)
+        status = transfers.copy_files(self.lfn, self.dst, background=True)
+        self.assertEqual(status, 'accepted')
+        self.assertEqual(transfers.TRANSFERS.lfns, [self.lfn])
+        self.assertEqual(os.path.getsize(self.fname), 40)
+        cmd = 'xrdcp root://cms-xrd-global.cern.ch/%s %s' % (self.lfn, self.dst)
+        self.assertEqual(resume_cmd(cmd, self.dst), \
+                cmd.replace('xrdcp ', 'xrdcp --continue ', 1))
+
+    def test_existing_file(self):
+        "Complete file is not copied again"
+        self.write(100)
+        status = transfers.copy_files(self.lfn, self.dst, background=True)
+        self.assertEqual(status, 'fail')
+        self.assertEqual(transfers.TRANSFERS.lfns, [])
+        self.assertTrue(os.path.isfile(self.fname))
+
+    def test_overwrite(self):
+        "Existing file is removed if it is overwritten"
+        self.write(40)
+        status = transfers.copy_files(self.lfn, self.dst, background=True,
+                overwrite=True)
+        self.assertEqual(status, 'accepted')
+        self.assertFalse(os.path.isfile(self.fname))
+
+class TestTransferJournal(unittest.TestCase):
+    "Tests of TransferJournal"
+    def setUp(self):
+        "Set up journal in temporary area"
+        self.tdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tdir, 'transfers.log')
+        self.journal = transfers.TransferJournal(self.fname, size=2)
+
+    def tearDown(self):
+        "Release the journal and remove temporary area"
+        if  self.journal.stream:
+            self.journal.stream.close()
+        if  self.journal.owner:
+            self.journal.owner.close()
+        shutil.rmtree(self.tdir)
+
+    def job(self, jid, status):
+        "Return job with given id and status"
+        job = transfers.TransferJob(jid, '/store/file_%s.root' % jid, self.tdir)
+        job.status = status
+        return job
+
+    def test_ownership(self):
+        "Only the owner of the journal appends records"
+        self.journal.record(self.job(1, 'waiting'))
+        self.assertFalse(os.path.isfile(self.fname))
+        self.assertTrue(self.journal.acquire())
+        other = transfers.TransferJournal(self.fname)
+        self.assertFalse(other.acquire())
+        other.record(self.job(1, 'waiting'))
+        self.assertEqual(self.journal.load(), [])
+
+    def test_append(self):
+        "The last record of a job wins, partial records are skipped"
+        self.assertTrue(self.journal.acquire())
+        for jid, status in [(2, 'waiting'), (1, 'waiting'), (1, 'running'),
+                (2, 'done'), (1, 'fail')]:
+            self.journal.record(self.job(jid, status))
+        with open(self.fname, 'a') as stream:
+            stream.write('{"jid": 3, "sta')
+        records = self.journal.load()
+        self.assertEqual([(r['jid'], r['status']) for r in records],
+                [(1, 'fail'), (2, 'done')])
+        self.assertEqual(records[0]['lfn'], '/store/file_1.root')
+
+    def test_compact(self):
+        "Pending jobs and only the last finished ones are kept"
+        self.assertTrue(self.journal.acquire())
+        statuses = ['done', 'waiting', 'fail', 'running', 'cancelled', 'done']
+        for jid, status in enumerate(statuses):
+            self.journal.record(self.job(jid, status))
+        records = self.journal.compact(self.journal.load())
+        expect = [(1, 'waiting'), (3, 'running'), (4, 'cancelled'), (5, 'done')]
+        self.assertEqual([(r['jid'], r['status']) for r in records], expect)
+        with open(self.fname) as stream:
+            lines = [json.loads(line) for line in stream]
+        self.assertEqual(lines, records)
+
+    def test_replay(self):
+        "Finished jobs are restored as history, pending ones are resumed"
+        self.assertTrue(self.journal.acquire())
+        done = self.job(1, 'done')
+        done.size = 10
+        for job in [done, self.job(2, 'running'), self.job(3, 'fail')]:
+            self.journal.record(job)
+        self.journal.stream.close()
+        self.journal.stream = None
+        self.journal.owner.close()
+        self.journal.owner = None
+        engine = transfers.TransferEngine(journal=self.journal)
+        engine.start_workers = lambda: None
+        resumed = engine.restore()
+        self.assertEqual([job.jid for job in resumed], [2])
+        self.assertEqual(resumed[0].status, 'waiting')
+        self.assertEqual([job.jid for _, _, job in engine.queue], [2])
+        self.assertEqual([(job.jid, job.restored) for job in engine.jobs],
+                [(1, True), (2, False), (3, True)])
+        self.assertEqual(engine.verified, {(done.lfn, self.tdir): 10})
+        self.assertEqual(engine.ids.next(), 4)
+        self.assertEqual(engine.restore(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+"""
+Unit tests of cmssh url_cache
+"""
+
+# system modules
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+# cmssh modules
+from cmssh import url_utils
+from cmssh.url_cache import ResponseCache
+
+URL = 'https://cmsweb.cern.ch/phedex/datasvc/json/prod/nodes'
+
+class TestResponseCache(unittest.TestCase):
+    """A test class for ResponseCache"""
+    def setUp(self):
+        "Set up cache in temporary area"
+        self.tdir  = tempfile.mkdtemp()
+        self.cache = ResponseCache(cdir=os.path.join(self.tdir, 'cache'))
+        self.env   = os.environ.get('CMSSH_CACHE')
+        os.environ['CMSSH_CACHE'] = '1'
+        self.orig  = (url_utils.HTTP_CACHE, url_utils.get_response)
+        url_utils.HTTP_CACHE = self.cache
+        self.requests = []
+
+    def tearDown(self):
+        "Remove temporary area"
+        url_utils.HTTP_CACHE, url_utils.get_response = self.orig
+        if  self.env is None:
+            del os.environ['CMSSH_CACHE']
+        else:
+            os.environ['CMSSH_CACHE'] = self.env
+        shutil.rmtree(self.tdir)
+
+    def respond(self, code, headers, body=''):
+        "Make get_response to return given response and record requests"
+        def get_response(url, kwargs, hdrs=None, verbose=None):
+            "Response of the service"
+            self.requests.append(hdrs)
+            return code, headers, StringIO(body)
+        url_utils.get_response = get_response
+
+    def expire(self, meta):
+        "Expire given entry"
+        meta['expire'] = time.time() - 1
+        self.cache.write_meta(meta)
+
+    def test_store(self):
+        "Test store and look-up of an entry"
+        self.assertEqual(self.cache.ttl(URL), 24*60*60)
+        sitedb = 'https://cmsweb.cern.ch/sitedb/data/prod/people'
+        self.assertEqual(self.cache.ttl(sitedb), 0)
+        self.assertEqual(self.cache.lookup(URL, {'a': 1}), None)
+        self.cache.store(URL, {'a': 1}, '{"b": 2}', {'etag': '"v1"'})
+        meta = self.cache.lookup(URL, {'a': 1})
+        self.assertTrue(self.cache.fresh(meta))
+        self.assertEqual(meta['size'], 8)
+        self.assertEqual(self.cache.open(meta).read(), '{"b": 2}')
+        self.assertEqual(self.cache.lookup(URL, {'a': 2}), None)
+
+    def test_validators(self):
+        "Test validators of an entry and their update on re-validation"
+        self.cache.store(URL, {}, 'data',
+                {'etag': '"v1"', 'last-modified': 'Mon, 01 Oct 2012'})
+        meta = self.cache.lookup(URL, {})
+        self.assertEqual(self.cache.validators(meta),
+                {'If-None-Match': '"v1"',
+                 'If-Modified-Since': 'Mon, 01 Oct 2012'})
+        self.expire(meta)
+        # validators which are not sent along with 304 are kept
+        self.cache.refresh(self.cache.lookup(URL, {}), {})
+        meta = self.cache.lookup(URL, {})
+        self.assertTrue(self.cache.fresh(meta))
+        self.assertEqual(meta['etag'], '"v1"')
+        self.assertEqual(meta['modified'], 'Mon, 01 Oct 2012')
+        self.cache.refresh(meta, {'etag': '"v2"'})
+        meta = self.cache.lookup(URL, {})
+        self.assertEqual(meta['etag'], '"v2"')
+        self.assertEqual(meta['modified'], 'Mon, 01 Oct 2012')
+        self.assertEqual(self.cache.valid, 2)
+
+    def test_revalidation(self):
+        "Test that expired entry is re-validated via ETag"
+        self.respond(200, {'etag': '"v1"'}, '{"data": 1}')
+        self.assertEqual(url_utils.get_data_cached(URL, {}), {'data': 1})
+        self.assertEqual(self.requests, [{}])
+        # fresh entry is served from the cache
+        self.assertEqual(url_utils.get_data_cached(URL, {}), {'data': 1})
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(self.cache.hits, 1)
+        # expired entry is re-validated, 304 keeps the body and validators
+        self.expire(self.cache.lookup(URL, {}))
+        self.respond(304, {})
+        self.assertEqual(url_utils.get_data_cached(URL, {}), {'data': 1})
+        self.assertEqual(self.requests[-1], {'If-None-Match': '"v1"'})
+        meta = self.cache.lookup(URL, {})
+        self.assertTrue(self.cache.fresh(meta))
+        self.assertEqual(meta['etag'], '"v1"')
+        # changed data replaces the entry
+        self.expire(meta)
+        self.respond(200, {'etag': '"v2"'}, '{"data": 2}')
+        self.assertEqual(url_utils.get_data_cached(URL, {}), {'data': 2})
+        self.assertEqual(self.requests[-1], {'If-None-Match': '"v1"'})
+        self.assertEqual(self.cache.lookup(URL, {})['etag'], '"v2"')
+
+    def test_unreachable(self):
+        "Test that expired entry is used if service is not reachable"
+        self.cache.store(URL, {}, '{"data": 1}')
+        self.expire(self.cache.lookup(URL, {}))
+        def get_response(url, kwargs, hdrs=None, verbose=None):
+            "Service which is not reachable"
+            raise IOError('connection refused')
+        url_utils.get_response = get_response
+        self.assertEqual(url_utils.get_data_cached(URL, {}), {'data': 1})
+        self.cache.clear()
+        self.assertRaises(IOError, url_utils.get_data_cached, URL, {})
+
+    def test_evict(self):
+        "Test that least recently used entries are evicted"
+        self.cache.size = 25
+        for idx in range(3):
+            self.cache.store(URL, {'idx': idx}, '0123456789')
+            meta = self.cache.lookup(URL, {'idx': idx})
+            fname = self.cache.path(meta['key'], '.data')
+            os.utime(fname, (time.time() - 100 + idx, time.time() - 100 + idx))
+        self.assertEqual(self.cache.lookup(URL, {'idx': 0}), None)
+        # recently used entry is kept
+        self.cache.open(self.cache.lookup(URL, {'idx': 1})).close()
+        self.cache.store(URL, {'idx': 3}, '0123456789')
+        self.assertNotEqual(self.cache.lookup(URL, {'idx': 1}), None)
+        self.assertEqual(self.cache.lookup(URL, {'idx': 2}), None)
+        self.assertNotEqual(self.cache.lookup(URL, {'idx': 3}), None)
+
+if __name__ == '__main__':
+    unittest.main()
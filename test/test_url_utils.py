@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+"""
+Unit tests of cmssh url_utils
+"""
+
+# system modules
+import time
+import threading
+import unittest
+
+# cmssh modules
+from cmssh.url_utils import SingleFlight
+
+class TestSingleFlight(unittest.TestCase):
+    """A test class for SingleFlight"""
+    def setUp(self):
+        "Set up single flight and a slow call"
+        self.flight = SingleFlight()
+        self.calls = []
+        self.started = threading.Event()
+
+    def slow(self, value):
+        "Slow call which returns given value or raises it if it is error"
+        self.calls.append(value)
+        self.started.set()
+        time.sleep(0.2)
+        if  isinstance(value, Exception):
+            raise value
+        return [value]
+
+    def run_callers(self, key, value, num=5):
+        "Run num concurrent callers, return their results and errors"
+        results = []
+        errors  = []
+        def target():
+            "Single caller"
+            try:
+                results.append(self.flight.call(key, self.slow, value))
+            except Exception as exc:
+                errors.append(exc)
+        threads = [threading.Thread(target=target) for _ in range(num)]
+        threads[0].start()
+        self.started.wait(1)
+        for thr in threads[1:]:
+            thr.start()
+        for thr in threads:
+            thr.join()
+        return results, errors
+
+    def test_shared_result(self):
+        "Test that concurrent callers share single call and its result"
+        results, errors = self.run_callers('key', 1)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 5)
+        for res in results:
+            self.assertTrue(res is results[0])
+        self.assertEqual(self.flight.calls, {})
+
+    def test_shared_error(self):
+        "Test that error of the call is raised by every caller"
+        error = IOError('failed')
+        results, errors = self.run_callers('key', error)
+        self.assertEqual(self.calls, [error])
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 5)
+        for exc in errors:
+            self.assertTrue(exc is error)
+        self.assertEqual(self.flight.calls, {})
+
+    def test_sequential(self):
+        "Test that calls which are not in flight are not coalesced"
+        self.assertEqual(self.flight.call('key', lambda: 1), 1)
+        self.assertEqual(self.flight.call('key', lambda: 2), 2)
+        self.assertEqual(self.flight.call('other', lambda: 3), 3)
+        self.assertEqual(self.flight.calls, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#-*- coding: ISO-8859-1 -*-
+"""
+Unit tests of cmssh utils
+"""
+
+# system modules
+import json
+import unittest
+from cStringIO import StringIO
+
+# cmssh modules
+from cmssh.utils import json_stream_parser
+
+class Source(object):
+    "File-like source which records reads and close"
+    def __init__(self, data):
+        self.fdesc  = StringIO(data)
+        self.nbytes = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        "Read data"
+        data = self.fdesc.read(size)
+        self.nbytes += len(data)
+        return data
+
+    def close(self):
+        "Close the source"
+        self.closed = True
+
+DOC = {'phedex': {'request_url': 'http://a/b?x=[1,2]', 'request_call': 'x',
+       'block': [{'name': '/a/b/c#1', 'files': 2, 'file': [{'name': 'f"\\1'}]},
+                 {'name': u'/a/b/c#é', 'files': 0, 'file': []},
+                 {'name': '/a/b/c#3', 'files': None, 'valid': True}]}}
+
+class TestJSONStreamParser(unittest.TestCase):
+    """A test class for json_stream_parser"""
+    def parse(self, doc, path, chunk=65536):
+        "Parse given document (object or JSON text) and return records"
+        data = doc if isinstance(doc, basestring) else json.dumps(doc)
+        return list(json_stream_parser(Source(data), path, chunk))
+
+    def test_path(self):
+        "Test records of array at given path"
+        self.assertEqual(self.parse(DOC, 'phedex.block'),
+                DOC['phedex']['block'])
+        self.assertEqual(self.parse(DOC['phedex']['block'], None),
+                DOC['phedex']['block'])
+        self.assertEqual(self.parse(DOC, 'phedex.request_call'), ['x'])
+        self.assertEqual(self.parse(DOC, 'phedex'), [DOC['phedex']])
+        self.assertEqual(self.parse(DOC, 'phedex.foo'), [])
+        self.assertEqual(self.parse({'a': []}, 'a'), [])
+        self.assertEqual(self.parse(' { "a" : [ 1 , 2 ] } ', 'a'), [1, 2])
+
+    def test_chunks(self):
+        "Test that records which span read chunks are decoded"
+        expect = DOC['phedex']['block']
+        for chunk in [1, 2, 3, 7, 16]:
+            self.assertEqual(self.parse(DOC, 'phedex.block', chunk), expect)
+
+    def test_lazy(self):
+        "Test that source is read lazily and closed on early stop"
+        rows = [{'name': 'x' * 100, 'idx': idx} for idx in range(1000)]
+        source = Source(json.dumps({'data': rows}))
+        gen = json_stream_parser(source, 'data', chunk=1024)
+        self.assertEqual(gen.next(), rows[0])
+        self.assertTrue(source.nbytes < 10*1024)
+        gen.close()
+        self.assertTrue(source.closed)
+
+    def test_malformed(self):
+        "Test that malformed document raises ValueError"
+        self.assertRaises(ValueError, self.parse, '{"a": [1, 2', 'a')
+        self.assertRaises(ValueError, self.parse, '{"a": [1; 2]}', 'a')
+        self.assertRaises(ValueError, self.parse, '[1, 2]', 'a')
+
+if __name__ == '__main__':
+    unittest.main()